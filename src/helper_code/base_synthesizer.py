@@ -14,7 +14,8 @@ import sqlite3
 import time
 from os import path as os_path
 
-from fourgp_speclib import SpectrumLibrarySqlite, Spectrum
+import numpy as np
+from fourgp_speclib import SpectrumLibrarySqlite, SpectrumArray
 from fourgp_specsynth import TurboSpectrum
 from fourgp_telescope_data import FourMost
 
@@ -57,6 +58,17 @@ class Synthesizer:
                             default="/tmp/turbospec_{}_{}".format(library_name, self.pid),
                             dest="log_to",
                             help="Specify a log directory where we log our progress and configuration files.")
+        parser.add_argument('--log-each-star',
+                            required=False,
+                            action='store_true',
+                            dest="log_each_star",
+                            help="Write the full output of TurboSpectrum for each star to its own log file.")
+        parser.add_argument('--no-log-each-star',
+                            required=False,
+                            action='store_false',
+                            dest="log_each_star",
+                            help="Do not write a separate log file for each star we synthesise.")
+        parser.set_defaults(log_each_star=True)
         parser.add_argument('--dump-to-sqlite-file',
                             required=False,
                             default="",
@@ -196,6 +208,32 @@ class Synthesizer:
         os.system("mkdir -p {}".format(self.args.log_to))
         self.logfile = os.path.join(self.args.log_to, "synthesis.log")
 
+    @staticmethod
+    def read_turbospectrum_output(filepath, metadata):
+        """
+        Read the text output of TurboSpectrum in a single pass, and return a SpectrumArray containing both the
+        continuum-normalised spectrum (columns 1 and 2) and the version with continuum (columns 1 and 3).
+
+        :param filepath:
+            The filename of the text output produced by TurboSpectrum.
+        :param metadata:
+            Dictionary of metadata to attach to both spectra.
+        :return:
+            SpectrumArray with the continuum-normalised spectrum first, followed by the version with continuum.
+        """
+        data = np.loadtxt(filepath, usecols=(0, 1, 2), ndmin=2).transpose()
+        wavelengths = data[0]
+        values = np.ascontiguousarray(data[1:3])
+
+        metadata_list = [dict(metadata), dict(metadata)]
+        metadata_list[0]['continuum_normalised'] = 1
+        metadata_list[1]['continuum_normalised'] = 0
+
+        return SpectrumArray(wavelengths=wavelengths,
+                             values=values,
+                             value_errors=np.zeros_like(values),
+                             metadata_list=metadata_list)
+
     def do_synthesis(self):
         # Iterate over the spectra we're supposed to be synthesizing
         with open(self.logfile, "w") as result_log:
@@ -243,8 +281,10 @@ class Synthesizer:
                 time_end = time.time()
 
                 # Log synthesizer status
-                logfile_this = os.path.join(self.args.log_to, "{}.log".format(star_name))
-                open(logfile_this, "w").write(json.dumps(turbospectrum_out))
+                if self.args.log_each_star:
+                    logfile_this = os.path.join(self.args.log_to, "{}.log".format(star_name))
+                    with open(logfile_this, "w") as f:
+                        f.write(json.dumps(turbospectrum_out))
 
                 # Check for errors
                 errors = turbospectrum_out['errors']
@@ -266,16 +306,8 @@ class Synthesizer:
                 # Insert spectrum into SpectrumLibrary
                 try:
                     filename = "spectrum_{:08d}".format(self.counter_output)
-
-                    # First import continuum-normalised spectrum, which is in columns 1 and 2
-                    metadata['continuum_normalised'] = 1
-                    spectrum = Spectrum.from_file(filename=filepath, metadata=metadata, columns=(0, 1), binary=False)
-                    self.library.insert(spectra=spectrum, filenames=filename)
-
-                    # Then import version with continuum, which is in columns 1 and 3
-                    metadata['continuum_normalised'] = 0
-                    spectrum = Spectrum.from_file(filename=filepath, metadata=metadata, columns=(0, 2), binary=False)
-                    self.library.insert(spectra=spectrum, filenames=filename)
+                    spectra = self.read_turbospectrum_output(filepath=filepath, metadata=metadata)
+                    self.library.insert(spectra=spectra, filenames=[filename, filename])
                 except (ValueError, IndexError):
                     result_log.write("[{}] {:6.0f} sec {}: {}\n".format(time.asctime(), time_end - time_start,
                                                                         star_name, "Could not read bsyn output"))
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions for querying the Cannon's internal model of the spectra of many stars at once.
+"""
+
+import numpy as np
+
+
+def label_matrix(label_values_list, label_names):
+    """
+    Build a matrix of label values, with one row per star, from a list of dictionaries of label values.
+
+    :param label_values_list:
+        A list of dictionaries, each containing the label values of one star.
+    :param label_names:
+        The list of the labels the Cannon was trained on, in the order that the Cannon expects them.
+    :return:
+        A 2D numpy array of shape (number of stars, number of labels).
+    """
+    return np.asarray([[label_values[key] for key in label_names] for label_values in label_values_list],
+                      dtype=float).reshape((-1, len(label_names)))
+
+
+def predict_spectra(cannon, labels, batch_size=1024):
+    """
+    Compute the Cannon's predicted spectrum for each row of a matrix of label values. The Cannon's model is a linear
+    combination of its coefficients, weighted by a vector of terms computed from the labels, so the spectra of many
+    stars can be computed in a single matrix multiplication, rather than by calling <predict> once for each star.
+
+    :param cannon:
+        The trained Cannon model (i.e. the <_model> attribute of a <CannonInstance>).
+    :param labels:
+        A 2D numpy array of label values, of shape (number of stars, number of labels).
+    :param batch_size:
+        The maximum number of stars to predict in each matrix multiplication, to limit memory usage.
+    :return:
+        A 2D numpy array of predicted fluxes, of shape (number of stars, number of pixels).
+    """
+    labels = np.atleast_2d(labels)
+    pixel_count = len(cannon.dispersion)
+    output = np.empty((labels.shape[0], pixel_count))
+
+    for start in range(0, labels.shape[0], batch_size):
+        stop = min(start + batch_size, labels.shape[0])
+        output[start:stop] = np.reshape(cannon.predict(labels[start:stop]), (stop - start, pixel_count))
+
+    return output
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions for storing trained Cannon models in a compact bundle which can be loaded almost instantly.
+
+A model bundle is a directory, <output>.bundle, which sits alongside the <output>.cannon and <output>.summary.json.gz
+files written by <cannon_test.py>. It contains:
+
+* header.json -- the metadata from the summary JSON file, without the wavelength raster or censoring masks, plus
+  a checksum of the .cannon file the bundle was made from. A bundle is ignored if the .cannon file alongside it no
+  longer matches this checksum, e.g. because the model has since been retrained under the same name.
+* wavelength_raster.npy and censoring_masks.npy -- the raster and masks, as binary arrays.
+* arrays/*.npy -- every large numpy array from the pickled Cannon model (coefficients, scatter, etc).
+* model.cannon -- a copy of the pickled Cannon model, in which each large array is replaced by an instruction to
+  memory-map the corresponding .npy file when it is unpickled. Files are referred to by their paths relative to the
+  bundle, so that bundles can be moved or copied freely.
+* model.summary.json.gz -- a copy of the summary JSON file.
+
+The Cannon wrappers unpickle models themselves, from a filename, so we cannot hand them an unpickler which knows where
+the bundle is. Instead, <model_reload_prefix> records the bundle directory which the array paths are resolved against.
+A bundled model.cannon can therefore only be loaded in a process which imports this module as <lib.cannon_model_bundle>
+(as all the scripts in this repository do), after calling <model_reload_prefix> on the model. Any other tool should be
+given the original <output>.cannon file, which is unaffected.
+
+Since all the arrays are memory mapped, processes on the same node which load the same model share the pages. The
+price is that the bundle holds a second copy of the model's arrays, roughly doubling the disk space it occupies.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+from os import path as os_path
+
+import numpy as np
+
+# Arrays smaller than this number of bytes are left inside the pickle, rather than being memory mapped
+minimum_mapped_array_size = 4096
+
+# The bundle directory which the array filenames in a bundled model.cannon are resolved against, when it is unpickled
+_bundle_directory = None
+
+
+def bundle_path(model_prefix):
+    """
+    Return the path of the bundle directory for a trained Cannon.
+
+    :param model_prefix:
+        The path of the output files from <cannon_test.py>, without the .cannon or .summary.json.gz suffix.
+    :return:
+        str
+    """
+    return "{}.bundle".format(model_prefix)
+
+
+def model_checksum(model_prefix):
+    """
+    Compute a checksum of the pickled Cannon model written by <cannon_test.py>.
+
+    :param model_prefix:
+        The path of the output files from <cannon_test.py>, without the .cannon or .summary.json.gz suffix.
+    :return:
+        str, or None if there is no .cannon file.
+    """
+    filename = "{}.cannon".format(model_prefix)
+    if not os_path.exists(filename):
+        return None
+
+    checksum = hashlib.md5()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def bundle_exists(model_prefix):
+    """
+    Check whether an up-to-date bundle has been written for a trained Cannon. A bundle which was made from a different
+    .cannon file to the one which now sits alongside it is ignored.
+
+    :param model_prefix:
+        The path of the output files from <cannon_test.py>, without the .cannon or .summary.json.gz suffix.
+    :return:
+        bool
+    """
+    header_filename = os_path.join(bundle_path(model_prefix), "header.json")
+    if not os_path.exists(header_filename):
+        return False
+
+    with open(header_filename) as f:
+        header = json.loads(f.read())
+    return header.get('source_checksum', None) == model_checksum(model_prefix)
+
+
+def remove_model_bundle(model_prefix):
+    """
+    Delete the bundle for a trained Cannon, if one exists. This should be called whenever a new model is saved under
+    the same name, since the bundle no longer describes it.
+
+    :param model_prefix:
+        The path of the output files from <cannon_test.py>, without the .cannon or .summary.json.gz suffix.
+    :return:
+        None
+    """
+    shutil.rmtree(bundle_path(model_prefix), ignore_errors=True)
+
+
+def model_reload_prefix(model_prefix):
+    """
+    Return the path which should be passed to tools which reload a trained Cannon (e.g. as --reload-cannon). If an
+    up-to-date bundle exists, this points to the copy of the model inside the bundle, whose arrays are memory mapped,
+    and records the bundle directory so that those arrays can be found when the model is unpickled.
+
+    :param model_prefix:
+        The path of the output files from <cannon_test.py>, without the .cannon or .summary.json.gz suffix.
+    :return:
+        str
+    """
+    global _bundle_directory
+
+    if bundle_exists(model_prefix):
+        _bundle_directory = os_path.abspath(bundle_path(model_prefix))
+        return os_path.join(bundle_path(model_prefix), "model")
+    return model_prefix
+
+
+def _load_bundle_array(filename):
+    """
+    Memory map one of the arrays from a bundle, while its model.cannon is being unpickled.
+
+    :param filename:
+        The path of the .npy file, relative to the bundle directory.
+    :return:
+        Numpy memory map
+    """
+    if _bundle_directory is None:
+        raise IOError("Cannot load <{}> from a Cannon model bundle, since the bundle directory is unknown. Use "
+                      "<model_reload_prefix> to find the model inside a bundle.".format(filename))
+
+    # Memory map copy-on-write, so that code which modifies the array in place gets a private copy of the pages
+    return np.load(os_path.join(_bundle_directory, filename), 'c')
+
+
+class _MemoryMappingPickler(pickle.Pickler):
+    """
+    A pickler which saves large numpy arrays to .npy files inside a bundle, and pickles an instruction to memory-map
+    each file in their place.
+    """
+
+    def __init__(self, file, bundle_directory):
+        super(_MemoryMappingPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.bundle_directory = bundle_directory
+        self.array_count = 0
+
+    def reducer_override(self, obj):
+        if (type(obj) is not np.ndarray) or (obj.dtype.hasobject) or (obj.nbytes < minimum_mapped_array_size):
+            return NotImplemented
+
+        filename = os_path.join("arrays", "{:04d}.npy".format(self.array_count))
+        self.array_count += 1
+        np.save(os_path.join(self.bundle_directory, filename), obj)
+
+        return _load_bundle_array, (filename,)
+
+
+def write_model_bundle(model_prefix):
+    """
+    Write a bundle for a trained Cannon, from the .cannon and .summary.json.gz files written by <cannon_test.py>.
+
+    :param model_prefix:
+        The path of the output files from <cannon_test.py>, without the .cannon or .summary.json.gz suffix.
+    :return:
+        None
+    """
+    target = os_path.abspath(bundle_path(model_prefix))
+    target_tmp = "{}.{:d}.tmp".format(target, os.getpid())
+
+    shutil.rmtree(target_tmp, ignore_errors=True)
+    os.makedirs(os_path.join(target_tmp, "arrays"))
+
+    # Read summary of the Cannon's training
+    summary_filename = "{}.summary.json.gz".format(model_prefix)
+    with gzip.open(summary_filename, "rt") as f:
+        summary = json.loads(f.read())
+
+    # Store the raster and censoring masks as binary arrays
+    np.save(os_path.join(target_tmp, "wavelength_raster.npy"), np.asarray(summary['wavelength_raster']))
+    header = dict(summary)
+    del header['wavelength_raster']
+    header['source_checksum'] = model_checksum(model_prefix)
+
+    censoring_mask = summary.get('censoring_mask', None)
+    if censoring_mask is not None:
+        header['censoring_mask'] = sorted(censoring_mask.keys())
+        np.save(os_path.join(target_tmp, "censoring_masks.npy"),
+                np.asarray([censoring_mask[label] for label in header['censoring_mask']], dtype=bool))
+
+    with open(os_path.join(target_tmp, "header.json"), "w") as f:
+        f.write(json.dumps(header, indent=2))
+
+    shutil.copyfile(summary_filename, os_path.join(target_tmp, "model.summary.json.gz"))
+
+    # Re-pickle the Cannon model, with its arrays moved into memory-mappable files
+    with open("{}.cannon".format(model_prefix), "rb") as f:
+        model = pickle.load(f)
+
+    buffer = io.BytesIO()
+    _MemoryMappingPickler(file=buffer, bundle_directory=target_tmp).dump(model)
+    with open(os_path.join(target_tmp, "model.cannon"), "wb") as f:
+        f.write(buffer.getvalue())
+
+    # Only move the bundle into place once it is complete, so that readers never see a partially written bundle
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(target_tmp, target)
+
+
+def read_model_summary(model_prefix):
+    """
+    Read the summary of a trained Cannon. If a bundle exists, the wavelength raster and censoring masks are memory
+    mapped from it, which is much faster than parsing them from the gzipped JSON file.
+
+    :param model_prefix:
+        The path of the output files from <cannon_test.py>, without the .cannon or .summary.json.gz suffix.
+    :return:
+        Dictionary, in the same format as the summary JSON file, except that the wavelength raster and censoring
+        masks may be numpy arrays.
+    """
+    if not bundle_exists(model_prefix):
+        with gzip.open("{}.summary.json.gz".format(model_prefix), "rt") as f:
+            return json.loads(f.read())
+
+    target = bundle_path(model_prefix)
+    with open(os_path.join(target, "header.json")) as f:
+        summary = json.loads(f.read())
+
+    summary['wavelength_raster'] = np.load(os_path.join(target, "wavelength_raster.npy"), mmap_mode='r')
+
+    if summary.get('censoring_mask', None) is not None:
+        masks = np.load(os_path.join(target, "censoring_masks.npy"), mmap_mode='r')
+        summary['censoring_mask'] = dict(zip(summary['censoring_mask'], masks))
+
+    return summary
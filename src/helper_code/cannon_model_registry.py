@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+A registry of trained Cannon models, kept in the workspace, which allows models to be reused by later runs which would
+otherwise train an identical model from scratch.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from os import path as os_path
+
+import numpy as np
+
+
+class CannonModelRegistry:
+    """
+    A registry of trained Cannon models, kept in the workspace, which allows models to be reused by later runs which
+    would otherwise train an identical model from scratch.
+
+    Each model is stored under a hash of everything which determines its contents: the flux and labels of the
+    training spectra, the censoring masks, and the version and options of the Cannon. Since the hash covers the
+    contents of the training spectra, rather than only their IDs, a library which is regenerated under the same name
+    never causes a stale model to be reused.
+    """
+
+    def __init__(self, workspace):
+        """
+        Open the model registry in a workspace, creating it if it doesn't already exist.
+
+        :param workspace:
+            Directory where we keep spectrum libraries.
+        :type workspace:
+            str
+        """
+        self.path = os_path.join(workspace, "cannon_model_registry")
+        os.system("mkdir -p {}".format(self.path))
+
+    @staticmethod
+    def model_hash(training_library, training_spectra, training_spectrum_ids, labels, censoring_masks, options):
+        """
+        Compute a hash which uniquely identifies a trained Cannon model.
+
+        :param training_library:
+            The absolute path of the spectrum library the Cannon was trained on.
+        :type training_library:
+            str
+        :param training_spectra:
+            The spectra the Cannon was trained on, whose wavelength raster, flux, errors and label values are all
+            included in the hash.
+        :type training_spectra:
+            SpectrumArray
+        :param training_spectrum_ids:
+            List of the IDs of the spectra the Cannon was trained on.
+        :type training_spectrum_ids:
+            list
+        :param labels:
+            List of the labels the Cannon was trained to estimate, including any label expressions.
+        :type labels:
+            list
+        :param censoring_masks:
+            Dictionary of the censoring mask for each label, or None if no censoring was applied.
+        :type censoring_masks:
+            dict
+        :param options:
+            Dictionary of any other settings which affect the trained model, e.g. the Cannon version, polynomial
+            order and tolerance.
+        :type options:
+            dict
+        :return:
+            str
+        """
+        model_hash = hashlib.sha256()
+        model_hash.update(json.dumps({
+            "training_library": training_library,
+            "training_spectrum_ids": [int(i) for i in training_spectrum_ids],
+            "labels": list(labels),
+            "label_values": [[training_spectra.get_metadata(index).get(label, None) for label in labels]
+                             for index in range(len(training_spectra))],
+            "options": options
+        }, sort_keys=True).encode('utf-8'))
+
+        for array in (training_spectra.wavelengths, training_spectra.values, training_spectra.value_errors):
+            model_hash.update(np.ascontiguousarray(array, dtype=float).data)
+
+        if censoring_masks is not None:
+            for label in sorted(censoring_masks.keys()):
+                model_hash.update(label.encode('utf-8'))
+                model_hash.update(np.packbits(np.asarray(censoring_masks[label], dtype=bool)).tobytes())
+
+        return model_hash.hexdigest()
+
+    def model_filename(self, model_hash):
+        """
+        Return the filename of the .cannon file containing a trained model.
+
+        :param model_hash:
+            The hash which identifies the model.
+        :return:
+            str
+        """
+        return os_path.join(self.path, "{}.cannon".format(model_hash))
+
+    def lookup(self, model_hash):
+        """
+        Look up whether a trained model is available in the registry.
+
+        :param model_hash:
+            The hash which identifies the model.
+        :return:
+            The filename of the .cannon file containing the trained model, or None if there is no such model.
+        """
+        filename = self.model_filename(model_hash=model_hash)
+        if os_path.exists(filename):
+            return filename
+        return None
+
+    def register(self, model_hash, filename, description):
+        """
+        Add a trained model to the registry.
+
+        :param model_hash:
+            The hash which identifies the model.
+        :param filename:
+            The filename of the .cannon file containing the trained model.
+        :param description:
+            Dictionary of information about the model, which is stored alongside it for human reference.
+        :return:
+            None
+        """
+        target = self.model_filename(model_hash=model_hash)
+
+        # Copy via a temporary file, so that other processes never see a partially-written model
+        target_tmp = "{}.{:d}.tmp".format(target, os.getpid())
+        shutil.copyfile(filename, target_tmp)
+        os.rename(target_tmp, target)
+
+        description = dict(description)
+        description['registered'] = time.time()
+        description['source'] = os_path.abspath(filename)
+        with open(os_path.join(self.path, "{}.json".format(model_hash)), "w") as f:
+            f.write(json.dumps(description, indent=2))
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""
+A class which parses the line lists used to censor the pixels that the Cannon and the Payne can see, and uses them to
+create a censoring mask for each label.
+"""
+
+import logging
+from os import path as os_path
+
+import numpy as np
+
+
+class CensoringLineList:
+    """
+    A class which parses the line lists used to censor the pixels that the Cannon and the Payne can see, and uses them
+    to create a censoring mask for each label.
+    """
+
+    # Cache of line lists we have already parsed, indexed by filename and modification time
+    _cache = {}
+
+    def __init__(self, filename, window=1):
+        """
+        Parse a line list.
+
+        :param filename:
+            The filename of the line list.
+        :type filename:
+            str
+        :param window:
+            How many Angstroms either side of lines which are specified by a single central wavelength should be used?
+        :type window:
+            float
+        """
+        self.filename = filename
+        self.window = window
+
+        element_symbols = []
+        pass_bands = []
+        excluded_bands = []
+
+        for line in open(filename):
+            line = line.strip()
+
+            # Ignore comment lines
+            if (len(line) == 0) or (line[0] == "#"):
+                continue
+            words = line.split()
+
+            # Excluded regions are listed with the wavelength in the second column; lines have it in the third column
+            if words[0] == "exclude":
+                excluded_bands.append(self._pass_band(words[1]))
+            else:
+                element_symbols.append(words[0])
+                pass_bands.append(self._pass_band(words[2]))
+
+        self.element_symbols = np.array(element_symbols, dtype=str)
+        self.pass_bands = np.array(pass_bands, dtype=float).reshape((-1, 2))
+        self.excluded_bands = np.array(excluded_bands, dtype=float).reshape((-1, 2))
+
+        # Cache of the pixel index ranges of each pass band, indexed by raster
+        self._pixel_ranges = {}
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Return a parsed copy of a line list, only parsing it if we have not already done so.
+
+        :param filename:
+            The filename of the line list.
+        :type filename:
+            str
+        :return:
+            CensoringLineList
+        """
+        key = (os_path.abspath(filename), os_path.getmtime(filename))
+        if key not in cls._cache:
+            cls._cache[key] = cls(filename=filename)
+        return cls._cache[key]
+
+    def _pass_band(self, wavelength):
+        """
+        Convert a wavelength from a line list, which is either a range (broad) or a single central wavelength (assume
+        narrow), into a pass band.
+        """
+        if "-" in wavelength:
+            return [float(i) for i in wavelength.split("-")]
+        return [float(wavelength) - self.window, float(wavelength) + self.window]
+
+    def pixel_ranges(self, raster):
+        """
+        Convert each pass band in the line list into a range of pixel indices within a wavelength raster. A pass band
+        [a, b] includes all pixels with a <= wavelength <= b.
+
+        :param raster:
+            The wavelength raster, which must be in ascending order.
+        :return:
+            A list of two items:
+
+            0. A 2D array of the first and last+1 pixel index of each line
+            1. A 2D array of the first and last+1 pixel index of each excluded region
+        """
+        raster = np.asarray(raster, dtype=float)
+        key = (raster.size, raster[0], raster[-1], hash(raster.tobytes()))
+
+        if key not in self._pixel_ranges:
+            self._pixel_ranges[key] = [
+                np.stack([np.searchsorted(raster, bands[:, 0], side='left'),
+                          np.searchsorted(raster, bands[:, 1], side='right')], axis=1)
+                for bands in (self.pass_bands, self.excluded_bands)
+            ]
+        return self._pixel_ranges[key]
+
+    @staticmethod
+    def mask_from_ranges(ranges, size):
+        """
+        Create a Boolean mask which is True within any of a list of ranges of pixel indices.
+
+        :param ranges:
+            A 2D array of the first and last+1 pixel index of each range.
+        :param size:
+            The number of pixels in the mask.
+        :return:
+            A numpy array of Booleans.
+        """
+        counts = np.zeros(size + 1, dtype=int)
+        np.add.at(counts, ranges[:, 0], 1)
+        np.add.at(counts, ranges[:, 1], -1)
+        return np.cumsum(counts[:-1]) > 0
+
+    def allowed_elements(self, censoring_scheme, label_name, label_fields):
+        """
+        Return the list of the elements whose lines a particular label is allowed to see. Lines of H are always
+        allowed.
+
+        :param censoring_scheme:
+            Switch to specify how censoring is done (1, 2 or 3). See <create_censoring_masks> in <cannon_test.py>.
+        :param label_name:
+            The label we are creating a mask for.
+        :param label_fields:
+            A list of all the labels we are fitting.
+        :return:
+            List of element symbols.
+        """
+        assert censoring_scheme in [1, 2, 3]
+
+        # Elements which have an abundance in the list of labels we're fitting
+        fitted_elements = [element for element in np.unique(self.element_symbols)
+                           if "[{}/H]".format(element) in label_fields]
+
+        # Scheme 1: All elements can see all lines
+        if censoring_scheme == 1:
+            return fitted_elements
+
+        # Scheme 2: Elements can only see their own lines, but Teff, log(g) can see all
+        # Scheme 3: As scheme 2, but [Fe/H] can also see all
+        if censoring_scheme == 2:
+            sees_all_lines = ("Teff", "logg")
+        else:
+            sees_all_lines = ("Teff", "logg", "[Fe/H]")
+
+        if label_name in sees_all_lines:
+            return fitted_elements
+        return [element for element in np.unique(self.element_symbols)
+                if "[{}/H]".format(element) == label_name]
+
+    def censoring_masks(self, censoring_scheme, raster, label_fields, label_expressions, logger=None):
+        """
+        Create censoring masks for each label we are fitting, based on pixels around the lines of each element.
+
+        :param censoring_scheme:
+            Switch to specify how censoring is done (1, 2 or 3). See <create_censoring_masks> in <cannon_test.py>.
+        :param raster:
+            The wavelength raster of the spectra we are fitting.
+        :param label_fields:
+            A list of the labels we are fitting. Used to determine which elements we need to include lines for.
+        :param label_expressions:
+            A list of the algebraic expressions for any label expressions we're fitting.
+        :param logger:
+            A logger object
+        :return:
+            A dictionary of Boolean masks, one for each label. These are True for pixels which are *excluded*.
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+
+        raster = np.asarray(raster)
+        line_ranges, excluded_ranges = self.pixel_ranges(raster=raster)
+        excluded_mask = self.mask_from_ranges(ranges=excluded_ranges, size=raster.size)
+
+        censoring_masks = {}
+        for label_name in label_fields:
+            # Only select lines from elements we're trying to fit. Always use H lines.
+            allowed_elements = self.allowed_elements(censoring_scheme=censoring_scheme,
+                                                     label_name=label_name,
+                                                     label_fields=label_fields)
+            allowed_lines = (self.element_symbols == "H") | np.isin(self.element_symbols, allowed_elements)
+
+            # Put allowed lines into the mask, and then take out the excluded regions
+            mask = self.mask_from_ranges(ranges=line_ranges[allowed_lines], size=raster.size) & ~excluded_mask
+
+            logger.info("Pixels used for label {}: {} of {} (in {} lines)".
+                        format(label_name, mask.sum(), len(raster), allowed_lines.sum()))
+
+            # Invert the mask because the Cannon expects pixels to be True when they are *excluded*
+            censoring_masks[label_name] = ~mask
+
+        # Make sure that label expressions also have masks set
+        for label_name in label_expressions:
+            mask = censoring_masks["Teff"].copy()
+            censoring_masks[label_name] = mask
+
+            logger.info("Pixels used for label {}: {} of {} (copied from Teff)".
+                        format(label_name, len(raster) - mask.sum(), len(raster)))
+
+        return censoring_masks
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+
+"""
+A class which works out the exposure times 4FS needs to observe template spectra at a range of magnitudes and SNRs.
+4FS is run on many templates in parallel, in a pool of worker processes. The results are cached in the workspace, so
+that the exposure time of a template in any given configuration only ever needs to be computed once.
+"""
+
+import json
+import logging
+import multiprocessing as mp
+import os
+import re
+import sqlite3
+from multiprocessing.util import Finalize
+from os import path as os_path
+
+from fourgp_fourfs import FourFS
+from fourgp_speclib import SpectrumLibrarySqlite
+
+# State of each worker process, set up by <_init_worker>
+_worker_settings = None
+_worker_load_template = None
+_worker_etc_wrappers = {}  # A 4FS wrapper for each magnitude, created when first needed
+_worker_libraries = {}  # Spectrum libraries which the worker has opened, indexed by path
+
+
+def _init_worker(settings, load_template):
+    """
+    Set up a worker process to run 4FS on template spectra.
+
+    :param settings:
+        Dictionary of the settings to pass to each 4FS wrapper we create.
+    :param load_template:
+        Function which loads the flux-normalised and continuum-normalised spectra of a template.
+    """
+    global _worker_settings, _worker_load_template, _worker_etc_wrappers, _worker_libraries
+
+    _worker_settings = settings
+    _worker_load_template = load_template
+    _worker_etc_wrappers = {}
+    _worker_libraries = {}
+
+    # Clean up 4FS when the process exits
+    Finalize(None, _close_etc_wrappers, exitpriority=10)
+
+
+def _close_etc_wrappers():
+    """
+    Clean up all the 4FS wrappers which this process has created.
+    """
+    for etc_wrapper in _worker_etc_wrappers.values():
+        etc_wrapper.close()
+    _worker_etc_wrappers.clear()
+
+
+def _etc_wrapper(magnitude):
+    """
+    Return a 4FS wrapper which simulates observations of objects at a particular magnitude. 4FS takes the magnitude as
+    a setting when it is instantiated, so each worker keeps one wrapper for each magnitude it has been asked about.
+
+    :param magnitude:
+        The magnitude of the objects we are simulating.
+    :return:
+        FourFS instance.
+    """
+    if magnitude not in _worker_etc_wrappers:
+        _worker_etc_wrappers[magnitude] = FourFS(
+            magnitude=magnitude,
+            identifier="exposure_times_{:d}_{:d}".format(os.getpid(), len(_worker_etc_wrappers)),
+            **_worker_settings
+        )
+    return _worker_etc_wrappers[magnitude]
+
+
+def _run_template(job):
+    """
+    Run 4FS on a single template spectrum, at each of a list of magnitudes.
+
+    :param job:
+        A tuple of (template, list of magnitudes).
+    :return:
+        A tuple of (template key, intrinsic magnitude of template, list of [magnitude, mode, snr, exposure time]).
+    """
+    template, magnitudes = job
+
+    input_spectrum, input_spectrum_continuum_normalised = _worker_load_template(template)
+
+    # Work out magnitude
+    mag_intrinsic = input_spectrum.photometry(_worker_settings["photometric_band"])
+
+    results = []
+    for magnitude in magnitudes:
+        # Pass template to 4FS
+        degraded_spectra = _etc_wrapper(magnitude=magnitude).process_spectra(
+            spectra_list=((input_spectrum, input_spectrum_continuum_normalised),)
+        )
+
+        # Loop over LRS and HRS
+        for mode in degraded_spectra:
+            # Loop over the spectra we simulated (there was only one!)
+            for index in degraded_spectra[mode]:
+                # Loop over the various SNRs we simulated
+                for snr in degraded_spectra[mode][index]:
+                    # Extract the exposure time returned by 4FS from the metadata associated with this Spectrum object
+                    exposure_time = degraded_spectra[mode][index][snr]["spectrum"].metadata["exposure"]
+                    results.append([magnitude, mode, float(snr), float(exposure_time)])
+
+    return template["key"], float(mag_intrinsic), results
+
+
+def library_templates(library_spec, workspace):
+    """
+    Search a spectrum library for template spectra, pairing each flux-normalised spectrum with the continuum-normalised
+    spectrum of the same object. The library is opened and searched only once, however many magnitudes we are to
+    simulate the templates at.
+
+    :param library_spec:
+        The name of the spectrum library, optionally followed by a list of constraints in [] brackets.
+    :param workspace:
+        Directory where we expect to find spectrum libraries.
+    :return:
+        List of dictionaries describing each template, to pass to <ExposureTimeEngine.exposure_times>.
+    """
+    # Open input SpectrumLibrary, and search for flux normalised spectra meeting our filtering constraints
+    spectra = SpectrumLibrarySqlite.open_and_search(library_spec=library_spec,
+                                                    workspace=workspace,
+                                                    extra_constraints={"continuum_normalised": 0}
+                                                    )
+    input_library, input_spectra_ids, input_spectra_constraints = [spectra[i]
+                                                                   for i in ("library", "items", "constraints")]
+
+    # Search for all of the continuum-normalised spectra meeting the same constraints
+    search_criteria = input_spectra_constraints.copy()
+    search_criteria['continuum_normalised'] = 1
+    continuum_normalised_ids = input_library.search(**search_criteria)
+
+    if len(input_spectra_ids) == 0:
+        return []
+
+    # Extract name of spectrum library. Filter off any constraints which follow the name in []
+    library_name = re.match("([^\[]*)", library_spec).group(1)
+    library_path = os_path.join(workspace, library_name)
+
+    # If the library changes, the exposure times we have cached for its templates may no longer be valid
+    index_status = os.stat(os_path.join(library_path, "index.db"))
+    library_version = "{:d}:{:d}".format(int(index_status.st_mtime), index_status.st_size)
+
+    input_metadata = input_library.get_metadata(ids=[item['specId'] for item in input_spectra_ids])
+    continuum_normalised_metadata = input_library.get_metadata(ids=[item['specId']
+                                                                    for item in continuum_normalised_ids])
+
+    # Newer spectrum libraries have a uid field which is guaranteed unique; for older spectrum libraries use
+    # Starname instead.
+    spectrum_matching_field = 'uid' if 'uid' in input_metadata[0] else 'Starname'
+
+    # Look up the continuum-normalised version of each object (which will share the same uid / name)
+    continuum_normalised_by_name = {}
+    for item, metadata in zip(continuum_normalised_ids, continuum_normalised_metadata):
+        continuum_normalised_by_name.setdefault(metadata[spectrum_matching_field], []).append(item['specId'])
+
+    templates = []
+    for item, metadata in zip(input_spectra_ids, input_metadata):
+        object_name = metadata[spectrum_matching_field]
+
+        # Check that continuum-normalised spectrum exists and is unique
+        matches = continuum_normalised_by_name.get(object_name, [])
+        assert len(matches) == 1, "Could not find continuum-normalised spectrum for <{}>.".format(object_name)
+
+        templates.append({
+            "key": "{}/{}/{}".format(library_name, object_name, library_version),
+            "name": object_name,
+            "filename": item['filename'],
+            "library_path": library_path,
+            "spectrum_id": item['specId'],
+            "continuum_normalised_id": matches[0]
+        })
+
+    return templates
+
+
+def load_library_template(template):
+    """
+    Load the flux-normalised and continuum-normalised spectra of a template returned by <library_templates>. Each
+    worker process opens its own connection to the spectrum library.
+
+    :param template:
+        Dictionary describing the template.
+    :return:
+        A tuple of (flux-normalised Spectrum, continuum-normalised Spectrum).
+    """
+    library_path = template["library_path"]
+    if library_path not in _worker_libraries:
+        _worker_libraries[library_path] = SpectrumLibrarySqlite(path=library_path, create=False)
+    library = _worker_libraries[library_path]
+
+    input_spectrum = library.open(ids=template["spectrum_id"]).extract_item(0)
+    input_spectrum_continuum_normalised = library.open(ids=template["continuum_normalised_id"]).extract_item(0)
+    return input_spectrum, input_spectrum_continuum_normalised
+
+
+class ExposureTimeEngine:
+    """
+    A class which works out the exposure times 4FS needs to observe template spectra at a range of magnitudes and SNRs.
+
+    Exposure times are cached in an SQLite database in the workspace, indexed by the template, the magnitude, the
+    photometric band the magnitude is measured in, the definition of SNR, the mode (LRS or HRS) and the SNR.
+    """
+
+    def __init__(self, workspace, binary_path, snr_list, photometric_band="SDSS_r", snr_definitions=None,
+                 snr_definitions_lrs=None, snr_definitions_hrs=None, run_lrs=True, run_hrs=True, processes=1,
+                 logger=None):
+        """
+        Instantiate an exposure time engine.
+
+        :param workspace:
+            Directory where we keep spectrum libraries, and our cache of exposure times.
+        :param binary_path:
+            Directory where the 4FS package is installed.
+        :param snr_list:
+            List of the SNRs at which we want to know exposure times.
+        :param photometric_band:
+            The name of the photometric band in which magnitudes are specified.
+        :param snr_definitions:
+            List of custom definitions of SNR to pass to 4FS, each of the form [name, minimum, maximum].
+        :param snr_definitions_lrs:
+            List of the SNR definitions to use for each arm of 4MOST LRS, or None to use the default.
+        :param snr_definitions_hrs:
+            List of the SNR definitions to use for each arm of 4MOST HRS, or None to use the default.
+        :param run_lrs:
+            Boolean indicating whether we want exposure times for 4MOST LRS.
+        :param run_hrs:
+            Boolean indicating whether we want exposure times for 4MOST HRS.
+        :param processes:
+            The number of worker processes to run 4FS in. If 1, 4FS is run in this process.
+        :param logger:
+            A logger to report progress to.
+        """
+        self.snr_list = [float(snr) for snr in snr_list]
+        self.photometric_band = photometric_band
+        self.processes = processes
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        self.modes = [mode for mode, active in (("LRS", run_lrs), ("HRS", run_hrs)) if active]
+
+        # Settings passed to each 4FS wrapper
+        self.etc_settings = {
+            "path_to_4fs": os_path.join(binary_path, "OpSys/ETC"),
+            "snr_definitions": snr_definitions,
+            "magnitude_unreddened": False,
+            "photometric_band": photometric_band,
+            "run_lrs": run_lrs,
+            "run_hrs": run_hrs,
+            "lrs_use_snr_definitions": snr_definitions_lrs,
+            "hrs_use_snr_definitions": snr_definitions_hrs,
+            "snr_list": self.snr_list,
+            "snr_per_pixel": False
+        }
+
+        # String describing the definition of SNR, which forms part of the index of our cache
+        self.snr_definition = json.dumps([snr_definitions, snr_definitions_lrs, snr_definitions_hrs])
+
+        # Open the cache of exposure times
+        self.cache_filename = os_path.join(workspace, "exposure_time_cache.db")
+        self.cache = sqlite3.connect(self.cache_filename)
+        self.cache.execute("""
+CREATE TABLE IF NOT EXISTS exposure_times (
+    template TEXT, band TEXT, snr_definition TEXT, magnitude REAL, mode TEXT, snr REAL, exposure REAL,
+    PRIMARY KEY (template, band, snr_definition, magnitude, mode, snr));
+""")
+        self.cache.execute("""
+CREATE TABLE IF NOT EXISTS intrinsic_magnitudes (
+    template TEXT, band TEXT, magnitude REAL,
+    PRIMARY KEY (template, band));
+""")
+        self.cache.commit()
+
+    def close(self):
+        """
+        Close the cache of exposure times.
+        """
+        self.cache.close()
+
+    def cached_exposure_times(self, template_key, magnitude):
+        """
+        Look up the exposure times of a template at a particular magnitude in our cache.
+
+        :param template_key:
+            The string which uniquely identifies the template.
+        :param magnitude:
+            The magnitude of the template.
+        :return:
+            Dictionary of exposure times, indexed by [mode][snr], or None if any are missing from the cache.
+        """
+        output = dict([(mode, {}) for mode in self.modes])
+        for mode, snr, exposure in self.cache.execute("""
+SELECT mode, snr, exposure FROM exposure_times
+WHERE template=? AND band=? AND snr_definition=? AND magnitude=?;
+""", (template_key, self.photometric_band, self.snr_definition, float(magnitude))):
+            if (mode in output) and (snr in self.snr_list):
+                output[mode][snr] = exposure
+
+        for mode in self.modes:
+            if len(output[mode]) < len(self.snr_list):
+                return None
+        return output
+
+    def cached_intrinsic_magnitude(self, template_key):
+        """
+        Look up the intrinsic magnitude of a template in our cache.
+
+        :param template_key:
+            The string which uniquely identifies the template.
+        :return:
+            The magnitude of the template in our photometric band, or None if it is not in the cache.
+        """
+        for (magnitude,) in self.cache.execute("""
+SELECT magnitude FROM intrinsic_magnitudes WHERE template=? AND band=?;
+""", (template_key, self.photometric_band)):
+            return magnitude
+        return None
+
+    def _store_results(self, template_key, mag_intrinsic, results):
+        """
+        Write the output from running 4FS on a template into our cache.
+        """
+        self.cache.execute("""
+REPLACE INTO intrinsic_magnitudes (template, band, magnitude) VALUES (?,?,?);
+""", (template_key, self.photometric_band, mag_intrinsic))
+        self.cache.executemany("""
+REPLACE INTO exposure_times (template, band, snr_definition, magnitude, mode, snr, exposure) VALUES (?,?,?,?,?,?,?);
+""", [(template_key, self.photometric_band, self.snr_definition, float(magnitude), mode, snr, exposure)
+      for magnitude, mode, snr, exposure in results])
+        self.cache.commit()
+
+    def exposure_times(self, templates, magnitudes, load_template=load_library_template):
+        """
+        Work out the exposure times needed to observe a list of templates at each of a list of magnitudes. 4FS is only
+        run on templates and magnitudes which are not already in our cache.
+
+        :param templates:
+            List of dictionaries describing each template, e.g. as returned by <library_templates>. Each must have a
+            field <key> which uniquely identifies it.
+        :param magnitudes:
+            List of the magnitudes to simulate each template at.
+        :param load_template:
+            Function which takes a template dictionary, and returns a tuple of its flux-normalised Spectrum and its
+            continuum-normalised Spectrum (which may be None). This must be defined at the top level of a module, so
+            that it can be passed to the worker processes.
+        :return:
+            A tuple of two dictionaries: the intrinsic magnitude of each template, indexed by template key, and the
+            exposure times, indexed by [template key][magnitude][mode][snr].
+        """
+        magnitudes = [float(magnitude) for magnitude in magnitudes]
+
+        # Work out which magnitudes we need to run 4FS at for each template
+        jobs = []
+        for template in templates:
+            missing = [magnitude for magnitude in magnitudes
+                       if self.cached_exposure_times(template_key=template["key"], magnitude=magnitude) is None]
+            if missing or (self.cached_intrinsic_magnitude(template_key=template["key"]) is None):
+                jobs.append((template, missing))
+
+        self.logger.info("Running 4FS on {:d} of {:d} templates; the remainder are cached in <{}>.".
+                         format(len(jobs), len(templates), self.cache_filename))
+
+        # Run 4FS on each template, either in this process, or across a pool of worker processes
+        if jobs:
+            settings = dict(self.etc_settings)
+            settings_args = (settings, load_template)
+
+            if self.processes == 1:
+                _init_worker(*settings_args)
+                try:
+                    for job in jobs:
+                        self.logger.info("Working on <{}>".format(job[0]["name"]))
+                        self._store_results(*_run_template(job))
+                finally:
+                    _close_etc_wrappers()
+            else:
+                pool = mp.get_context("fork").Pool(processes=self.processes,
+                                                   initializer=_init_worker,
+                                                   initargs=settings_args)
+                try:
+                    for job_index, result in enumerate(pool.imap(_run_template, jobs)):
+                        self.logger.info("Finished template {:d}/{:d}".format(job_index + 1, len(jobs)))
+                        self._store_results(*result)
+
+                    # Let the workers exit cleanly, so that they clean up their 4FS wrappers
+                    pool.close()
+                except BaseException:
+                    # Don't leave workers running if 4FS fails on any template, or we fail to cache the results
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+
+        # Read all the exposure times back from the cache
+        intrinsic_magnitudes = {}
+        exposure_times = {}
+        for template in templates:
+            intrinsic_magnitudes[template["key"]] = self.cached_intrinsic_magnitude(template_key=template["key"])
+            exposure_times[template["key"]] = {}
+            for magnitude in magnitudes:
+                exposure_times[template["key"]][magnitude] = self.cached_exposure_times(template_key=template["key"],
+                                                                                        magnitude=magnitude)
+
+        return intrinsic_magnitudes, exposure_times
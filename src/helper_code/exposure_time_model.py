@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+A class for estimating the exposure time needed to observe a template spectrum at any magnitude and SNR, by
+interpolating between exposure times which 4FS computed at a few anchor magnitudes.
+
+Exposure times vary smoothly with magnitude and SNR, following the noise model of the spectrograph, and close to
+a power law in each. We therefore interpolate linearly in log(exposure time), as a function of magnitude (itself a
+logarithm of flux) and log(SNR).
+"""
+
+import logging
+
+import numpy as np
+
+from .exposure_time_engine import load_library_template
+
+
+def _interpolation_weights(grid, x):
+    """
+    Work out how to linearly interpolate between the points of a grid.
+
+    :param grid:
+        Sorted numpy array of the grid points, with at least two entries.
+    :param x:
+        Numpy array of the positions we want to interpolate values at.
+    :return:
+        A tuple of (index of grid point below each position, weight of the grid point above, boolean mask of which
+        positions lie within the grid).
+    """
+    index = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    weight = (x - grid[index]) / (grid[index + 1] - grid[index])
+    inside = (x >= grid[0]) & (x <= grid[-1])
+    return index, weight, inside
+
+
+class ExposureTimeModel:
+    """
+    A model of the exposure time needed to observe one template spectrum, in each mode, as a function of magnitude
+    and SNR, interpolated between exposure times which 4FS computed at a few anchor magnitudes.
+    """
+
+    def __init__(self, exposure_times):
+        """
+        Create an exposure time model for a template.
+
+        :param exposure_times:
+            Dictionary of the exposure times computed by 4FS, indexed by [magnitude][mode][snr], as returned by
+            <ExposureTimeEngine.exposure_times>. There must be at least two anchor magnitudes.
+        """
+        self.magnitudes = np.array(sorted(exposure_times.keys()), dtype=float)
+        assert len(self.magnitudes) >= 2, "Need at least two anchor magnitudes to interpolate exposure times."
+
+        first_anchor = exposure_times[self.magnitudes[0]]
+        self.modes = sorted(first_anchor.keys())
+
+        self.snr_list = {}
+        self.log_exposure = {}
+        for mode in self.modes:
+            self.snr_list[mode] = np.array(sorted(first_anchor[mode].keys()), dtype=float)
+
+            # Table of log(exposure time) at each [magnitude, SNR]. Exposure times which are not positive and finite
+            # (e.g. because 4FS could not reach the SNR) become NaN, and propagate into any interpolated values.
+            exposure = np.array([[exposure_times[magnitude][mode][snr] for snr in self.snr_list[mode]]
+                                 for magnitude in self.magnitudes], dtype=float)
+            valid = np.isfinite(exposure) & (exposure > 0)
+            self.log_exposure[mode] = np.where(valid, np.log10(np.where(valid, exposure, 1)), np.nan)
+
+    def exposure_time(self, mode, magnitude, snr):
+        """
+        Estimate the exposure time needed to observe the template at some magnitude and SNR.
+
+        :param mode:
+            The mode of 4MOST, either "LRS" or "HRS".
+        :param magnitude:
+            The magnitude of the object, or a numpy array of magnitudes.
+        :param snr:
+            The SNR we want to reach, or a numpy array of SNRs.
+        :return:
+            The exposure time, or a numpy array of exposure times. This is NaN wherever the magnitude or SNR lie
+            outside the range of the anchor points, since we do not extrapolate.
+        """
+        magnitude, snr = np.broadcast_arrays(np.asarray(magnitude, dtype=float), np.asarray(snr, dtype=float))
+        snr_list = self.snr_list[mode]
+        log_exposure = self.log_exposure[mode]
+
+        # If we only have exposure times at a single SNR, we can only answer queries at that SNR
+        if len(snr_list) == 1:
+            snr_list = np.array([snr_list[0], snr_list[0] * 10])
+            log_exposure = np.hstack([log_exposure, log_exposure])
+            snr_inside = (snr == snr_list[0])
+        else:
+            snr_inside = True
+
+        i, weight_i, mag_inside = _interpolation_weights(grid=self.magnitudes, x=magnitude)
+        j, weight_j, log_snr_inside = _interpolation_weights(grid=np.log10(snr_list), x=np.log10(snr))
+
+        log_output = ((1 - weight_i) * (1 - weight_j) * log_exposure[i, j] +
+                      weight_i * (1 - weight_j) * log_exposure[i + 1, j] +
+                      (1 - weight_i) * weight_j * log_exposure[i, j + 1] +
+                      weight_i * weight_j * log_exposure[i + 1, j + 1])
+
+        output = np.where(mag_inside & log_snr_inside & snr_inside, 10 ** log_output, np.nan)
+        return output if output.ndim > 0 else float(output)
+
+
+def interpolation_errors(models, held_out_exposure_times):
+    """
+    Compare the exposure times estimated by a set of models against exposure times computed by 4FS at magnitudes
+    which were not used as anchor points.
+
+    :param models:
+        Dictionary of the ExposureTimeModel for each template, indexed by template key.
+    :param held_out_exposure_times:
+        Dictionary of the exposure times computed by 4FS, indexed by [template key][magnitude][mode][snr].
+    :return:
+        Dictionary of numpy arrays of the fractional errors in the estimated exposure times, indexed by mode.
+    """
+    errors = {}
+    for template_key, model in models.items():
+        if model is None:
+            continue
+        for magnitude, exposure_times in held_out_exposure_times[template_key].items():
+            if exposure_times is None:
+                continue
+            for mode in exposure_times:
+                snr_list = np.array(sorted(exposure_times[mode].keys()), dtype=float)
+                exact = np.array([exposure_times[mode][snr] for snr in snr_list], dtype=float)
+                estimate = model.exposure_time(mode=mode, magnitude=magnitude, snr=snr_list)
+                fractional_error = estimate / exact - 1
+                errors.setdefault(mode, []).extend(fractional_error[np.isfinite(fractional_error)])
+
+    return dict([(mode, np.array(values)) for mode, values in errors.items()])
+
+
+def interpolated_exposure_times(engine, templates, magnitudes, anchor_magnitudes, validation_magnitudes=None,
+                                load_template=load_library_template, logger=None):
+    """
+    Estimate the exposure times needed to observe a list of templates at each of a list of magnitudes, by running 4FS
+    only at a few anchor magnitudes, and interpolating between them.
+
+    :param engine:
+        The ExposureTimeEngine used to run 4FS at the anchor magnitudes.
+    :param templates:
+        List of dictionaries describing each template, e.g. as returned by <library_templates>.
+    :param magnitudes:
+        List of the magnitudes we want to know exposure times at. These must lie within the range of the anchor
+        magnitudes.
+    :param anchor_magnitudes:
+        List of the magnitudes at which we run 4FS.
+    :param validation_magnitudes:
+        Optional list of magnitudes at which we also run 4FS, to measure the error in the interpolated exposure times.
+    :param load_template:
+        Function which loads a template, as passed to <ExposureTimeEngine.exposure_times>.
+    :param logger:
+        A logger to report the interpolation errors to.
+    :return:
+        A tuple of two dictionaries, in the same format as returned by <ExposureTimeEngine.exposure_times>: the
+        intrinsic magnitude of each template, and the exposure times, indexed by [template key][magnitude][mode][snr].
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    magnitudes = [float(magnitude) for magnitude in magnitudes]
+    anchor_magnitudes = sorted(set(float(magnitude) for magnitude in anchor_magnitudes))
+
+    if (len(anchor_magnitudes) < 2) or (min(magnitudes) < anchor_magnitudes[0]) or \
+            (max(magnitudes) > anchor_magnitudes[-1]):
+        raise ValueError("Magnitudes {} must lie within the range of at least two anchor magnitudes {}.".
+                         format(magnitudes, anchor_magnitudes))
+
+    # Run 4FS at the anchor magnitudes, and fit a model to each template
+    intrinsic_magnitudes, anchor_exposure_times = engine.exposure_times(templates=templates,
+                                                                        magnitudes=anchor_magnitudes,
+                                                                        load_template=load_template)
+    models = {}
+    for template in templates:
+        template_exposure_times = anchor_exposure_times[template["key"]]
+        if any(item is None for item in template_exposure_times.values()):
+            models[template["key"]] = None
+        else:
+            models[template["key"]] = ExposureTimeModel(exposure_times=template_exposure_times)
+
+    # Report how well the model reproduces exposure times computed by 4FS at magnitudes it has not seen
+    if validation_magnitudes:
+        _, held_out_exposure_times = engine.exposure_times(templates=templates,
+                                                           magnitudes=validation_magnitudes,
+                                                           load_template=load_template)
+        errors = interpolation_errors(models=models, held_out_exposure_times=held_out_exposure_times)
+        for mode in sorted(errors.keys()):
+            if len(errors[mode]) == 0:
+                continue
+            logger.info("{} interpolation error at held-out magnitudes: RMS {:.2f}%, max {:.2f}%, over {:d} points".
+                        format(mode,
+                               100 * np.sqrt(np.mean(errors[mode] ** 2)),
+                               100 * np.max(np.abs(errors[mode])),
+                               len(errors[mode])))
+
+    # Evaluate models at the requested magnitudes
+    exposure_times = {}
+    for template in templates:
+        model = models[template["key"]]
+        exposure_times[template["key"]] = {}
+        for magnitude in magnitudes:
+            if model is None:
+                exposure_times[template["key"]][magnitude] = None
+                continue
+            exposure_times[template["key"]][magnitude] = dict([
+                (mode, dict([(snr, model.exposure_time(mode=mode, magnitude=magnitude, snr=snr))
+                             for snr in model.snr_list[mode].tolist()]))
+                for mode in model.modes
+            ])
+
+    return intrinsic_magnitudes, exposure_times
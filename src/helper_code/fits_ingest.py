@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions used by the scripts which import FITS files into spectrum libraries: opening FITS files with their data
+memory mapped, converting FITS tables into Python values a column at a time, and processing many input files
+concurrently in a pool of worker processes, while a single process writes the results into spectrum libraries.
+"""
+
+import multiprocessing as mp
+
+import numpy as np
+from astropy.io import fits
+
+
+def open_fits(filename):
+    """
+    Open a FITS file, with the data in each HDU memory mapped rather than read into memory. HDUs are only parsed when
+    they are first accessed.
+
+    :param filename:
+        The filename of the FITS file.
+    :return:
+        An astropy HDUList.
+    """
+    return fits.open(filename, memmap=True, lazy_load_hdus=True)
+
+
+def fits_table_columns(table, column_names=None):
+    """
+    Convert the columns of a FITS table into lists of Python values, converting a whole column at a time rather than
+    one value at a time. String columns are converted into str values, and all other columns into floats.
+
+    :param table:
+        The data in a FITS table HDU (an astropy FITS_rec).
+    :param column_names:
+        The list of the columns to convert. If None, convert every column.
+    :return:
+        Dictionary of a list of the values in each column.
+    """
+    if column_names is None:
+        column_names = table.names
+
+    columns = {}
+    for column_name in column_names:
+        column = table[column_name]
+        if table.dtype[column_name].type is np.bytes_:
+            columns[column_name] = [str(value) for value in column]
+        else:
+            columns[column_name] = np.asarray(column, dtype=float).tolist()
+    return columns
+
+
+def ingest_files(filenames, process_file, write_output, processes=None, initializer=None, initializer_args=()):
+    """
+    Process a list of input files concurrently, in a pool of worker processes, and pass the results from each file
+    back to this process to be written out. This means that only one process ever writes to the output spectrum
+    libraries.
+
+    :param filenames:
+        The list of the input files to process.
+    :param process_file:
+        Function, called in a worker process with the filename of each input file, which returns a result to be
+        written out. This must be defined at the top level of a module, so that it can be passed to the workers.
+    :param write_output:
+        Function, called in this process with the result from each input file, in the same order as <filenames>.
+    :param processes:
+        The number of worker processes to use. If 1, the files are processed in this process, without a pool.
+    :param initializer:
+        Function which is called once in each worker process when it starts, e.g. to create a 4FS instance for that
+        worker's private use.
+    :param initializer_args:
+        Arguments to pass to <initializer>.
+    :return:
+        None
+    """
+    if processes == 1:
+        if initializer is not None:
+            initializer(*initializer_args)
+        for filename in filenames:
+            write_output(process_file(filename))
+        return
+
+    pool = mp.get_context("fork").Pool(processes=processes,
+                                       initializer=initializer,
+                                       initargs=initializer_args)
+    try:
+        for result in pool.imap(process_file, filenames):
+            write_output(result)
+
+        # Let the workers exit cleanly, so that any finalizers they registered (e.g. to clean up 4FS) are run
+        pool.close()
+    except BaseException:
+        # Don't leave workers running, or holding pending results, if any file fails
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+A class for evaluating computed labels, such as B-V colours, which are algebraic expressions of metadata fields. Each
+expression is compiled once, and then evaluated over numpy arrays of the metadata fields of many spectra at once.
+"""
+
+import ast
+
+import numpy as np
+
+
+class LabelExpression:
+    """
+    A class for evaluating computed labels, such as B-V colours, which are algebraic expressions of metadata fields.
+
+    Expressions are parsed into a Python syntax tree, and only simple arithmetic on metadata fields, numbers and a
+    few mathematical functions is allowed. This means they can be safely evaluated without a copy of Python's
+    built-in functions, and that they work equally well on numpy arrays as on single values.
+    """
+
+    # Mathematical functions which may be used in label expressions
+    functions = {
+        "abs": np.abs,
+        "exp": np.exp,
+        "log": np.log,
+        "log10": np.log10,
+        "sqrt": np.sqrt,
+        "min": np.minimum,
+        "max": np.maximum
+    }
+
+    # Types of node which may appear in the syntax tree of a label expression
+    allowed_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+                     ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.UAdd, ast.USub)
+
+    def __init__(self, expression):
+        """
+        Compile a label expression.
+
+        :param expression:
+            The algebraic expression to evaluate, e.g. "photometry_B - photometry_V".
+        :type expression:
+            str
+        """
+        self.expression = expression
+
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError:
+            raise ValueError("Could not parse label expression <{}>".format(expression))
+
+        names = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, self.allowed_nodes):
+                raise ValueError("Label expression <{}> contains unsupported syntax <{}>".
+                                 format(expression, type(node).__name__))
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError("Label expression <{}> contains a constant which is not a number".format(expression))
+            if isinstance(node, ast.Call):
+                if not (isinstance(node.func, ast.Name) and node.func.id in self.functions and not node.keywords):
+                    raise ValueError("Label expression <{}> calls an unsupported function".format(expression))
+            elif isinstance(node, ast.Name):
+                names.add(node.id)
+
+        # The names of the metadata fields the expression depends on
+        self.names = sorted(names - set(self.functions.keys()))
+
+        self.code = compile(tree, filename="<label expression>", mode='eval')
+
+    def evaluate(self, columns):
+        """
+        Evaluate the label expression.
+
+        :param columns:
+            Dictionary of the values of each metadata field the expression depends on. These may be single values, or
+            numpy arrays with one entry per spectrum.
+        :return:
+            The value of the expression, or a numpy array of values.
+        """
+        namespace = dict(self.functions)
+        namespace.update((name, columns[name]) for name in self.names)
+        return eval(self.code, {"__builtins__": {}}, namespace)
+
+
+def evaluate_label_expressions(label_expressions, metadata_list):
+    """
+    Evaluate a list of label expressions for many spectra at once.
+
+    :param label_expressions:
+        A list of the computed label expressions to evaluate.
+    :param metadata_list:
+        A list of the metadata dictionaries of the spectra to evaluate the expressions for.
+    :return:
+        Dictionary of a numpy array of the values of each label expression, with one entry per spectrum.
+    """
+    compiled_expressions = [LabelExpression(expression=expression) for expression in label_expressions]
+
+    # Gather each metadata field we need into a numpy array. Missing values become NaN.
+    names = sorted(set(name for expression in compiled_expressions for name in expression.names))
+    columns = {}
+    for name in names:
+        column = [metadata[name] for metadata in metadata_list]
+        columns[name] = np.array([np.nan if value is None else value for value in column], dtype=float)
+
+    output = {}
+    for expression in compiled_expressions:
+        values = expression.evaluate(columns=columns)
+        output[expression.expression] = np.broadcast_to(np.asarray(values, dtype=float), (len(metadata_list),))
+    return output
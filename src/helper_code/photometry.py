@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions for computing the flux and magnitudes of spectra in photometric bands as matrix products. The transmission
+curve of each pyphot filter is resampled onto a spectrum's wavelength raster once, as a vector of weights, so that the
+flux of many spectra, in many bands, can then be computed in a single matrix multiplication (see <band_fluxes>).
+"""
+
+import hashlib
+
+import numpy as np
+import pyphot
+
+# Cache of filter response matrices, indexed by the hash of the wavelength raster, and the list of bands
+_response_cache = {}
+
+
+def _filter_curve(band):
+    """
+    Look up the transmission curve of a photometric band in pyphot's library of filters.
+
+    :param band:
+        The name of the photometric band, e.g. "SDSS_r".
+    :return:
+        A tuple of (numpy array of wavelengths in Angstrom, numpy array of transmission, boolean indicating whether
+        the filter counts photons rather than energy).
+    """
+    photometric_filter = pyphot.get_library()[band]
+
+    # pyphot returns wavelengths as quantities with units, if a units package is installed
+    wavelength = photometric_filter.wavelength
+    if hasattr(wavelength, "to"):
+        wavelength = wavelength.to("AA")
+    wavelength = np.asarray(getattr(wavelength, "magnitude", getattr(wavelength, "value", wavelength)), dtype=float)
+
+    transmission = np.asarray(photometric_filter.transmit, dtype=float)
+    photon_counter = (photometric_filter.dtype == "photon")
+    return wavelength, transmission, photon_counter
+
+
+def band_response(band, wavelengths):
+    """
+    Resample the transmission curve of a photometric band onto a wavelength raster, as a vector of weights. The dot
+    product of this vector with a spectrum's flux gives the mean flux density of the spectrum within the band, as
+    computed by pyphot's trapezium-rule integral.
+
+    :param band:
+        The name of the photometric band, e.g. "SDSS_r".
+    :param wavelengths:
+        Numpy array of the wavelengths of the raster, in Angstrom.
+    :return:
+        Numpy array of weights, with one entry per pixel of the raster.
+    """
+    filter_wavelengths, transmission, photon_counter = _filter_curve(band=band)
+    resampled_transmission = np.interp(wavelengths, filter_wavelengths, transmission, left=0, right=0)
+
+    # Weight of each pixel in a trapezium-rule integral over the raster
+    pixel_widths = np.zeros_like(wavelengths, dtype=float)
+    pixel_widths[:-1] += np.diff(wavelengths) / 2
+    pixel_widths[1:] += np.diff(wavelengths) / 2
+
+    weights = pixel_widths * resampled_transmission
+    if photon_counter:
+        weights *= wavelengths
+
+    return weights / np.sum(weights)
+
+
+def band_responses(wavelengths, bands):
+    """
+    Return a matrix of the response of each of a list of photometric bands on a wavelength raster. Matrices are cached,
+    so that the filter curves only need to be resampled once for each distinct raster.
+
+    :param wavelengths:
+        Numpy array of the wavelengths of the raster, in Angstrom.
+    :param bands:
+        List of the names of the photometric bands.
+    :return:
+        2D numpy array of shape (number of pixels, number of bands). Multiplying a 2D array of spectra (one per row)
+        by this matrix gives the mean flux density of each spectrum in each band.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    key = (hashlib.md5(wavelengths.tobytes()).hexdigest(), tuple(bands))
+
+    if key not in _response_cache:
+        _response_cache[key] = np.stack([band_response(band=band, wavelengths=wavelengths) for band in bands], axis=1)
+    return _response_cache[key]
+
+
+def band_fluxes(values, responses):
+    """
+    Compute the mean flux density of one or more spectra in each of a list of photometric bands. Each band only sums
+    over the pixels it covers, so NaN pixels outside a band do not affect its flux. NaN pixels inside a band leave
+    its flux undefined, and it is returned as NaN.
+
+    :param values:
+        Numpy array of the flux of a spectrum, or 2D numpy array of the fluxes of many spectra (one per row).
+    :param responses:
+        2D numpy array of the response of each band on the spectra's raster, as returned by <band_responses>.
+    :return:
+        Numpy array of the flux in each band, or 2D numpy array of shape (number of spectra, number of bands).
+    """
+    values = np.asarray(values, dtype=float)
+    finite = np.isfinite(values)
+
+    fluxes = np.atleast_2d(np.dot(np.where(finite, values, 0), responses))
+    fluxes[np.atleast_2d(np.dot(~finite, responses > 0))] = np.nan
+    return fluxes if values.ndim > 1 else fluxes[0]
+
+
+class PhotometryEngine:
+    """
+    A class for computing the magnitudes of many spectra in many photometric bands at once.
+
+    Magnitudes are computed from the matrix product of a block of spectra with the response matrix of the bands on
+    their wavelength raster. The zero point of each band on each raster is calibrated once, against the magnitudes
+    returned by <Spectrum.photometry> for several spectra, so that the magnitudes we return follow the same
+    convention.
+    """
+
+    def __init__(self, bands, calibration_spectra=5):
+        """
+        Instantiate a photometry engine.
+
+        :param bands:
+            List of the names of the photometric bands we compute magnitudes in.
+        :param calibration_spectra:
+            The number of spectra against which we calibrate the zero point of each band. We take the median of the
+            zero points they imply, so that a single spectrum with bad photometry cannot corrupt it.
+        """
+        self.bands = list(bands)
+        self.calibration_spectra = int(calibration_spectra)
+
+        # Zero point of each band, indexed by the hash of the wavelength raster
+        self._zero_points = {}
+
+    def _zero_point(self, spectra, band_fluxes):
+        """
+        Return the zero point of each band on the raster of a block of spectra, calibrating it if necessary.
+
+        :param spectra:
+            SpectrumArray of spectra which share a wavelength raster.
+        :param band_fluxes:
+            2D numpy array of the flux of each spectrum in each band.
+        :return:
+            Numpy array of the zero point of each band.
+        """
+        key = hashlib.md5(np.asarray(spectra.wavelengths, dtype=float).tobytes()).hexdigest()
+
+        if key not in self._zero_points:
+            zero_points = np.full(len(self.bands), np.nan)
+            fully_calibrated = True
+            for band_index, band in enumerate(self.bands):
+                # Calibrate against several spectra with some flux in this band, spread through the block
+                usable = np.flatnonzero(np.isfinite(band_fluxes[:, band_index]) & (band_fluxes[:, band_index] > 0))
+                if len(usable) > self.calibration_spectra:
+                    usable = usable[np.linspace(0, len(usable) - 1, self.calibration_spectra).astype(int)]
+
+                estimates = []
+                for index in usable:
+                    magnitude = spectra.extract_item(index).photometry(band=band)
+                    if np.isfinite(magnitude):
+                        estimates.append(magnitude + 2.5 * np.log10(band_fluxes[index, band_index]))
+
+                if len(estimates) > 0:
+                    zero_points[band_index] = np.median(estimates)
+                fully_calibrated = fully_calibrated and (len(estimates) >= self.calibration_spectra)
+
+            # Only cache the zero points once every band has been calibrated against enough spectra. Otherwise, we
+            # calibrate again on the next block.
+            if not fully_calibrated:
+                return zero_points
+            self._zero_points[key] = zero_points
+
+        return self._zero_points[key]
+
+    def magnitudes(self, spectra):
+        """
+        Compute the magnitude of a block of spectra in each photometric band.
+
+        :param spectra:
+            SpectrumArray of spectra which share a wavelength raster.
+        :return:
+            2D numpy array of shape (number of spectra, number of bands).
+        """
+        responses = band_responses(wavelengths=spectra.wavelengths, bands=self.bands)
+        fluxes = band_fluxes(values=np.atleast_2d(spectra.values), responses=responses)
+
+        zero_points = self._zero_point(spectra=spectra, band_fluxes=fluxes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return zero_points[np.newaxis, :] - 2.5 * np.log10(fluxes)
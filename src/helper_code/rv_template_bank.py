@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+
+"""
+A bank of cross-correlation templates, stored in Fourier space, which allows the RVs of test spectra to be estimated
+with a single batched multiply-and-inverse-FFT against every template in each arm.
+
+Optionally, a coarse-to-fine search can be used. The test spectrum is first cross-correlated against a binned,
+low-resolution copy of the bank, and the full upsampled cross-correlation is then only computed for the few templates
+which matched best.
+
+The cross-correlation is computed independently of <RvInstanceCrossCorrelation>, so <RvTemplateBank.check_agreement>
+can be used to confirm that both give consistent RVs for a test spectrum.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from collections import namedtuple
+from os import path as os_path
+
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+# Speed of light, m/s
+speed_of_light = 299792458.
+
+# Pixels with uncertainties larger than this are treated as missing data. The RV test scripts set the uncertainties of
+# NaN pixels to 1000.
+max_usable_error = 100.
+
+
+class RvTemplateBank:
+    """
+    A bank of cross-correlation templates, stored in Fourier space, which allows the RVs of test spectra to be estimated
+    with a single batched multiply-and-inverse-FFT against every template in each arm.
+    """
+
+    def __init__(self, rv_calculator, bank_path=None, upsampling=1, coarse_binning=0, coarse_candidates=10,
+                 logger=None):
+        """
+        Build a Fourier-space template bank from the templates loaded by an <RvInstanceCrossCorrelation>, or reload
+        it from disk if a matching bank has already been saved.
+
+        :param rv_calculator:
+            The <RvInstanceCrossCorrelation> instance whose template spectra we are to use.
+        :param bank_path:
+            The directory where the template bank is stored, normally inside the template spectrum library. If None,
+            the bank is held in memory only and never saved.
+        :type bank_path:
+            str
+        :param upsampling:
+            The factor by which both the templates and the test spectra are upsampled before cross-correlation.
+        :type upsampling:
+            int
+        :param coarse_binning:
+            If greater than one, we do a coarse-to-fine search. Templates are first scored by cross-correlating binned
+            copies of the spectra, with this many pixels per bin, and only the best matches are cross-correlated at
+            full resolution. If zero, every template is cross-correlated at full resolution.
+        :type coarse_binning:
+            int
+        :param coarse_candidates:
+            The number of templates, in each arm, which go forward from the coarse search to full cross-correlation.
+        :type coarse_candidates:
+            int
+        :param logger:
+            A logger object
+        """
+        self.rv_calculator = rv_calculator
+        self.bank_path = bank_path
+        self.upsampling = int(upsampling)
+        self.coarse_binning = int(coarse_binning)
+        self.coarse_candidates = int(coarse_candidates)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        # Expose the same template information as the underlying RV code, so that we can be used as a drop-in
+        # replacement for it
+        self.templates_by_arm = rv_calculator.templates_by_arm
+        self.arm_properties = rv_calculator.arm_properties
+
+        # Dictionaries of the Fourier-space templates for each arm, at full resolution and binned for coarse searches
+        self.arms = {}
+        self.coarse_arms = {}
+
+        for mode in self.templates_by_arm:
+            for arm_name in self.templates_by_arm[mode]:
+                self.arms[arm_name] = self._load_or_build_arm(mode=mode, arm_name=arm_name,
+                                                              upsampling=self.upsampling, binning=1)
+                if self.coarse_binning > 1:
+                    self.coarse_arms[arm_name] = self._load_or_build_arm(mode=mode, arm_name=arm_name,
+                                                                         upsampling=1, binning=self.coarse_binning)
+
+    @classmethod
+    def from_spectra(cls, templates_by_arm, arm_properties, upsampling=1, logger=None):
+        """
+        Build an in-memory template bank directly from template spectra, without needing a template spectrum
+        library on disk.
+
+        :param templates_by_arm:
+            Dictionary, indexed by mode and then arm name, of lists of template Spectrum objects. All the templates
+            in each arm must share the same logarithmic wavelength raster.
+        :type templates_by_arm:
+            dict
+        :param arm_properties:
+            Dictionary of the properties of each arm, in the same format as <RvInstanceCrossCorrelation>.
+        :type arm_properties:
+            dict
+        :param upsampling:
+            The factor by which both the templates and the test spectra are upsampled before cross-correlation.
+        :type upsampling:
+            int
+        :param logger:
+            A logger object
+        :return:
+            RvTemplateBank
+        """
+        return cls(rv_calculator=namedtuple("templates", ("templates_by_arm", "arm_properties"))
+                   (templates_by_arm, arm_properties),
+                   upsampling=upsampling,
+                   logger=logger)
+
+    def _arm_filename(self, arm_name, upsampling, binning, suffix):
+        if binning > 1:
+            return os_path.join(self.bank_path, "{}_x{:d}_bin{:d}.{}".format(arm_name, upsampling, binning, suffix))
+        return os_path.join(self.bank_path, "{}_x{:d}.{}".format(arm_name, upsampling, suffix))
+
+    @staticmethod
+    def _bin_pixels(pixels, binning):
+        """
+        Average together groups of <binning> adjacent pixels along the last axis of an array.
+        """
+        if binning <= 1:
+            return pixels
+        bin_count = pixels.shape[-1] // binning
+        return pixels[..., :bin_count * binning].reshape(pixels.shape[:-1] + (bin_count, binning)).mean(axis=-1)
+
+    def _load_or_build_arm(self, mode, arm_name, upsampling, binning):
+        """
+        Return the Fourier-space templates for a single arm, building them if no matching bank exists on disk.
+        """
+        templates = list(self.templates_by_arm[mode][arm_name])
+
+        # Hash the template spectra, so that we can tell whether a bank saved on disk is still valid
+        template_hash = hashlib.md5()
+        for template in templates:
+            template_hash.update(np.ascontiguousarray(template.wavelengths, dtype=np.float64).tobytes())
+            template_hash.update(np.ascontiguousarray(template.values, dtype=np.float64).tobytes())
+        template_hash = template_hash.hexdigest()
+
+        # See if we have a matching bank on disk already
+        if self.bank_path is not None:
+            header_filename = self._arm_filename(arm_name=arm_name, upsampling=upsampling, binning=binning,
+                                                 suffix="json")
+            if os_path.exists(header_filename):
+                with open(header_filename) as f:
+                    header = json.load(f)
+                if header.get('template_hash', None) == template_hash:
+                    self.logger.info("Loading Fourier template bank for arm <{}>".format(arm_name))
+                    try:
+                        return self._arm_from_header(
+                            header=header,
+                            ffts=np.load(self._arm_filename(arm_name=arm_name, upsampling=upsampling,
+                                                            binning=binning, suffix="npy"),
+                                         mmap_mode='r')
+                        )
+                    except KeyError:
+                        # Banks saved by older versions of this code lack some of the fields we need
+                        self.logger.info("Fourier template bank for arm <{}> is out of date".format(arm_name))
+
+        self.logger.info("Building Fourier template bank for arm <{}> ({:d} templates)".format(arm_name,
+                                                                                            len(templates)))
+
+        # Upsampled logarithmic raster, onto which we interpolate spectra before binning them (if required) and doing
+        # cross-correlation
+        template_raster = np.asarray(templates[0].wavelengths, dtype=np.float64)
+        log_raster = np.linspace(np.log(template_raster[0]), np.log(template_raster[-1]),
+                                 (len(template_raster) - 1) * upsampling + 1)
+        pixel_count = len(log_raster) // binning
+
+        # Pad FFTs to at least twice the raster length, to avoid wrap-around in the cross-correlation
+        fft_length = 1 << int(np.ceil(np.log2(2 * pixel_count)))
+
+        template_pixels = np.zeros((len(templates), len(log_raster)))
+        for index, template in enumerate(templates):
+            template_pixels[index] = np.interp(x=log_raster,
+                                               xp=np.log(np.asarray(template.wavelengths, dtype=np.float64)),
+                                               fp=template.values)
+
+        template_pixels = self._bin_pixels(pixels=1 - template_pixels, binning=binning)
+        ffts = np.conj(np.fft.rfft(self._normalise(template_pixels), n=fft_length, axis=1))
+
+        header = {
+            'mode': mode,
+            'arm_name': arm_name,
+            'template_hash': template_hash,
+            'upsampling': upsampling,
+            'binning': binning,
+            'log_lambda_min': float(log_raster[0]),
+            'log_lambda_max': float(log_raster[-1]),
+            'raster_length': len(log_raster),
+            'pixel_count': int(pixel_count),
+            'fft_length': int(fft_length),
+            'stellar_parameters': [[float(template.metadata.get(label, np.nan))
+                                    for label in ("Teff", "logg", "[Fe/H]")]
+                                   for template in templates]
+        }
+
+        # Save the bank to disk, so that subsequent runs can memory-map it. Each file is written to a temporary name
+        # and then renamed, and the header goes last, so that other processes never load a partially-written bank.
+        if self.bank_path is not None:
+            os.system("mkdir -p {}".format(self.bank_path))
+            fft_filename = self._arm_filename(arm_name=arm_name, upsampling=upsampling, binning=binning, suffix="npy")
+            header_filename = self._arm_filename(arm_name=arm_name, upsampling=upsampling, binning=binning,
+                                                 suffix="json")
+
+            with open("{}.{:d}.tmp".format(fft_filename, os.getpid()), "wb") as f:
+                np.save(f, ffts)
+            os.rename("{}.{:d}.tmp".format(fft_filename, os.getpid()), fft_filename)
+
+            with open("{}.{:d}.tmp".format(header_filename, os.getpid()), "w") as f:
+                json.dump(header, f)
+            os.rename("{}.{:d}.tmp".format(header_filename, os.getpid()), header_filename)
+
+            ffts = np.load(fft_filename, mmap_mode='r')
+
+        return self._arm_from_header(header=header, ffts=ffts)
+
+    @staticmethod
+    def _arm_from_header(header, ffts):
+        arm = dict(header)
+        arm['log_raster'] = np.linspace(header['log_lambda_min'], header['log_lambda_max'], header['raster_length'])
+        arm['log_step'] = (arm['log_raster'][1] - arm['log_raster'][0]) * header['binning']
+        arm['stellar_parameters'] = np.asarray(header['stellar_parameters'])
+        arm['ffts'] = ffts
+        return arm
+
+    @staticmethod
+    def _normalise(pixels):
+        """
+        Subtract the mean from each row of a 2D array of pixel values, and scale each row to unit norm, so that the
+        cross-correlation of two rows is a correlation coefficient.
+        """
+        pixels = pixels - np.mean(pixels, axis=-1, keepdims=True)
+        norm = np.sqrt(np.sum(pixels * pixels, axis=-1, keepdims=True))
+        norm[norm == 0] = 1
+        return pixels / norm
+
+    def cross_correlate(self, input_spectrum, arm, template_indices=None):
+        """
+        Cross-correlate a test spectrum against the templates in one arm.
+
+        :param input_spectrum:
+            The Spectrum object we are to estimate the RV of.
+        :param arm:
+            The dictionary describing the bank of templates for this arm, from either <self.arms> or
+            <self.coarse_arms>.
+        :param template_indices:
+            The indices of the templates we are to cross-correlate against. If None, we use all of them.
+        :return:
+            List of [2D array of cross-correlation functions (one row per template, indexed by pixel lag), number
+            of usable pixels in the test spectrum, counted on its native raster rather than the upsampled one]
+        """
+        wavelengths = np.asarray(input_spectrum.wavelengths, dtype=np.float64)
+        values = np.asarray(input_spectrum.values, dtype=np.float64)
+        errors = np.asarray(input_spectrum.value_errors, dtype=np.float64)
+        usable = np.isfinite(values) & (errors < max_usable_error)
+
+        # Resample test spectrum onto the upsampled logarithmic raster of this arm
+        log_wavelengths = np.log(wavelengths[usable])
+        observed = np.interp(x=arm['log_raster'], xp=log_wavelengths, fp=1 - values[usable], left=0, right=0)
+        in_range = (arm['log_raster'] >= log_wavelengths[0]) & (arm['log_raster'] <= log_wavelengths[-1])
+        observed = self._normalise(self._bin_pixels(pixels=observed * in_range, binning=arm['binning']))
+
+        # Reading a subset of rows from a memory-mapped bank only touches the pages we need
+        template_ffts = arm['ffts'] if template_indices is None else arm['ffts'][template_indices]
+
+        observed_fft = np.fft.rfft(observed, n=arm['fft_length'])
+        ccf = np.fft.irfft(template_ffts * observed_fft[np.newaxis, :], n=arm['fft_length'], axis=1)
+
+        # Reorder lags so that they run from -(pixel_count-1) to +(pixel_count-1)
+        pixel_count = arm['pixel_count']
+        ccf = np.concatenate((ccf[:, -(pixel_count - 1):], ccf[:, :pixel_count]), axis=1)
+
+        # Number of independent pixels in the test spectrum which overlap this arm, counted on its native raster
+        overlapping = (log_wavelengths >= arm['log_raster'][0]) & (log_wavelengths <= arm['log_raster'][-1])
+        usable_pixels = max(int(np.sum(overlapping)), 1)
+
+        return ccf, usable_pixels
+
+    def _measure_peak(self, ccf_row, arm, usable_pixels, interpolation_scheme, interpolation_pixels):
+        """
+        Find the sub-pixel position of the peak of a single CCF, and convert it into a radial velocity.
+
+        :return:
+            List of [radial velocity (m/s), uncertainty (m/s)]
+        """
+        pixel_count = arm['pixel_count']
+        peak = int(np.argmax(ccf_row))
+
+        # Select pixels around the peak to use for sub-pixel interpolation
+        half_width = max(int(interpolation_pixels) // 2, 1)
+        start = max(peak - half_width, 0)
+        end = min(peak + half_width + 1, len(ccf_row))
+        x = np.arange(start, end, dtype=np.float64)
+        y = ccf_row[start:end]
+
+        # Fit a quadratic, which we also use to estimate the curvature of the CCF peak
+        if len(x) >= 3:
+            a, b, _ = np.polyfit(x - peak, y, 2)
+        else:
+            a, b = -1, 0
+
+        if a < 0 and abs(b / (2 * a)) <= half_width:
+            peak_position = peak - b / (2 * a)
+        else:
+            peak_position = float(peak)
+
+        if interpolation_scheme == "spline" and len(x) >= 4:
+            spline = CubicSpline(x, y)
+            x_fine = np.linspace(x[0], x[-1], 20 * len(x))
+            peak_position = x_fine[np.argmax(spline(x_fine))]
+
+        # Convert pixel lag into a radial velocity
+        lag = peak_position - (pixel_count - 1)
+        rv = speed_of_light * (np.exp(lag * arm['log_step']) - 1)
+
+        # Estimate the uncertainty from the curvature of the CCF peak (Zucker 2003, MNRAS, 342, 1291). The number of
+        # usable pixels is counted on the test spectrum's native raster, so we express the curvature of the CCF, and
+        # the step in log(wavelength), per native pixel rather than per (upsampled and binned) CCF lag.
+        native_pixels_per_lag = arm['binning'] / arm['upsampling']
+        native_log_step = arm['log_step'] / native_pixels_per_lag
+        peak_height = min(max(ccf_row[peak], 1e-6), 1 - 1e-6)
+        curvature = 2 * a / native_pixels_per_lag ** 2
+        if curvature < 0:
+            lag_variance = -(1 - peak_height ** 2) / (usable_pixels * curvature * peak_height)
+            rv_error = speed_of_light * native_log_step * np.sqrt(lag_variance)
+        else:
+            rv_error = np.nan
+
+        return rv, rv_error
+
+    def estimate_rv(self, input_spectrum, mode, arm_names=None, interpolation_scheme="quadratic",
+                    interpolation_pixels=3):
+        """
+        Estimate the RV of a test spectrum. This has the same call signature, and returns the same values, as
+        <RvInstanceCrossCorrelation.estimate_rv>.
+
+        :param input_spectrum:
+            The Spectrum object we are to estimate the RV of.
+        :param mode:
+            The 4MOST mode (LRS or HRS) of the test spectrum.
+        :param arm_names:
+            The names of the arms we are to use. If None, all arms of this mode are used.
+        :param interpolation_scheme:
+            The functional form to use for sub-pixel interpolation of the CCF: "quadratic" or "spline".
+        :param interpolation_pixels:
+            The number of pixels to use for sub-pixel interpolation of the CCF.
+        :return:
+            List of [RV (m/s), RV uncertainty (m/s), stellar parameters of best-fit template, per-arm estimates]
+        """
+        if arm_names is None:
+            arm_names = self.templates_by_arm[mode].keys()
+
+        rv_estimates = []
+        for arm_name in arm_names:
+            arm = self.arms[arm_name]
+
+            # In a coarse-to-fine search, shortlist the templates whose binned spectra correlate best with the
+            # binned test spectrum
+            candidates = None
+            if arm_name in self.coarse_arms:
+                coarse_ccf, _ = self.cross_correlate(input_spectrum=input_spectrum, arm=self.coarse_arms[arm_name])
+                coarse_scores = np.max(coarse_ccf, axis=1)
+                candidate_count = min(self.coarse_candidates, len(coarse_scores))
+                candidates = np.sort(np.argsort(-coarse_scores)[:candidate_count])
+
+            ccf, usable_pixels = self.cross_correlate(input_spectrum=input_spectrum, arm=arm,
+                                                      template_indices=candidates)
+
+            # Pick the template which matches the test spectrum best
+            best_template = int(np.argmax(np.max(ccf, axis=1)))
+            ccf_row = ccf[best_template]
+            if candidates is not None:
+                best_template = int(candidates[best_template])
+
+            rv, rv_error = self._measure_peak(ccf_row=ccf_row, arm=arm, usable_pixels=usable_pixels,
+                                              interpolation_scheme=interpolation_scheme,
+                                              interpolation_pixels=interpolation_pixels)
+
+            rv_estimates.append({
+                'arm_name': arm_name,
+                'rv': rv,
+                'rv_error': rv_error,
+                'ccf_peak': float(np.max(ccf_row)),
+                'template_index': best_template,
+                'stellar_parameters': arm['stellar_parameters'][best_template]
+            })
+
+        # Combine the estimates from each arm, weighted by their uncertainties
+        rvs = np.array([item['rv'] for item in rv_estimates])
+        rv_errors = np.array([item['rv_error'] for item in rv_estimates])
+        if np.all(np.isfinite(rv_errors)) and np.all(rv_errors > 0):
+            weights = rv_errors ** -2
+            rv_mean = np.sum(rvs * weights) / np.sum(weights)
+            rv_std_dev = np.sqrt(1. / np.sum(weights))
+        else:
+            rv_mean = np.mean(rvs)
+            rv_std_dev = np.std(rvs) if len(rvs) > 1 else np.nan
+
+        # Report the stellar parameters of the template with the strongest CCF peak
+        best_arm = max(rv_estimates, key=lambda item: item['ccf_peak'])
+        stellar_parameters = best_arm['stellar_parameters']
+
+        return rv_mean, rv_std_dev, stellar_parameters, rv_estimates
+
+    def check_agreement(self, input_spectrum, mode, interpolation_scheme="quadratic", interpolation_pixels=3):
+        """
+        Check that the RVs we estimate for a test spectrum agree with those from the <RvInstanceCrossCorrelation>
+        whose templates we were built from. In each arm, the two RVs should agree to within the larger of their
+        uncertainties. Since we compute the CCF independently, small differences are expected on noisy spectra, so a
+        disagreement is logged as a warning rather than treated as an error. An arm where neither code returns a
+        finite uncertainty cannot be checked, and counts as a disagreement.
+
+        :param input_spectrum:
+            The Spectrum object we are to estimate the RV of.
+        :param mode:
+            The 4MOST mode (LRS or HRS) of the test spectrum.
+        :param interpolation_scheme:
+            The functional form to use for sub-pixel interpolation of the CCF: "quadratic" or "spline".
+        :param interpolation_pixels:
+            The number of pixels to use for sub-pixel interpolation of the CCF.
+        :return:
+            List of [dictionary of the difference between the two RV estimates in each arm (m/s), boolean indicating
+            whether they agreed in every arm]
+        """
+        differences = {}
+        agreed = True
+        for arm_name in self.templates_by_arm[mode]:
+            reference = self.rv_calculator.estimate_rv(input_spectrum=input_spectrum, mode=mode, arm_names=(arm_name,),
+                                                       interpolation_scheme=interpolation_scheme,
+                                                       interpolation_pixels=interpolation_pixels)
+            estimate = self.estimate_rv(input_spectrum=input_spectrum, mode=mode, arm_names=(arm_name,),
+                                        interpolation_scheme=interpolation_scheme,
+                                        interpolation_pixels=interpolation_pixels)
+
+            differences[arm_name] = estimate[0] - reference[0]
+            rv_errors = [rv_error for rv_error in (reference[1], estimate[1]) if np.isfinite(rv_error)]
+            tolerance = max(rv_errors) if rv_errors else np.nan
+            self.logger.info("Template bank RV in arm <{}> differs from <fourgp_rv> by {:.1f} m/s "
+                             "(tolerance {:.1f} m/s)".format(arm_name, differences[arm_name], tolerance))
+
+            if not (np.isfinite(differences[arm_name]) and np.isfinite(tolerance) and
+                    abs(differences[arm_name]) <= tolerance):
+                agreed = False
+                self.logger.warning("Template bank RV in arm <{}> of {:.1f} +/- {:.1f} m/s disagrees with <fourgp_rv> "
+                                    "RV of {:.1f} +/- {:.1f} m/s".format(arm_name, estimate[0], estimate[1],
+                                                                         reference[0], reference[1]))
+
+        return differences, agreed
@@ -24,6 +24,7 @@ You specify an input library pattern, e.g. "demo_stars". We then look for all sp
 # python merge_libraries.py --input-library marcs_stars
 # python merge_libraries.py --input-library turbospec_marcs_grid
 # python merge_libraries.py --input-library turbospec_ges_dwarfs_perturbed
+# python merge_libraries.py --input-library turbospec_galah --processes 8
 
 import argparse
 import glob
@@ -47,6 +48,9 @@ parser.add_argument('--input-library',
                          "<demo_stars_*> into a single spectrum library called <demo_stars>.")
 parser.add_argument('--workspace', dest='workspace', default="",
                     help="Directory where we expect to find spectrum libraries.")
+parser.add_argument('--processes', default=1, dest='processes', type=int,
+                    help="The number of worker processes <rearrange.py> should use to read the input libraries "
+                         "concurrently.")
 args = parser.parse_args()
 
 logger.info("Running library merger on spectra with arguments <{}>".format(args.input_library))
@@ -64,6 +68,7 @@ for item in input_libraries:
     command_line += " --input-library {}".format(os.path.split(item)[1])
 
 command_line += " --output-library {}".format(args.input_library)
+command_line += " --processes {:d}".format(args.processes)
 
 # Show the user the python command we're about to run
 print(command_line)
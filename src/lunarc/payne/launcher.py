@@ -17,6 +17,9 @@ python commands which have been split over many lines.
 Unfortunately, it seems very necessary to run this in SLURM's exclusive mode. Otherwise, the out of memory killer
 tends to kill your jobs.
 
+To train all the batches of pixels in parallel on a single machine instead, use <payne_batch_orchestrator.py> in the
+<test_payne> directory.
+
 """
 
 import argparse
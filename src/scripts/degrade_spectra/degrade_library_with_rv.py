@@ -20,7 +20,8 @@ import re
 import time
 from os import path as os_path
 
-from fourgp_speclib import SpectrumLibrarySqlite
+import numpy as np
+from fourgp_speclib import SpectrumLibrarySqlite, SpectrumArray
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
                     datefmt='%d/%m/%Y %H:%M:%S')
@@ -78,6 +79,9 @@ parser.add_argument('--log-file',
                     default="/tmp/add_rv_{}.log".format(pid),
                     dest="log_to",
                     help="Specify a log file where we log our progress.")
+parser.add_argument('--block-size', dest='block_size', type=int, default=1000,
+                    help="The number of spectra to shift and insert into the output library at once. Spectra on "
+                         "different wavelength rasters are inserted separately.")
 args = parser.parse_args()
 
 logger.info("Adding radial velocities to spectra from <{}>, going into <{}>".format(args.input_library,
@@ -112,66 +116,128 @@ if args.db_in_tmp:
 # Parse the list of radial velocities which were passed to us on the command line
 rv_list = [float(item.strip()) for item in args.rv_list.split(",")]
 
-# Start making a log file
-with open(args.log_to, "w") as result_log:
-    # Loop over spectra to process
-    for input_spectrum_id in input_spectra_ids:
-        logger.info("Working on <{}>".format(input_spectrum_id['filename']))
-        # Open Spectrum data from disk
-        input_spectrum_array = input_library.open(ids=input_spectrum_id['specId'])
-
-        # Turn SpectrumArray object into a Spectrum object
-        input_spectrum = input_spectrum_array.extract_item(0)
-
-        # Look up the unique ID of the star we've just loaded
-        # Newer spectrum libraries have a uid field which is guaranteed unique; for older spectrum libraries use
-        # Starname instead.
+# Search for the continuum-normalised versions of all the same objects (which will share the same uid / name)
+search_criteria = input_spectra_constraints.copy()
+search_criteria['continuum_normalised'] = 1
+continuum_normalised_spectra_ids = input_library.search(**search_criteria)
+continuum_normalised_metadata = input_library.get_metadata(ids=[item['specId']
+                                                                for item in continuum_normalised_spectra_ids])
+
+# Look up the unique ID of each object
+# Newer spectrum libraries have a uid field which is guaranteed unique; for older spectrum libraries use
+# Starname instead.
+input_metadata = input_library.get_metadata(ids=[item['specId'] for item in input_spectra_ids])
+spectrum_matching_field = 'uid' if (input_metadata and 'uid' in input_metadata[0]) else 'Starname'
+
+continuum_normalised_by_name = {}
+for item, metadata in zip(continuum_normalised_spectra_ids, continuum_normalised_metadata):
+    continuum_normalised_by_name.setdefault(metadata[spectrum_matching_field], []).append(item['specId'])
+
+# Cache of the wavelength raster produced by applying each RV to each input raster, indexed by [raster hash, rv]
+shifted_rasters = {}
+
+
+def raster_hash(wavelengths):
+    """
+    Return a hash of a wavelength raster, which we use to tell whether spectra share the same raster.
+
+    :param wavelengths:
+        Numpy array of wavelengths.
+    :return:
+        str
+    """
+    return hashlib.md5(np.asarray(wavelengths, dtype=float).tobytes()).hexdigest()
+
+
+def spectrum_array(spectra):
+    """
+    Combine a list of spectra which share a wavelength raster into a single SpectrumArray.
+
+    :param spectra:
+        List of Spectrum objects.
+    :return:
+        SpectrumArray
+    """
+    return SpectrumArray(wavelengths=spectra[0].wavelengths,
+                         values=np.array([spectrum.values for spectrum in spectra]),
+                         value_errors=np.array([spectrum.value_errors for spectrum in spectra]),
+                         metadata_list=[spectrum.metadata for spectrum in spectra])
+
+
+def shifted_raster(spectra, rv):
+    """
+    Return the wavelength raster of a block of spectra, after applying a radial velocity. Applying a radial velocity
+    shifts the wavelength raster without affecting the flux data, so the shifted raster is the same for every spectrum
+    which shares the same input raster. We work it out once, using the <apply_radial_velocity> method of the first
+    spectrum in the block.
+
+    :param spectra:
+        SpectrumArray of spectra which share a wavelength raster.
+    :param rv:
+        The radial velocity to apply, in m/s.
+    :return:
+        Numpy array of the shifted wavelengths.
+    """
+    key = (raster_hash(spectra.wavelengths), rv)
+    if key not in shifted_rasters:
+        shifted_rasters[key] = spectra.extract_item(0).apply_radial_velocity(rv).wavelengths
+    return shifted_rasters[key]
 
-        # Work out which field we're using (uid or Starname)
-        spectrum_matching_field = 'uid' if 'uid' in input_spectrum.metadata else 'Starname'
 
-        # Look up the unique ID of this object
-        object_name = input_spectrum.metadata[spectrum_matching_field]
-
-        # Write log message
-        result_log.write("\n[{}] {}... ".format(time.asctime(), object_name))
+# Start making a log file
+with open(args.log_to, "w") as result_log:
+    # Loop over blocks of spectra to process
+    for block_start in range(0, len(input_spectra_ids), args.block_size):
+        block_ids = input_spectra_ids[block_start:block_start + args.block_size]
+        block_metadata = input_metadata[block_start:block_start + args.block_size]
+        logger.info("Working on spectra {:d}-{:d} of {:d}".format(block_start + 1, block_start + len(block_ids),
+                                                                  len(input_spectra_ids)))
+
+        # Find the continuum-normalised version of each object in this block
+        block_continuum_normalised_ids = []
+        for metadata in block_metadata:
+            object_name = metadata[spectrum_matching_field]
+
+            # Write log message
+            result_log.write("\n[{}] {}... ".format(time.asctime(), object_name))
+
+            # Check that continuum-normalised spectrum exists and is unique
+            continuum_normalised_spectrum_id = continuum_normalised_by_name.get(object_name, [])
+            assert len(continuum_normalised_spectrum_id) == 1, "Could not find continuum-normalised spectrum."
+            block_continuum_normalised_ids.append(continuum_normalised_spectrum_id[0])
         result_log.flush()
 
-        # Search for the continuum-normalised version of this same object (which will share the same uid / name)
-        search_criteria = input_spectra_constraints.copy()
-        search_criteria[spectrum_matching_field] = object_name
-        search_criteria['continuum_normalised'] = 1
-        continuum_normalised_spectrum_id = input_library.search(**search_criteria)
-
-        # Check that continuum-normalised spectrum exists and is unique
-        assert len(continuum_normalised_spectrum_id) == 1, "Could not find continuum-normalised spectrum."
-
-        # Load the continuum-normalised version
-        input_spectrum_continuum_normalised_arr = input_library.open(ids=continuum_normalised_spectrum_id[0]['specId'])
-
-        # Turn the SpectrumArray we got back into a single Spectrum
-        input_spectrum_continuum_normalised = input_spectrum_continuum_normalised_arr.extract_item(0)
-
-        # Process spectra with each radial velocity in turn
-        for rv in rv_list:
-            # Apply RV to the flux-normalised spectrum
-            degraded = input_spectrum.apply_radial_velocity(rv * 1000)
-
-            # Apply RV to the continuum-normalised spectrum
-            degraded_cn = input_spectrum_continuum_normalised.apply_radial_velocity(rv * 1000)
-
-            # Create a unique ID for this mock observation (shared between the flux- and continuum-normalised output)
-            unique_id = hashlib.md5(os.urandom(32)).hexdigest()[:16]
-
-            # Save the flux-normalised output
-            output_library.insert(spectra=degraded,
-                                  filenames=input_spectrum_id['filename'],
-                                  metadata_list={"uid": unique_id, "rv": rv * 1000})
-
-            # Save the continuum-normalised output
-            output_library.insert(spectra=degraded_cn,
-                                  filenames=input_spectrum_id['filename'],
-                                  metadata_list={"uid": unique_id, "rv": rv * 1000})
+        # Open Spectrum data from disk, for both the flux- and continuum-normalised versions of every object in block.
+        # A library may contain spectra on more than one raster, so we group the objects by the rasters of their flux-
+        # and continuum-normalised spectra, and only combine spectra which share a raster into a SpectrumArray.
+        raster_groups = {}
+        for item, continuum_normalised_id in zip(block_ids, block_continuum_normalised_ids):
+            input_spectrum = input_library.open(ids=item['specId']).extract_item(0)
+            input_spectrum_continuum_normalised = input_library.open(ids=continuum_normalised_id).extract_item(0)
+            raster_key = (raster_hash(input_spectrum.wavelengths),
+                          raster_hash(input_spectrum_continuum_normalised.wavelengths))
+            raster_groups.setdefault(raster_key, []).append((item, input_spectrum, input_spectrum_continuum_normalised))
+
+        for group in raster_groups.values():
+            input_spectra = spectrum_array([spectrum for item, spectrum, _ in group])
+            input_spectra_continuum_normalised = spectrum_array([spectrum for item, _, spectrum in group])
+
+            # Process spectra with each radial velocity in turn
+            for rv in rv_list:
+                # Create a unique ID for each mock observation (shared between flux- and continuum-normalised output)
+                rv_metadata = [{"uid": hashlib.md5(os.urandom(32)).hexdigest()[:16], "rv": rv * 1000}
+                               for i in range(len(group))]
+
+                # Save the flux-normalised and continuum-normalised output, shifting the raster of each
+                for spectra in (input_spectra, input_spectra_continuum_normalised):
+                    output_library.insert(spectra=SpectrumArray(wavelengths=shifted_raster(spectra=spectra,
+                                                                                           rv=rv * 1000),
+                                                                values=spectra.values,
+                                                                value_errors=spectra.value_errors,
+                                                                metadata_list=[dict(spectra.get_metadata(index),
+                                                                                    **rv_metadata[index])
+                                                                               for index in range(len(group))]),
+                                          filenames=[item['filename'] for item, _, _ in group])
 
 # If we put database in /tmp while adding entries to it, now return it to original location
 if args.db_in_tmp:
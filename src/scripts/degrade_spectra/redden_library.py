@@ -19,8 +19,10 @@ import re
 import time
 from os import path as os_path
 
+import numpy as np
 from fourgp_degrade import SpectrumReddener
-from fourgp_speclib import SpectrumLibrarySqlite
+from fourgp_speclib import SpectrumLibrarySqlite, Spectrum, SpectrumArray
+from lib.photometry import band_fluxes, band_responses
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
                     datefmt='%d/%m/%Y %H:%M:%S')
@@ -95,6 +97,35 @@ photometric_bands = ["SDSS_r", "SDSS_g", "GROUND_JOHNSON_V", "GROUND_JOHNSON_B"]
 # Parse the list of reddening values (i.e. E_BV) which we were passed on the command line
 ebv_list = [float(item.strip()) for item in args.ebv_list.split(",")]
 
+# Cache of the extinction curve of the reddening model on each wavelength raster, indexed by hash of the raster
+extinction_curves = {}
+
+
+def extinction_curve(wavelengths):
+    """
+    Return the extinction, in magnitudes per unit E(B-V), at each wavelength of a raster. Extinction is proportional
+    to E(B-V), so we find this by reddening a spectrum of unit flux once, and reuse it for all E(B-V) values and all
+    spectra which share the same raster.
+
+    :param wavelengths:
+        Numpy array of the wavelengths of the raster.
+    :return:
+        Numpy array of extinction values.
+    """
+    key = hashlib.md5(np.asarray(wavelengths, dtype=float).tobytes()).hexdigest()
+
+    if key not in extinction_curves:
+        unit_spectrum = Spectrum(wavelengths=wavelengths,
+                                 values=np.ones_like(wavelengths),
+                                 value_errors=np.zeros_like(wavelengths),
+                                 metadata={})
+        reference_e_bv = 1
+        reddened_unit_spectrum = SpectrumReddener(input_spectrum=unit_spectrum).redden(e_bv=reference_e_bv)
+        extinction_curves[key] = -2.5 * np.log10(reddened_unit_spectrum.values) / reference_e_bv
+
+    return extinction_curves[key]
+
+
 # Start making a log file
 with open(args.log_to, "w") as result_log:
     for input_spectrum_id in input_spectra_ids:
@@ -134,32 +165,43 @@ with open(args.log_to, "w") as result_log:
         # Turn the SpectrumArray we got back into a single Spectrum
         input_spectrum_continuum_normalised = input_spectrum_continuum_normalised_arr.extract_item(0)
 
-        # Process spectra through reddening model
-        reddener = SpectrumReddener(input_spectrum=input_spectrum)
-
-        # Loop over each of the values of E(B-V) we are applying to each input spectrum
-        for e_bv in ebv_list:
+        # Redden the spectrum by every value of E(B-V) at once, with one row of output per value
+        transmission = 10 ** (-0.4 * np.outer(ebv_list, extinction_curve(wavelengths=input_spectrum.wavelengths)))
+        reddened_values = input_spectrum.values[np.newaxis, :] * transmission
+        reddened_value_errors = input_spectrum.value_errors[np.newaxis, :] * transmission
+
+        # Calculate how many magnitudes of extinction we have applied to each photometric band of interest. The flux
+        # in every band, of the unreddened spectrum and every reddened spectrum, is a single matrix product.
+        responses = band_responses(wavelengths=input_spectrum.wavelengths, bands=photometric_bands)
+        unreddened_band_fluxes = band_fluxes(values=input_spectrum.values, responses=responses)
+        extinctions = -2.5 * np.log10(band_fluxes(values=reddened_values, responses=responses) /
+                                      unreddened_band_fluxes[np.newaxis, :])
+
+        # Add metadata to each spectrum recording how much reddening we have applied, and its new UID
+        metadata_list = []
+        for e_bv_index, e_bv in enumerate(ebv_list):
             # Create a unique ID for this reddened spectrum (shared between the flux- and continuum-normalised output)
             unique_id = hashlib.md5(os.urandom(32)).hexdigest()[:16]
 
-            # Redden the spectrum
-            reddened_spectrum = reddener.redden(e_bv=e_bv)
-
-            # Add metadata to each spectrum recording how much reddening we have applied, and its new UID
             metadata = {"e_bv": e_bv, "uid": unique_id}
-
-            # Calculate how many magnitudes of extinction we have applied to each photometric band of interest
-            for band in photometric_bands:
-                # Add this data to the metadata for each reddened spectrum
-                metadata["A_{}".format(band)] = (reddened_spectrum.photometry(band=band) -
-                                                 input_spectrum.photometry(band=band))
-
-            # Save the flux-normalised reddened spectrum
-            output_library.insert(spectra=reddened_spectrum,
-                                  filenames=input_spectrum_id['filename'],
-                                  metadata_list=metadata)
-
-            # Save the continuum-normalised reddened spectrum, which is identical to the input
-            output_library.insert(spectra=input_spectrum_continuum_normalised,
-                                  filenames=continuum_normalised_spectrum_id[0]['filename'],
-                                  metadata_list=metadata)
+            for band_index, band in enumerate(photometric_bands):
+                metadata["A_{}".format(band)] = float(extinctions[e_bv_index, band_index])
+            metadata_list.append(metadata)
+
+        # Save the flux-normalised reddened spectra
+        output_library.insert(spectra=SpectrumArray(wavelengths=input_spectrum.wavelengths,
+                                                    values=reddened_values,
+                                                    value_errors=reddened_value_errors,
+                                                    metadata_list=[dict(input_spectrum.metadata, **metadata)
+                                                                   for metadata in metadata_list]),
+                              filenames=[input_spectrum_id['filename']] * len(ebv_list))
+
+        # Save the continuum-normalised reddened spectra, which are identical to the input
+        continuum_normalised = input_spectrum_continuum_normalised
+        output_library.insert(spectra=SpectrumArray(wavelengths=continuum_normalised.wavelengths,
+                                                    values=np.tile(continuum_normalised.values, (len(ebv_list), 1)),
+                                                    value_errors=np.tile(continuum_normalised.value_errors,
+                                                                         (len(ebv_list), 1)),
+                                                    metadata_list=[dict(continuum_normalised.metadata, **metadata)
+                                                                   for metadata in metadata_list]),
+                              filenames=[continuum_normalised_spectrum_id[0]['filename']] * len(ebv_list))
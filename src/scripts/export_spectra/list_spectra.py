@@ -15,6 +15,7 @@ from os import path as os_path
 
 import numpy as np
 from fourgp_speclib import SpectrumLibrarySqlite
+from lib.photometry import PhotometryEngine
 
 # Read input parameters
 parser = argparse.ArgumentParser(description=__doc__)
@@ -44,14 +45,15 @@ input_library, library_items = [input_library_info[i] for i in ("library", "item
 library_ids = [i["specId"] for i in library_items]
 library_spectra = input_library.open(ids=library_ids)
 
+# Do some basic photometry on all the spectra at once, so we can report how bright they are
+photometry = PhotometryEngine(bands=["SDSS_r", "SDSS_g", "SDSS_u"])
+library_magnitudes = photometry.magnitudes(spectra=library_spectra)
+
 # Write out information about each spectrum, one by one
 for i in range(len(library_spectra)):
     # Retrieve the dictionary of metadata associated with this spectrum
     metadata = library_spectra.get_metadata(i)
 
-    # Retrieve the spectrum itself
-    spectrum = library_spectra.extract_item(i)
-
     # Retrieve information about this spectrum, with default values for any metadata which is missing
     name = metadata.get("Starname", "untitled")
 
@@ -65,10 +67,8 @@ for i in range(len(library_spectra)):
     snr_defn = metadata.get("snr_definition", "--")
     snr_per_unit = "pix" if (metadata.get("SNR_per", None) != "A") else "A"
 
-    # Do some basic photometry on the spectrum so we can report how bright it is
-    r = spectrum.photometry("SDSS_r")
-    g = spectrum.photometry("SDSS_g")
-    u = spectrum.photometry("SDSS_u")
+    # Look up the photometry of this spectrum
+    r, g, u = library_magnitudes[i]
 
     # Can do some extra filtering at this stage if we want to reduce the amount of output...
     # if ((("lrs" in args.library) and ((int(mag_4fs) in [13, 16]) or (int(snr) in [100, 150]))) or
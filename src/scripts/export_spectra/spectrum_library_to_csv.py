@@ -11,7 +11,10 @@ Take spectrum library, and output all of the metadata contained within into a CS
 """
 
 import argparse
-import re
+import csv
+import gzip
+import io
+import sys
 from os import path as os_path
 
 from fourgp_speclib import SpectrumLibrarySqlite
@@ -25,7 +28,12 @@ parser.add_argument('--library', dest='library', default="turbospec_ahm2017_samp
                          "or [0<[Fe/H]<0.2] to specify a range. We do not currently support other operators like "
                          "[Teff>5000], but such ranges are easy to recast is a range, e.g. [5000<Teff<9999].")
 parser.add_argument('--separator', dest='separator', default=",",
-                    help="Separator to use between fields in the CSV output.")
+                    help="Separator to use between fields in the CSV output. Use \\t for tab-separated output.")
+parser.add_argument('--output', dest='output', default="-",
+                    help="The filename to write the CSV output to, or - to write it to stdout. If the filename ends "
+                         "in .gz, the output is gzip-compressed.")
+parser.add_argument('--page-size', dest='page_size', type=int, default=10000,
+                    help="The number of spectra to fetch metadata for in each database query.")
 parser.add_argument('--workspace', dest='workspace', default="",
                     help="Directory where we expect to find spectrum libraries.")
 args = parser.parse_args()
@@ -49,30 +57,44 @@ library_ids = [i["specId"] for i in library_items]
 fields = [i.strip() for i in input_library.list_metadata_fields()]
 fields.sort()
 
+# Open output file, with a large buffer, so that we are limited by the speed of the disk rather than by many small
+# writes
+separator = "\t" if args.separator == "\\t" else args.separator
+if args.output == "-":
+    output = sys.stdout
+elif args.output.endswith(".gz"):
+    output = io.TextIOWrapper(io.BufferedWriter(gzip.open(args.output, "wb"), buffer_size=1 << 20), newline="")
+else:
+    output = open(args.output, "w", buffering=1 << 20, newline="")
+
+# Write strings in quotes, escaping any quotes inside them with backslashes, and numbers without quotes
+writer = csv.writer(output, delimiter=separator, quoting=csv.QUOTE_NONNUMERIC, doublequote=False, escapechar="\\",
+                    lineterminator="\n")
+
 # At the top of the CSV file, write column headings with the field names
-line = args.separator.join(fields)
-print(line)
-
-# Write out information about spectra one by one
-for i in range(len(library_ids)):
-    # Fetch a dictionary of metadata about this spectrum
-    metadata = input_library.get_metadata(ids=library_ids[i])[0]
-
-    # To avoid duplication, only list flux-normalised spectra
-    if 'continuum_normalisation' in metadata and (metadata['continuum_normalisation'] != 0):
-        continue
-
-    # Extract each field from the metadata in turn. Write a "-" when a field is not set on a particular spectrum.
-    words = []
-    for x in fields:
-        word = metadata.get(x, "-")
-        # For string metadata, make sure that quotes are escaped correctly in the CSV output
-        if type(word) not in [int, float]:
-            word = "\"{}\"".format(re.sub("\"", "\\\"", str(word).strip()))
-        else:
-            word = str(word)
-        words.append(word)
-
-    # Print out a line of CSV output
-    line = args.separator.join(words)
-    print(line)
+output.write(separator.join(fields) + "\n")
+
+# Fetch metadata about the spectra in large pages, rather than querying the database once for each spectrum
+for page_start in range(0, len(library_ids), args.page_size):
+    page_metadata = input_library.get_metadata(ids=library_ids[page_start:page_start + args.page_size])
+
+    rows = []
+    for metadata in page_metadata:
+        # To avoid duplication, only list flux-normalised spectra
+        if 'continuum_normalisation' in metadata and (metadata['continuum_normalisation'] != 0):
+            continue
+
+        # Extract each field from the metadata in turn. Write a "-" when a field is not set on a particular spectrum.
+        words = []
+        for x in fields:
+            word = metadata.get(x, "-")
+            if type(word) not in [int, float]:
+                word = str(word).strip()
+            words.append(word)
+        rows.append(words)
+
+    # Write out a page of CSV output
+    writer.writerows(rows)
+
+if output is not sys.stdout:
+    output.close()
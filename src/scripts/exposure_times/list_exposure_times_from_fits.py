@@ -18,13 +18,47 @@ import os
 from os import path as os_path
 
 import numpy as np
-from astropy.io import fits
-from fourgp_fourfs import FourFS
 from fourgp_speclib import SpectrumLibrarySqlite, Spectrum
+from lib.exposure_time_engine import ExposureTimeEngine
+from lib.exposure_time_model import interpolated_exposure_times
+from lib.fits_ingest import open_fits
 
 our_path = os_path.split(os_path.abspath(__file__))[0]
 root_path = os_path.join(our_path, "../../../..")
 
+
+def load_fits_template(template):
+    """
+    Read a template spectrum from a FITS file.
+
+    :param template:
+        Dictionary describing the template, including its name and filename.
+    :return:
+        A tuple of (flux-normalised Spectrum, None), since we have no continuum-normalised version of the template.
+    """
+    # Open fits spectrum
+    with open_fits(template["filename"]) as f:
+        data = f[1].data
+        wavelengths = np.array(data['LAMBDA'])
+        fluxes = np.array(data['FLUX'])
+
+    # Open ASCII spectrum
+    # f = np.loadtxt(template).T
+    # wavelengths = f[0]
+    # fluxes = f[1]
+
+    # Create 4GP spectrum object
+    spectrum = Spectrum(wavelengths=wavelengths,
+                        values=fluxes,
+                        value_errors=np.zeros_like(wavelengths),
+                        metadata={
+                            "Starname": template["name"],
+                            "imported_from": template["filename"]
+                        })
+
+    return spectrum, None
+
+
 # Read input parameters
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('--input',
@@ -99,6 +133,22 @@ parser.add_argument('--mag-list',
                     help="Specify a comma-separated list of the magnitudes to assume when simulating observations "
                          "of each object. If multiple magnitudes are specified, than each input spectrum we be "
                          "output multiple times, once at each magnitude.")
+parser.add_argument('--processes', default=1, dest='processes', type=int,
+                    help="Run 4FS on templates in parallel across a pool of this many worker processes, each running "
+                         "its own instance of 4FS.")
+parser.add_argument('--anchor-mag-list',
+                    required=False,
+                    default="",
+                    dest="anchor_mag_list",
+                    help="Specify a comma-separated list of anchor magnitudes. If set, 4FS is only run at these "
+                         "magnitudes, and the exposure times at the magnitudes in --mag-list are interpolated "
+                         "between them, in log space. The magnitudes in --mag-list must lie within this range.")
+parser.add_argument('--validation-mag-list',
+                    required=False,
+                    default="",
+                    dest="validation_mag_list",
+                    help="Specify a comma-separated list of magnitudes at which to also run 4FS, to report the error "
+                         "in the exposure times interpolated between the magnitudes in --anchor-mag-list.")
 args = parser.parse_args()
 
 # Start logger
@@ -116,8 +166,14 @@ library_path = os_path.join(workspace, args.library)
 library = SpectrumLibrarySqlite(path=library_path, create=True)
 
 # Fetch a list of all the input template spectra which match the supplied filename wildcard
-templates = glob.glob(args.input)
-templates.sort()
+templates = []
+for template_index, template in enumerate(sorted(glob.glob(args.input))):
+    # Templates are cached by filename and modification time, so that edited templates are run through 4FS afresh
+    templates.append({
+        "key": "{}:{:d}".format(os_path.abspath(template), int(os.stat(template).st_mtime)),
+        "name": "template_{:08d}".format(template_index),
+        "filename": template
+    })
 
 # Parse any definitions of SNR we were supplied on the command line
 if (args.snr_definitions is None) or (len(args.snr_definitions) < 1):
@@ -158,73 +214,64 @@ snr_list = [float(item.strip()) for item in args.snr_list.split(",")]
 # Parse the list of magnitudes that the user specified on the command line
 mag_list = [float(item.strip()) for item in args.mag_list.split(",")]
 
+# Parse the lists of magnitudes at which we run 4FS, if we are to interpolate exposure times between them
+anchor_mag_list = [float(item.strip()) for item in args.anchor_mag_list.split(",")] if args.anchor_mag_list else None
+validation_mag_list = ([float(item.strip()) for item in args.validation_mag_list.split(",")]
+                       if args.validation_mag_list else None)
+
+# Run 4FS on any templates whose exposure times are not already cached, either at every magnitude, or only at
+# the anchor magnitudes we interpolate between
+engine = ExposureTimeEngine(
+    workspace=workspace,
+    binary_path=args.binary_path,
+    snr_list=snr_list,
+    photometric_band=args.photometric_band,
+    snr_definitions=snr_definitions,
+    snr_definitions_lrs=snr_definitions_lrs,
+    snr_definitions_hrs=snr_definitions_hrs,
+    run_lrs=args.run_lrs,
+    run_hrs=args.run_hrs,
+    processes=args.processes,
+    logger=logger
+)
+if anchor_mag_list is None:
+    intrinsic_magnitudes, exposure_times = engine.exposure_times(templates=templates, magnitudes=mag_list,
+                                                                 load_template=load_fits_template)
+else:
+    intrinsic_magnitudes, exposure_times = interpolated_exposure_times(engine=engine,
+                                                                       templates=templates,
+                                                                       magnitudes=mag_list,
+                                                                       anchor_magnitudes=anchor_mag_list,
+                                                                       validation_magnitudes=validation_mag_list,
+                                                                       load_template=load_fits_template,
+                                                                       logger=logger)
+engine.close()
+
 # Loop over all the magnitudes we are to simulate for each object
 for magnitude in mag_list:
-
-    # Instantiate 4FS wrapper
-    # NB: Here we are requiring SNR/pixel=100 in GalDiskHR_545NM
-    etc_wrapper = FourFS(
-        path_to_4fs=os_path.join(args.binary_path, "OpSys/ETC"),
-        snr_definitions=snr_definitions,
-        magnitude=magnitude,
-        magnitude_unreddened=False,
-        photometric_band=args.photometric_band,
-        run_lrs=args.run_lrs,
-        run_hrs=args.run_hrs,
-        lrs_use_snr_definitions=snr_definitions_lrs,
-        hrs_use_snr_definitions=snr_definitions_hrs,
-        snr_list=snr_list,
-        snr_per_pixel=False
-    )
-
-    for template_index, template in enumerate(templates):
-        name = "template_{:08d}".format(template_index)
-
-        # Open fits spectrum
-        f = fits.open(template)
-        data = f[1].data
-        wavelengths = data['LAMBDA']
-        fluxes = data['FLUX']
-
-        # Open ASCII spectrum
-        # f = np.loadtxt(template).T
-        # wavelengths = f[0]
-        # fluxes = f[1]
-
-        # Create 4GP spectrum object
-        spectrum = Spectrum(wavelengths=wavelengths,
-                            values=fluxes,
-                            value_errors=np.zeros_like(wavelengths),
-                            metadata={
-                                "Starname": name,
-                                "imported_from": template
-                            })
-
-        # Work out magnitude
-        mag_intrinsic = spectrum.photometry(args.photometric_band)
-
-        # Pass template to 4FS
-        degraded_spectra = etc_wrapper.process_spectra(
-            spectra_list=((spectrum, None),)
-        )
+    # Loop over templates
+    for template in templates:
+        template_exposure_times = exposure_times[template["key"]][magnitude]
+        if template_exposure_times is None:
+            logger.warning("4FS did not return exposure times for <{}>".format(template["filename"]))
+            continue
 
         # Loop over LRS and HRS
-        for mode in degraded_spectra:
-            # Loop over the spectra we simulated (there was only one!)
-            for index in degraded_spectra[mode]:
-                # Loop over the various SNRs we simulated
-                for snr in degraded_spectra[mode][index]:
-                    # Extract the exposure time returned by 4FS from the metadata associated with this Spectrum object
-                    # The exposure time is recorded in seconds
-                    exposure_time = degraded_spectra[mode][index][snr]["spectrum"].metadata["exposure"]
-
-                    # Print output
-                    print("{name:100s} {mode:6s} {snr:6.1f} {magnitude:6.3f} {exposure:6.3f}". \
-                          format(name=name,
-                                 mode=mode,
-                                 snr=snr,
-                                 magnitude=mag_intrinsic,
-                                 exposure=exposure_time))
-
-        # Insert spectrum object into spectrum library
-        library.insert(spectra=spectrum, filenames=os_path.split(template)[1])
+        for mode in template_exposure_times:
+            # Loop over the various SNRs we simulated
+            for snr in sorted(template_exposure_times[mode].keys()):
+                # The exposure time returned by 4FS
+                exposure_time = template_exposure_times[mode][snr]
+
+                # Print output
+                print("{name:100s} {mode:6s} {snr:6.1f} {magnitude:6.3f} {exposure:6.3f}". \
+                      format(name=template["name"],
+                             mode=mode,
+                             snr=snr,
+                             magnitude=intrinsic_magnitudes[template["key"]],
+                             exposure=exposure_time))
+
+# Insert template spectra into spectrum library
+for template in templates:
+    spectrum, _ = load_fits_template(template)
+    library.insert(spectra=spectrum, filenames=os_path.split(template["filename"])[1])
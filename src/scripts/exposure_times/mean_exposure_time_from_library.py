@@ -13,11 +13,12 @@ were at some particular reference magnitude.
 
 import argparse
 import logging
+import os
 from os import path as os_path
 
 import numpy as np
-from fourgp_fourfs import FourFS
-from fourgp_speclib import SpectrumLibrarySqlite
+from lib.exposure_time_engine import ExposureTimeEngine, library_templates
+from lib.exposure_time_model import interpolated_exposure_times
 
 our_path = os_path.split(os_path.abspath(__file__))[0]
 root_path = os_path.join(our_path, "../../../..")
@@ -96,6 +97,22 @@ parser.add_argument('--mag-list',
                     help="Specify a comma-separated list of the magnitudes to assume when simulating observations "
                          "of each object. If multiple magnitudes are specified, than each input spectrum we be "
                          "output multiple times, once at each magnitude.")
+parser.add_argument('--processes', default=1, dest='processes', type=int,
+                    help="Run 4FS on templates in parallel across a pool of this many worker processes, each running "
+                         "its own instance of 4FS.")
+parser.add_argument('--anchor-mag-list',
+                    required=False,
+                    default="",
+                    dest="anchor_mag_list",
+                    help="Specify a comma-separated list of anchor magnitudes. If set, 4FS is only run at these "
+                         "magnitudes, and the exposure times at the magnitudes in --mag-list are interpolated "
+                         "between them, in log space. The magnitudes in --mag-list must lie within this range.")
+parser.add_argument('--validation-mag-list',
+                    required=False,
+                    default="",
+                    dest="validation_mag_list",
+                    help="Specify a comma-separated list of magnitudes at which to also run 4FS, to report the error "
+                         "in the exposure times interpolated between the magnitudes in --anchor-mag-list.")
 args = parser.parse_args()
 
 # Start logger
@@ -147,105 +164,68 @@ snr_list = [float(item.strip()) for item in args.snr_list.split(",")]
 # Parse the list of magnitudes that the user specified on the command line
 mag_list = [float(item.strip()) for item in args.mag_list.split(",")]
 
+# Parse the lists of magnitudes at which we run 4FS, if we are to interpolate exposure times between them
+anchor_mag_list = [float(item.strip()) for item in args.anchor_mag_list.split(",")] if args.anchor_mag_list else None
+validation_mag_list = ([float(item.strip()) for item in args.validation_mag_list.split(",")]
+                       if args.validation_mag_list else None)
+
+# Open the input SpectrumLibrary once, and pair up the flux-normalised and continuum-normalised spectra of each object
+templates = library_templates(library_spec=args.library, workspace=workspace)
+
+# Run 4FS on any templates whose exposure times are not already cached, either at every magnitude, or only at
+# the anchor magnitudes we interpolate between
+engine = ExposureTimeEngine(
+    workspace=workspace,
+    binary_path=args.binary_path,
+    snr_list=snr_list,
+    photometric_band=args.photometric_band,
+    snr_definitions=snr_definitions,
+    snr_definitions_lrs=snr_definitions_lrs,
+    snr_definitions_hrs=snr_definitions_hrs,
+    run_lrs=args.run_lrs,
+    run_hrs=args.run_hrs,
+    processes=args.processes,
+    logger=logger
+)
+if anchor_mag_list is None:
+    intrinsic_magnitudes, exposure_times = engine.exposure_times(templates=templates, magnitudes=mag_list)
+else:
+    intrinsic_magnitudes, exposure_times = interpolated_exposure_times(engine=engine,
+                                                                       templates=templates,
+                                                                       magnitudes=mag_list,
+                                                                       anchor_magnitudes=anchor_mag_list,
+                                                                       validation_magnitudes=validation_mag_list,
+                                                                       logger=logger)
+engine.close()
+
 # Initialise output data structure
 output = {}  # output[magnitude]["HRS"][snr] = list of exposure times in seconds
 
 # Loop over all the magnitudes we are to simulate for each object
 for magnitude in mag_list:
+    output[magnitude] = {}
 
-    # Instantiate 4FS wrapper
-    etc_wrapper = FourFS(
-        path_to_4fs=os_path.join(args.binary_path, "OpSys/ETC"),
-        snr_definitions=snr_definitions,
-        magnitude=magnitude,
-        magnitude_unreddened=False,
-        photometric_band=args.photometric_band,
-        run_lrs=args.run_lrs,
-        run_hrs=args.run_hrs,
-        lrs_use_snr_definitions=snr_definitions_lrs,
-        hrs_use_snr_definitions=snr_definitions_hrs,
-        snr_list=snr_list,
-        snr_per_pixel=False
-    )
-
-    # Open input SpectrumLibrary, and search for flux normalised spectra meeting our filtering constraints
-    spectra = SpectrumLibrarySqlite.open_and_search(library_spec=args.library,
-                                                    workspace=workspace,
-                                                    extra_constraints={"continuum_normalised": 0}
-                                                    )
-
-    # Get a list of the spectrum IDs which we were returned
-    input_library, input_spectra_ids, input_spectra_constraints = [spectra[i]
-                                                                   for i in ("library", "items", "constraints")]
-
-    # Loop over spectra to process
-    for input_spectrum_id in input_spectra_ids:
-        logger.info("Working on <{}>".format(input_spectrum_id['filename']))
-
-        # Open Spectrum data from disk
-        input_spectrum_array = input_library.open(ids=input_spectrum_id['specId'])
-
-        # Turn SpectrumArray object into a Spectrum object
-        input_spectrum = input_spectrum_array.extract_item(0)
-
-        # Look up the unique ID of the star we've just loaded
-        # Newer spectrum libraries have a uid field which is guaranteed unique; for older spectrum libraries use
-        # Starname instead.
-
-        # Work out which field we're using (uid or Starname)
-        spectrum_matching_field = 'uid' if 'uid' in input_spectrum.metadata else 'Starname'
-
-        # Look up the unique ID of this object
-        object_name = input_spectrum.metadata[spectrum_matching_field]
-
-        # Search for the continuum-normalised version of this same object (which will share the same uid / name)
-        search_criteria = input_spectra_constraints.copy()
-        search_criteria[spectrum_matching_field] = object_name
-        search_criteria['continuum_normalised'] = 1
-        continuum_normalised_spectrum_id = input_library.search(**search_criteria)
-
-        # Check that continuum-normalised spectrum exists and is unique
-        assert len(continuum_normalised_spectrum_id) == 1, "Could not find continuum-normalised spectrum."
-
-        # Load the continuum-normalised version
-        input_spectrum_continuum_normalised_arr = input_library.open(
-            ids=continuum_normalised_spectrum_id[0]['specId']
-        )
-
-        # Turn the SpectrumArray we got back into a single Spectrum
-        input_spectrum_continuum_normalised = input_spectrum_continuum_normalised_arr.extract_item(0)
-
-        # Pass this spectrum to 4FS
-        degraded_spectra = etc_wrapper.process_spectra(
-            spectra_list=((input_spectrum, input_spectrum_continuum_normalised),)
-        )
+    # Loop over templates
+    for template in templates:
+        template_exposure_times = exposure_times[template["key"]][magnitude]
+        if template_exposure_times is None:
+            logger.warning("4FS did not return exposure times for <{}>".format(template["name"]))
+            continue
 
         # Loop over LRS and HRS
-        for mode in degraded_spectra:
-            # Loop over the spectra we simulated (there was only one!)
-            for index in degraded_spectra[mode]:
-                # Loop over the various SNRs we simulated
-                for snr in degraded_spectra[mode][index]:
-                    # Extract the exposure time returned by 4FS from the metadata associated with this Spectrum object
-                    # The exposure time is recorded in seconds
-                    exposure_time = degraded_spectra[mode][index][snr]["spectrum"].metadata["exposure"]
-
-                    # Record this exposure time into a list of the times recorded for this [mag][mode][snr] combination
-                    if magnitude not in output:
-                        output[magnitude] = {}
-                    if mode not in output:
-                        output[magnitude][mode] = {}
-                    if snr not in output[mode]:
-                        output[magnitude][mode][snr] = []
-                    output[magnitude][mode][snr].append(exposure_time)
+        for mode in template_exposure_times:
+            # Loop over the various SNRs we simulated
+            for snr in template_exposure_times[mode]:
+                # Record this exposure time into a list of the times recorded for this [mag][mode][snr] combination
+                output[magnitude].setdefault(mode, {}).setdefault(snr, []).append(template_exposure_times[mode][snr])
 
 # Print output
 for magnitude in sorted(output.keys()):
     for mode in sorted(output[magnitude].keys()):
         for snr in sorted(output[magnitude][mode].keys()):
             # Calculate the mean exposure time, and the standard deviation of the distribution
-            exposure_time_mean = np.mean(output[mode][snr])
-            exposure_time_sd = np.std(output[mode][snr])
+            exposure_time_mean = np.mean(output[magnitude][mode][snr])
+            exposure_time_sd = np.std(output[magnitude][mode][snr])
 
             # Print a row of output
             print("{mode:6s} {magnitude:6.1f} {snr:6.1f} {mean:6.3f} {std_dev:6.3f}".format(mode=mode,
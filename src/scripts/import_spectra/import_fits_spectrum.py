@@ -17,9 +17,10 @@ import re
 from os import path as os_path
 
 import numpy as np
-from astropy.io import fits
 from fourgp_speclib import SpectrumLibrarySqlite, Spectrum
 
+from lib.fits_ingest import open_fits
+
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
                     datefmt='%d/%m/%Y %H:%M:%S')
 logger = logging.getLogger(__name__)
@@ -54,12 +55,12 @@ library_name = re.sub("/", "_", args.library)
 library_path = os_path.join(workspace, library_name)
 library = SpectrumLibrarySqlite(path=library_path, create=args.create)
 
-# Open fits spectrum
-f = fits.open(args.filename)
-data = f[1].data
+# Open fits spectrum. Its data is memory mapped, so we only read the columns we need.
+with open_fits(args.filename) as f:
+    data = f[1].data
 
-wavelengths = data['LAMBDA']
-fluxes = data['FLUX']
+    wavelengths = np.array(data['LAMBDA'], dtype=float)
+    fluxes = np.array(data['FLUX'], dtype=float)
 
 # Create 4GP spectrum object
 spectrum = Spectrum(wavelengths=wavelengths,
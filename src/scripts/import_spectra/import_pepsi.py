@@ -18,13 +18,15 @@ import hashlib
 import logging
 import os
 import re
+from multiprocessing.util import Finalize
 from os import path as os_path
 
 import numpy as np
-from astropy.io import fits
 from fourgp_degrade import SpectrumResampler
 from fourgp_fourfs import FourFS
-from fourgp_speclib import SpectrumLibrarySqlite, Spectrum
+from fourgp_speclib import SpectrumLibrarySqlite, Spectrum, SpectrumArray
+
+from lib.fits_ingest import ingest_files, open_fits
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
                     datefmt='%d/%m/%Y %H:%M:%S')
@@ -63,6 +65,9 @@ parser.add_argument('--no-create',
                     dest="create",
                     help="Do not create a clean spectrum library to feed output spectra into.")
 parser.set_defaults(create=True)
+parser.add_argument('--processes', default=1, dest='processes', type=int,
+                    help="Import FITS files in parallel across a pool of this many worker processes, each running its "
+                         "own copy of 4FS. The spectra are written into the spectrum libraries by a single process.")
 args = parser.parse_args()
 
 # Open ASCII table which lists the measured abundances of the PEPSI stars
@@ -124,36 +129,64 @@ for mode, output_library in (("original", args.library),
     library_path = os_path.join(workspace, library_name)
     output_libraries[mode] = SpectrumLibrarySqlite(path=library_path, create=args.create)
 
-# Instantiate 4FS wrapper
-etc_wrapper = FourFS(
-    path_to_4fs=os_path.join(args.binary_path, "OpSys/ETC"),
-    magnitude=13,
-    snr_list=[250]
-)
+# Each worker process has its own 4FS wrapper, so that the workers don't overwrite each other's temporary files
+etc_wrapper = None
+
+
+def init_worker():
+    """
+    Set up a worker process to import FITS files, by instantiating a 4FS wrapper for its own use.
+    """
+    global etc_wrapper
+
+    identifier = "pepsi_{:d}".format(os.getpid())
+    etc_wrapper = FourFS(
+        path_to_4fs=os_path.join(args.binary_path, "OpSys/ETC"),
+        magnitude=13,
+        snr_list=[250],
+        identifier=identifier
+    )
 
-# Open fits spectrum
-for item in glob.glob(os_path.join(args.fits_path, "*.all6")):
+    # Clean up 4FS when the process exits
+    Finalize(None, etc_wrapper.close, exitpriority=10)
+
+
+def import_fits_file(item):
+    """
+    Read a PEPSI spectrum from a FITS file, resample it onto a raster with fixed stride, and pass it through 4FS.
+
+    :param item:
+        The filename of the FITS file.
+    :return:
+        Dictionary of the spectra to be inserted into each of the output spectrum libraries.
+    """
     filename = os_path.split(item)[1]
 
-    # Open FITS file
-    f = fits.open(item)
+    # Open FITS file. Its data is memory mapped, so we only read the columns we need.
+    with open_fits(item) as f:
+        # Extract headers and import them as metadata in SpectrumLibrary
+        headers = f[0].header
+
+        # Extract name of object
+        star_name = str(headers['OBJECT'].strip())
 
-    # Extract headers and import them as metadata in SpectrumLibrary
-    headers = f[0].header
+        header_dictionary = {'Starname': star_name,
+                             'original_filename': filename
+                             }
 
-    # Extract name of object
-    star_name = str(headers['OBJECT'].strip())
+        # Truncate each FITS header to only the first line. Also, omit various fields, otherwise we get hundreds of
+        # fields we don't need.
+        for key in headers:
+            if ((not key.startswith("BCOL")) and (not key.startswith("GAIN")) and
+                    (not key.startswith("IMASEC")) and (not key.startswith("RON"))):
+                header_dictionary[key] = str(headers[key]).strip().split("\n")[0]
 
-    header_dictionary = {'Starname': star_name,
-                         'original_filename': filename
-                         }
+        # 1. Extract continuum-normalised spectrum from FITS file
+        data = f[1].data
 
-    # Truncate each FITS header to only the first line. Also, omit various fields, otherwise we get hundreds of fields
-    # we don't need.
-    for key in headers:
-        if ((not key.startswith("BCOL")) and (not key.startswith("GAIN")) and
-                (not key.startswith("IMASEC")) and (not key.startswith("RON"))):
-            header_dictionary[key] = str(headers[key]).strip().split("\n")[0]
+        wavelengths = np.array(data['Arg'], dtype=float)
+        flux = np.array(data['Fun'], dtype=float)
+        flux_errors = np.array(data['Var'], dtype=float)
 
     # Extract radial velocity of object -- units m/s, with receding velocity being positive
     radial_velocity = float(header_dictionary['RADVEL'])
@@ -167,13 +200,6 @@ for item in glob.glob(os_path.join(args.fits_path, "*.all6")):
     else:
         header_dictionary.update(abundance_data[star_name])
 
-    # 1. Extract continuum-normalised spectrum from FITS file
-    data = f[1].data
-
-    wavelengths = data['Arg']
-    flux = data['Fun']
-    flux_errors = data['Var']
-
     # Create a unique ID for this PEPSI spectrum
     unique_id = hashlib.md5(os.urandom(32)).hexdigest()[:16]
     header_dictionary["uid"] = unique_id
@@ -181,17 +207,7 @@ for item in glob.glob(os_path.join(args.fits_path, "*.all6")):
     pepsi_spectrum = Spectrum(wavelengths=wavelengths,
                               values=flux,
                               value_errors=flux_errors,
-                              metadata=header_dictionary)
-
-    output_libraries['original'].insert(spectra=pepsi_spectrum,
-                                        filenames=star_name,
-                                        metadata_list={'continuum_normalised': 1}
-                                        )
-
-    output_libraries['original'].insert(spectra=pepsi_spectrum,
-                                        filenames=star_name,
-                                        metadata_list={'continuum_normalised': 0}
-                                        )
+                              metadata=header_dictionary.copy())
 
     # 2. Correct radial velocity
     # pepsi_spectrum_rest_frame = pepsi_spectrum.correct_radial_velocity(radial_velocity)
@@ -207,19 +223,9 @@ for item in glob.glob(os_path.join(args.fits_path, "*.all6")):
     lambda_steps = (lambda_max - lambda_min) / lambda_delta
     pepsi_spectrum_resampled = resampler.onto_raster(output_raster=np.linspace(start=lambda_min,
                                                                                stop=lambda_max,
-                                                                               num=lambda_steps
+                                                                               num=int(lambda_steps)
                                                                                ))
 
-    output_libraries['resampled'].insert(spectra=pepsi_spectrum_resampled,
-                                        filenames=star_name,
-                                        metadata_list={'continuum_normalised': 1}
-                                        )
-
-    output_libraries['resampled'].insert(spectra=pepsi_spectrum_resampled,
-                                        filenames=star_name,
-                                        metadata_list={'continuum_normalised': 0}
-                                        )
-
     # Process spectra through 4FS
     degraded_spectra = etc_wrapper.process_spectra(
         spectra_list=((pepsi_spectrum_resampled.copy(),
@@ -227,9 +233,8 @@ for item in glob.glob(os_path.join(args.fits_path, "*.all6")):
         resolution=(lambda_max + lambda_min) / 2 / lambda_delta
     )
 
-    # Import degraded spectra into output spectrum library
-
     # Loop over LRS and HRS
+    degraded_output = []
     for mode in degraded_spectra:
         # Loop over the spectra we simulated (there was only one!)
         for index in degraded_spectra[mode]:
@@ -240,10 +245,78 @@ for item in glob.glob(os_path.join(args.fits_path, "*.all6")):
                 header_dictionary["uid"] = unique_id
                 # Import the flux- and continuum-normalised spectra separately, but give them the same ID
                 for spectrum_type in degraded_spectra[mode][index][snr]:
-                    output_libraries[mode].insert(spectra=degraded_spectra[mode][index][snr][spectrum_type],
-                                                  filenames=star_name,
-                                                  metadata_list=header_dictionary
-                                                  )
-
-# Clean up 4FS
-etc_wrapper.close()
+                    degraded_output.append((mode,
+                                            degraded_spectra[mode][index][snr][spectrum_type],
+                                            header_dictionary.copy()))
+
+    return {
+        "star_name": star_name,
+        "original": pepsi_spectrum,
+        "resampled": pepsi_spectrum_resampled,
+        "degraded": degraded_output
+    }
+
+
+def insert_spectra(library, spectra, metadata_list, filename):
+    """
+    Insert a list of spectra made from a single FITS file into an output library. If they all share the same
+    wavelength raster, they are inserted as a single SpectrumArray, in one operation.
+
+    :param library:
+        The spectrum library to insert the spectra into.
+    :param spectra:
+        List of Spectrum objects.
+    :param metadata_list:
+        List of dictionaries of metadata to add to each spectrum.
+    :param filename:
+        The filename to record for all of the spectra.
+    """
+    metadata_list = [dict(spectrum.metadata, **metadata) for spectrum, metadata in zip(spectra, metadata_list)]
+
+    if all(np.array_equal(spectrum.wavelengths, spectra[0].wavelengths) for spectrum in spectra):
+        library.insert(spectra=SpectrumArray(wavelengths=spectra[0].wavelengths,
+                                             values=np.array([spectrum.values for spectrum in spectra]),
+                                             value_errors=np.array([spectrum.value_errors for spectrum in spectra]),
+                                             metadata_list=metadata_list),
+                       filenames=[filename] * len(spectra))
+    else:
+        for spectrum, metadata in zip(spectra, metadata_list):
+            library.insert(spectra=spectrum, filenames=filename, metadata_list=metadata)
+
+
+def write_spectra(imported):
+    """
+    Insert the spectra we made from a single FITS file into the output spectrum libraries, with one insertion into
+    each library.
+
+    :param imported:
+        Dictionary of the spectra to be inserted into each of the output spectrum libraries, as returned by
+        <import_fits_file>.
+    """
+    star_name = imported["star_name"]
+
+    for mode in ("original", "resampled"):
+        insert_spectra(library=output_libraries[mode],
+                       spectra=[imported[mode], imported[mode]],
+                       metadata_list=[{'continuum_normalised': 1}, {'continuum_normalised': 0}],
+                       filename=star_name)
+
+    # Import degraded spectra into output spectrum library, with all the spectra for each mode inserted together
+    for mode in ("LRS", "HRS"):
+        degraded = [(spectrum, metadata) for spectrum_mode, spectrum, metadata in imported["degraded"]
+                    if spectrum_mode == mode]
+        if degraded:
+            insert_spectra(library=output_libraries[mode],
+                           spectra=[spectrum for spectrum, metadata in degraded],
+                           metadata_list=[metadata for spectrum, metadata in degraded],
+                           filename=star_name)
+
+
+# Import each FITS file in turn, either in this process, or across a pool of worker processes
+ingest_files(filenames=sorted(glob.glob(os_path.join(args.fits_path, "*.all6"))),
+             process_file=import_fits_file,
+             write_output=write_spectra,
+             processes=args.processes,
+             initializer=init_worker)
+
+# Each copy of 4FS is cleaned up by the finalizer registered in <init_worker>, when its process exits
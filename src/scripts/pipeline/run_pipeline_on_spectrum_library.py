@@ -18,6 +18,8 @@ from fourgp_pipeline import PipelineFGK
 from fourgp_pipeline import PipelineManager
 from fourgp_speclib import SpectrumLibrarySqlite
 
+from lib.cannon_model_bundle import model_reload_prefix
+
 
 # Implement a pipeline manager which loads spectra for analysis from disk
 class PipelineManagerReadFromSpectrumLibrary(PipelineManager):
@@ -167,7 +169,8 @@ if __name__ == "__main__":
                         help="Directory where we expect to find spectrum libraries.")
     parser.add_argument('--reload-cannon', required=True, dest='reload_cannon',
                         help="Skip training step, and reload a Cannon that we've previously trained. Specify the full "
-                             "path to the .cannon file containing the trained Cannon, but without the .cannon suffix.")
+                             "path to the .cannon file containing the trained Cannon, but without the .cannon suffix. "
+                             "If a memory-mappable bundle was saved alongside it, that is loaded instead.")
     parser.add_argument('--output-file', default="./test_cannon.out", dest='output_file',
                         help="Data file to write output to.")
     parser.add_argument('--mode', required=True, dest='fourmost_mode',
@@ -178,6 +181,6 @@ if __name__ == "__main__":
     main(logger=logger,
          input_library=args.input_library,
          workspace=args.workspace,
-         reload_cannon=args.reload_cannon,
+         reload_cannon=model_reload_prefix(model_prefix=args.reload_cannon),
          fourmost_mode=args.fourmost_mode
          )
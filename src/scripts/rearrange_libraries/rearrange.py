@@ -16,13 +16,17 @@ We can also contaminate the input spectra with some fraction of light from a con
 
 import argparse
 import logging
+import multiprocessing as mp
 import os
 import random
+import re
 import time
+from collections import deque
 from os import path as os_path
 
 import fourgp_degrade
-from fourgp_speclib import SpectrumLibrarySqlite
+import numpy as np
+from fourgp_speclib import SpectrumLibrarySqlite, SpectrumArray
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
                     datefmt='%d/%m/%Y %H:%M:%S')
@@ -87,11 +91,25 @@ parser.add_argument('--log-file',
                     default="/tmp/rearrange_{}.log".format(pid),
                     dest="log_to",
                     help="Specify a log file where we log our progress.")
+parser.add_argument('--processes', default=1, dest='processes', type=int,
+                    help="Read and contaminate input spectra in parallel across a pool of this many worker processes. "
+                         "This process alone writes to the output libraries.")
+parser.add_argument('--block-size', dest='block_size', type=int, default=100,
+                    help="The number of input spectra each worker process reads at a time. The spectra from each "
+                         "block are inserted into the output libraries together.")
+parser.add_argument('--seed', default=None, dest='seed', type=int,
+                    help="Random seed, used to split spectra between output libraries and to pick contaminating "
+                         "spectra. If not specified, a seed is picked at random.")
 args = parser.parse_args()
 
 logger.info("Running rearrange on spectra from <{}>, going into <{}>, contaminating with <{}>".
             format(args.input_library, args.output_library, args.contamination_library))
 
+# Pick a random seed, if none was specified, and record it in the log so that this run can be reproduced
+if args.seed is None:
+    args.seed = random.SystemRandom().randint(0, 2 ** 31 - 1)
+logger.info("Random seed is {:d}".format(args.seed))
+
 # Set path to workspace where we create libraries of spectra
 workspace = args.workspace if args.workspace else os_path.join(our_path, "../../../workspace")
 os.system("mkdir -p {}".format(workspace))
@@ -194,103 +212,225 @@ if len(output_fractions) == 0:
     output_fractions = [1]
 assert len(output_fractions) == len(output_libraries), "Must have an output fraction specified for each output library."
 
-# Keep a record of which stars are being sent to which output
+# Decide up front which output library each star is sent to, so that the worker processes never need to coordinate.
+# Be sure to send all spectra relating to any particular star to the same destination.
+random.seed(args.seed)
 output_destinations = {}
+for input_library in input_libraries:
+    library_obj = input_library["library"]
+    for metadata in library_obj.get_metadata(ids=[item['specId'] for item in input_library["items"]]):
+        object_name = metadata['Starname']
+        if object_name not in output_destinations:
+            output_destinations[object_name] = make_weighted_choice(output_fractions)
+
+# Each worker process opens its own connection to each input library, indexed by path
+input_library_paths = [os_path.join(workspace, re.match("([^\[]*)", item).group(1))
+                       for item in (args.input_library if args.input_library is not None else [])]
+worker_libraries = {}
+
+
+def init_worker():
+    """
+    Set up a worker process to read input spectra, by opening its own connection to each input library.
+    """
+    worker_libraries.clear()
+    for library_path in input_library_paths:
+        worker_libraries[library_path] = SpectrumLibrarySqlite(path=library_path, create=False)
+
+
+def process_block(job):
+    """
+    Read a block of spectra from an input library, and contaminate them if requested.
+
+    :param job:
+        A tuple of (index of contamination fraction, index of input library, index of first spectrum in block,
+        list of the spectra in the block, as returned by the library search).
+    :return:
+        List of tuples of (output library index, flux-normalised Spectrum, its filename, continuum-normalised
+        Spectrum, its filename).
+    """
+    contamination_index, library_index, block_start, block_items = job
+    contamination_fraction = contamination_fractions[contamination_index]
+    library_obj = worker_libraries[input_library_paths[library_index]]
+
+    output = []
+    for item_index, input_spectrum_id in enumerate(block_items):
+        # Open input spectrum data from disk
+        input_spectrum_array = library_obj.open(ids=input_spectrum_id['specId'])
+        input_spectrum = input_spectrum_array.extract_item(0)
 
-# Process each spectrum in turn
-with open(args.log_to, "w") as result_log:
-    # Loop over all the contamination fractions we're applying
-    for contamination_fraction in contamination_fractions:
-        # Loop over spectra to process
-        for input_library in input_libraries:
-            library_obj = input_library["library"]
-            for input_spectrum_id in input_library["items"]:
-                logger.info("Working on <{}>".format(input_spectrum_id['filename']))
-
-                # Open input spectrum data from disk
-                input_spectrum_array = library_obj.open(ids=input_spectrum_id['specId'])
-                input_spectrum = input_spectrum_array.extract_item(0)
-
-                # Look up the name of the star we've just loaded
-                spectrum_matching_field = 'uid' if 'uid' in input_spectrum.metadata else 'Starname'
-                object_uid = input_spectrum.metadata[spectrum_matching_field]
-                object_name = input_spectrum.metadata['Starname']
+        # Look up the name of the star we've just loaded
+        spectrum_matching_field = 'uid' if 'uid' in input_spectrum.metadata else 'Starname'
+        object_uid = input_spectrum.metadata[spectrum_matching_field]
+        object_name = input_spectrum.metadata['Starname']
 
+        # Search for the continuum-normalised version of this same object
+        search_constraints = {
+            spectrum_matching_field: object_uid,
+            "continuum_normalised": 1
+        }
+        if "SNR" in input_spectrum.metadata:
+            search_constraints["SNR"] = input_spectrum.metadata["SNR"]
+        continuum_normalised_spectrum_id = library_obj.search(**search_constraints)
+
+        # Check that continuum-normalised spectrum exists
+        assert len(continuum_normalised_spectrum_id) == 1, "Could not find continuum-normalised spectrum."
+
+        # Load the continuum-normalised version
+        input_spectrum_continuum_normalised_arr = library_obj.open(
+            ids=continuum_normalised_spectrum_id[0]['specId'])
+        input_spectrum_continuum_normalised = input_spectrum_continuum_normalised_arr.extract_item(0)
+
+        # Contaminate this spectrum if requested
+        if contamination_fraction > 0:
+            # Pick a random spectrum to contaminate with. Each spectrum derives its own random seed from its position
+            # in the input, so the choice doesn't depend on which worker process handles it.
+            random.seed("{:d}/{:d}/{:d}/{:d}".format(args.seed, contamination_index, library_index,
+                                                     block_start + item_index))
+            contamination_spectrum, contamination_spectrum_continuum_normalised = \
+                random.choice(contamination_spectra)
+
+            # Work out the integrated flux in the input and contaminating spectra
+            input_integral = input_spectrum.integral()
+            contamination_integral = contamination_spectrum.integral()
+
+            # Interpolate the contamination spectrum onto the observed spectrum's wavelength
+            resampler = fourgp_degrade.SpectrumResampler(contamination_spectrum)
+            contamination_resampled = resampler.match_to_other_spectrum(other=input_spectrum,
+                                                                        resample_errors=False,
+                                                                        resample_mask=False)
+
+            resampler = fourgp_degrade.SpectrumResampler(contamination_spectrum_continuum_normalised)
+            contamination_cn_resampled = resampler.match_to_other_spectrum(other=input_spectrum,
+                                                                           resample_errors=False,
+                                                                           resample_mask=False)
+
+            # Renormalise contaminating spectrum to same integrated flux as input spectrum
+            contamination_resampled.values *= input_integral / contamination_integral
+
+            # Flux components from input spectrum, and from contamination source
+            flux_from_input = input_spectrum.values * (1 - contamination_fraction)
+            flux_from_contamination = contamination_resampled.values * contamination_fraction
+
+            # Fraction of flux in each pixel coming from input spectrum versus contaminating spectrum
+            pixel_weights = flux_from_input / (flux_from_input + flux_from_contamination)
+
+            # Pollute flux normalised spectrum
+            input_spectrum.values = flux_from_input + flux_from_contamination
+
+            # Pollute continuum normalised spectrum
+            input_spectrum_continuum_normalised.values = \
+                (input_spectrum_continuum_normalised.values * pixel_weights +
+                 contamination_cn_resampled.values * (1 - pixel_weights))
+
+            # Add metadata describing pollution fraction
+            input_spectrum_continuum_normalised.metadata["contamination_fraction"] = \
+                input_spectrum.metadata["contamination_fraction"] = contamination_fraction
+
+        output.append((output_destinations[object_name],
+                       input_spectrum, input_spectrum_id['filename'],
+                       input_spectrum_continuum_normalised, continuum_normalised_spectrum_id[0]['filename']))
+
+    return output
+
+
+def insert_spectra(library, spectra, filenames):
+    """
+    Insert a list of spectra into an output library. If they all share the same wavelength raster, they are inserted
+    as a single SpectrumArray, in one operation.
+
+    :param library:
+        The spectrum library to insert the spectra into.
+    :param spectra:
+        List of Spectrum objects.
+    :param filenames:
+        List of the filenames of the spectra.
+    """
+    if all(np.array_equal(spectrum.wavelengths, spectra[0].wavelengths) for spectrum in spectra):
+        library.insert(spectra=SpectrumArray(wavelengths=spectra[0].wavelengths,
+                                             values=np.array([spectrum.values for spectrum in spectra]),
+                                             value_errors=np.array([spectrum.value_errors for spectrum in spectra]),
+                                             metadata_list=[spectrum.metadata for spectrum in spectra]),
+                       filenames=filenames)
+    else:
+        for spectrum, filename in zip(spectra, filenames):
+            library.insert(spectra=spectrum, filenames=filename)
+
+
+# Make a list of the blocks of spectra to process. We loop over all the contamination fractions we're applying, and
+# then over the input libraries.
+jobs = []
+for contamination_index in range(len(contamination_fractions)):
+    for library_index, input_library in enumerate(input_libraries):
+        items = input_library["items"]
+        for block_start in range(0, len(items), args.block_size):
+            jobs.append((contamination_index, library_index, block_start,
+                         items[block_start:block_start + args.block_size]))
+
+def process_blocks_in_pool(pool, jobs, window):
+    """
+    Process blocks of spectra across a pool of worker processes, yielding the results in order. At most <window>
+    blocks are submitted to the pool at any time, so that results never pile up in memory faster than this process
+    can write them out.
+
+    :param pool:
+        The pool of worker processes.
+    :param jobs:
+        List of the blocks of spectra to process, as passed to <process_block>.
+    :param window:
+        The maximum number of blocks which may be in flight at once.
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(process_block, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+# Process each block of spectra in turn, either in this process, or across a pool of worker processes. Results are
+# returned in order, and this process alone writes them into the output libraries.
+if args.processes == 1:
+    init_worker()
+    results = map(process_block, jobs)
+    pool = None
+else:
+    pool = mp.get_context("fork").Pool(processes=args.processes, initializer=init_worker)
+    results = process_blocks_in_pool(pool=pool, jobs=jobs, window=2 * args.processes)
+
+try:
+    with open(args.log_to, "w") as result_log:
+        for job, result in zip(jobs, results):
+            logger.info("Working on spectra {:d}-{:d} of <{}>".format(job[2] + 1, job[2] + len(job[3]),
+                                                                      args.input_library[job[1]]))
+
+            # Group the spectra by output library, keeping flux- and continuum-normalised versions of each star together
+            output_spectra = [[] for i in output_libraries]
+            output_filenames = [[] for i in output_libraries]
+            for (output_index, spectrum, filename,
+                 spectrum_continuum_normalised, filename_continuum_normalised) in result:
                 # Write log message
-                result_log.write("\n[{}] {}".format(time.asctime(), object_uid))
-                result_log.flush()
-
-                # Search for the continuum-normalised version of this same object
-                search_constraints = {
-                    spectrum_matching_field: object_uid,
-                    "continuum_normalised": 1
-                }
-                if "SNR" in input_spectrum.metadata:
-                    search_constraints["SNR"] = input_spectrum.metadata["SNR"]
-                continuum_normalised_spectrum_id = library_obj.search(**search_constraints)
-
-                # Check that continuum-normalised spectrum exists
-                assert len(continuum_normalised_spectrum_id) == 1, "Could not find continuum-normalised spectrum."
-
-                # Load the continuum-normalised version
-                input_spectrum_continuum_normalised_arr = library_obj.open(
-                    ids=continuum_normalised_spectrum_id[0]['specId'])
-                input_spectrum_continuum_normalised = input_spectrum_continuum_normalised_arr.extract_item(0)
-
-                # Contaminate this spectrum if requested
-                if contamination_fraction > 0:
-                    # Pick a random spectrum to contaminate with
-                    contamination_spectrum, contamination_spectrum_continuum_normalised = \
-                        random.choice(contamination_spectra)
-
-                    # Work out the integrated flux in the input and contaminating spectra
-                    input_integral = input_spectrum.integral()
-                    contamination_integral = contamination_spectrum.integral()
-
-                    # Interpolate the contamination spectrum onto the observed spectrum's wavelength
-                    resampler = fourgp_degrade.SpectrumResampler(contamination_spectrum)
-                    contamination_resampled = resampler.match_to_other_spectrum(other=input_spectrum,
-                                                                                resample_errors=False,
-                                                                                resample_mask=False)
-
-                    resampler = fourgp_degrade.SpectrumResampler(contamination_spectrum_continuum_normalised)
-                    contamination_cn_resampled = resampler.match_to_other_spectrum(other=input_spectrum,
-                                                                                   resample_errors=False,
-                                                                                   resample_mask=False)
-
-                    # Renormalise contaminating spectrum to same integrated flux as input spectrum
-                    contamination_resampled.values *= input_integral / contamination_integral
-
-                    # Flux components from input spectrum, and from contamination source
-                    flux_from_input = input_spectrum.values * (1 - contamination_fraction)
-                    flux_from_contamination = contamination_resampled.values * contamination_fraction
-
-                    # Fraction of flux in each pixel coming from input spectrum versus contaminating spectrum
-                    pixel_weights = flux_from_input / (flux_from_input + flux_from_contamination)
-
-                    # Pollute flux normalised spectrum
-                    input_spectrum.values = flux_from_input + flux_from_contamination
-
-                    # Pollute continuum normalised spectrum
-                    input_spectrum_continuum_normalised.values = \
-                        (input_spectrum_continuum_normalised.values * pixel_weights +
-                         contamination_cn_resampled.values * (1 - pixel_weights))
-
-                    # Add metadata describing pollution fraction
-                    input_spectrum_continuum_normalised.metadata["contamination_fraction"] = \
-                        input_spectrum.metadata["contamination_fraction"] = contamination_fraction
-
-                # Select which output library to send this spectrum to
-                # Be sure to send all spectra relating to any particular star to the same destination
-                if object_name in output_destinations:
-                    output_index = output_destinations[object_name]
-                else:
-                    output_index = make_weighted_choice(output_fractions)
-                    output_destinations[object_name] = output_index
-
-                # Import spectra into output spectrum library
-                output_libraries[output_index].insert(spectra=input_spectrum,
-                                                      filenames=input_spectrum_id['filename'])
-
-                output_libraries[output_index].insert(spectra=input_spectrum_continuum_normalised,
-                                                      filenames=continuum_normalised_spectrum_id[0]['filename'])
+                result_log.write("\n[{}] {}".format(time.asctime(), spectrum.metadata['Starname']))
+
+                output_spectra[output_index].extend([spectrum, spectrum_continuum_normalised])
+                output_filenames[output_index].extend([filename, filename_continuum_normalised])
+            result_log.flush()
+
+            # Import spectra into output spectrum libraries
+            for output_index, output_library in enumerate(output_libraries):
+                if output_spectra[output_index]:
+                    insert_spectra(library=output_library,
+                                   spectra=output_spectra[output_index],
+                                   filenames=output_filenames[output_index])
+
+    if pool is not None:
+        pool.close()
+except BaseException:
+    # Don't leave workers running if we fail to process or write out any block
+    if pool is not None:
+        pool.terminate()
+    raise
+finally:
+    if pool is not None:
+        pool.join()
@@ -14,23 +14,34 @@ We work out the RV from all the arms simultaneously, and combine the information
 """
 
 import argparse
+import hashlib
 import logging
+import multiprocessing as mp
 import os
 import random
+import shutil
 import sys
+import tempfile
 import time
 from collections import namedtuple
+from multiprocessing.util import Finalize
 from os import path as os_path
 
 import numpy as np
+from fourgp_degrade import SpectrumResampler
 from fourgp_fourfs import FourFS
 from fourgp_rv import random_radial_velocity, RvInstanceCrossCorrelation
 from fourgp_rv.templates_resample import resample_templates
 from fourgp_speclib import SpectrumLibrarySqlite
 
+from lib.rv_template_bank import RvTemplateBank
+
 # Create unique ID for this process
 run_id = os.getpid()
 
+# The SNR/pixel at which we simulate observations of test spectra when using them as their own templates
+template_snr = 250.
+
 
 # Helper function to measure CPU time
 def get_cpu_time(pid):
@@ -91,13 +102,35 @@ parser.add_argument('--correlate-with-test-spectrum',
                     action='store_true',
                     dest="correlate_with_test_spectrum",
                     help="Specify that we cross-correlate with the test spectrum itself, at zero RV, as a sanity "
-                         "check.")
+                         "check. With --template-bank, each test spectrum is resampled into a template once, and "
+                         "held in memory, rather than building a new template library for every test.")
 parser.add_argument('--correlate-with-templates',
                     action='store_false',
                     dest="correlate_with_test_spectrum",
                     help="Specify that we cross-correlate with a library of template spectra (default).")
 parser.set_defaults(correlate_with_test_spectrum=False)
 
+parser.add_argument('--template-bank',
+                    action='store_true',
+                    dest="template_bank",
+                    help="Cross-correlate against a bank of template FFTs, which is saved alongside the template "
+                         "library and memory-mapped on subsequent runs. On the first test, a warning is logged if the "
+                         "bank does not give the same RVs as the cross-correlation code in <fourgp_rv>.")
+parser.add_argument('--no-template-bank',
+                    action='store_false',
+                    dest="template_bank",
+                    help="Use the cross-correlation code in <fourgp_rv> directly (default).")
+parser.set_defaults(template_bank=False)
+parser.add_argument('--coarse-binning', default=0, dest='coarse_binning',
+                    type=int,
+                    help="If greater than one, do a coarse-to-fine template search. Templates are first scored using "
+                         "spectra binned by this number of pixels, and only the best matches are cross-correlated "
+                         "at full resolution. Only used with --template-bank.")
+parser.add_argument('--coarse-candidates', default=10, dest='coarse_candidates',
+                    type=int,
+                    help="The number of templates per arm which go forward from the coarse search to full "
+                         "cross-correlation.")
+
 parser.add_argument('--zero-rv',
                     action='store_true',
                     dest="zero_rv",
@@ -107,6 +140,18 @@ parser.add_argument('--non-zero-rv',
                     dest="zero_rv",
                     help="Specify that we inject non-zero RVs into the test spectra (default).")
 parser.set_defaults(zero_rv=False)
+
+parser.add_argument('--processes', default=1, dest='processes',
+                    type=int,
+                    help="Run tests in parallel across a pool of this many worker processes.")
+parser.add_argument('--seed', default=None, dest='seed',
+                    type=int,
+                    help="Master random seed, from which the random seed of each test is derived. If not "
+                         "specified, a seed is picked at random and written to the output files.")
+parser.add_argument('--first-test', default=0, dest='first_test',
+                    type=int,
+                    help="The number of the first test to run. Runs with the same --seed and different values of "
+                         "--first-test can be used to split a long series of tests across several nodes.")
 args = parser.parse_args()
 
 # Set up logger
@@ -139,17 +184,25 @@ rv_calculator = RvInstanceCrossCorrelation(
     upsampling=args.upsampling
 )
 
-# Instantiate 4FS wrapper
-etc_wrapper = FourFS(
-    path_to_4fs=os_path.join(args.binary_path, "OpSys/ETC"),
-    magnitude=13,
-    snr_list=[float(args.snr)],
-    snr_per_pixel=True,
-    identifier="rv_test"
-)
+# Precompute FFTs of the template spectra, if requested
+if args.template_bank:
+    rv_calculator = RvTemplateBank(
+        rv_calculator=rv_calculator,
+        bank_path=os_path.join(workspace, args.templates_library, "fourier_template_bank"),
+        upsampling=args.upsampling,
+        coarse_binning=args.coarse_binning,
+        coarse_candidates=args.coarse_candidates,
+        logger=logger
+    )
+
+# Pick a master random seed, if none was specified, and record it in the output so that this run can be reproduced
+if args.seed is None:
+    args.seed = random.SystemRandom().randint(0, 2 ** 31 - 1)
+logger.info("Master random seed is {:d}".format(args.seed))
 
-# Pick some random spectra
-indices = [random.randint(0, len(test_library_items) - 1) for i in range(args.test_count)]
+# The numbers of the tests we are to run. Each test derives its own random seed from its number, so a long run can be
+# split across several nodes using --first-test, and the combined output is identical to a single run.
+test_numbers = list(range(args.first_test, args.first_test + args.test_count))
 
 # Start writing output
 output_files = {}
@@ -161,6 +214,7 @@ for mode in ("HRS", "LRS"):
     # Write column headers
     output_files[mode].write("# {}\n".format(" ".join(sys.argv[:])))
     output_files[mode].write("# SNR/pixel = {}\n".format(args.snr))
+    output_files[mode].write("# Master random seed = {:d}\n".format(args.seed))
 
     output_files[mode].write("# {}\n".format(format_str).format("Time",
                                                                 "Teff_in", "Teff_out",
@@ -171,8 +225,145 @@ for mode in ("HRS", "LRS"):
                              )
     output_files[mode].write("# {}\n".format(format_str).format(*range(11)))
 
-# Loop over the spectra we are going to test
-for counter, index in enumerate(indices):
+# Each worker process is given its own number, which it uses to name its 4FS instance and scratch directory
+mp_context = mp.get_context("fork")
+worker_counter = mp_context.Value('i', 0)
+worker = {}
+
+
+def init_worker(counter, reopen_library):
+    """
+    Set up a worker process to run RV tests. Each worker has its own 4FS instance and scratch directory, and its own
+    connection to the test spectrum library.
+
+    :param counter:
+        Shared counter, used to give each worker a unique number.
+    :param reopen_library:
+        Boolean flag indicating whether we should open a new connection to the test spectrum library, rather than
+        using the one inherited from the parent process.
+    """
+    global test_library
+
+    with counter.get_lock():
+        counter.value += 1
+        worker['id'] = counter.value
+
+    # Give each worker its own scratch directory, so that temporary files from parallel 4FS runs do not collide
+    worker['scratch'] = os_path.join(tempfile.gettempdir(), "rv_test_{}_{}".format(run_id, worker['id']))
+    os.system("mkdir -p {}".format(worker['scratch']))
+    os.environ['TMPDIR'] = worker['scratch']
+    tempfile.tempdir = worker['scratch']
+
+    # Open a separate connection to the test library, rather than sharing the parent's SQLite connection
+    if reopen_library:
+        test_library = SpectrumLibrarySqlite.open_and_search(
+            library_spec=args.test_library,
+            workspace=workspace,
+            extra_constraints={"continuum_normalised": 0}
+        )["library"]
+
+    # Instantiate 4FS wrapper
+    worker['etc_wrapper'] = FourFS(
+        path_to_4fs=os_path.join(args.binary_path, "OpSys/ETC"),
+        magnitude=13,
+        snr_list=[float(args.snr)],
+        snr_per_pixel=True,
+        identifier="rv_test_{}_{}".format(run_id, worker['id'])
+    )
+
+    # If we're cross-correlating test spectra with themselves, using in-memory templates, we need a second 4FS
+    # instance to resample them into templates, and a cache of the templates we have already made
+    if args.correlate_with_test_spectrum and args.template_bank:
+        worker['template_wrapper'] = FourFS(
+            path_to_4fs=os_path.join(args.binary_path, "OpSys/ETC"),
+            magnitude=13,
+            snr_list=[template_snr],
+            snr_per_pixel=True,
+            identifier="rv_templates_{}_{}".format(run_id, worker['id'])
+        )
+        worker['test_templates'] = {}
+
+    # Clean up 4FS and the scratch directory when the worker exits
+    Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    """
+    Clean up the 4FS instances, scratch directory and temporary template library belonging to a worker process.
+    """
+    for wrapper_name in ('etc_wrapper', 'template_wrapper'):
+        if wrapper_name in worker:
+            worker.pop(wrapper_name).close()
+
+    shutil.rmtree(worker['scratch'], ignore_errors=True)
+    shutil.rmtree(os_path.join(workspace, "tmp_{}_{}".format(run_id, worker['id'])), ignore_errors=True)
+
+
+def test_spectrum_template_bank(test_spectrum, test_spectrum_continuum_normalised):
+    """
+    Resample a test spectrum into a cross-correlation template, on the same logarithmic rasters as the templates in
+    the template library, and return an in-memory template bank containing it.
+
+    :param test_spectrum:
+        The test spectrum, at zero RV (flux normalised).
+    :param test_spectrum_continuum_normalised:
+        The test spectrum, at zero RV (continuum normalised).
+    :return:
+        RvTemplateBank
+    """
+    mock_observed_template = worker['template_wrapper'].process_spectra(
+        spectra_list=((test_spectrum, test_spectrum_continuum_normalised),)
+    )
+
+    templates_by_arm = {}
+
+    # Loop over LRS and HRS
+    for mode in mock_observed_template:
+        templates_by_arm[mode] = {}
+
+        # Loop over the spectra we simulated (there was only one!)
+        for fourfs_index in mock_observed_template[mode]:
+            observed = mock_observed_template[mode][fourfs_index][template_snr]['spectrum_continuum_normalised']
+            resampler = SpectrumResampler(input_spectrum=observed)
+
+            # Resample onto the raster of each arm
+            for arm_name in rv_calculator.templates_by_arm[mode]:
+                arm_raster = rv_calculator.templates_by_arm[mode][arm_name][0].wavelengths
+                template = resampler.onto_raster(output_raster=arm_raster)
+                template.values[~np.isfinite(template.values)] = 1.
+                template.metadata = dict(test_spectrum.metadata)
+                templates_by_arm[mode][arm_name] = [template]
+
+    return RvTemplateBank.from_spectra(
+        templates_by_arm=templates_by_arm,
+        arm_properties=rv_calculator.arm_properties,
+        upsampling=args.upsampling,
+        logger=logger
+    )
+
+
+def run_test(test_number):
+    """
+    Run a single RV test.
+
+    :param test_number:
+        The number of the test to run, from which we derive the random seed used to pick a test spectrum and a
+        radial velocity.
+    :return:
+        List of [test number, list of (mode, line of output) pairs]
+    """
+    pid = os.getpid()
+    output_lines = []
+
+    # Seed the random number generators for this test, so that its results do not depend on which process runs it.
+    # numpy's generator needs an integer seed, which we derive from the same string.
+    test_seed = "{:d}/{:d}".format(args.seed, test_number)
+    random.seed(test_seed)
+    np.random.seed(int(hashlib.md5(test_seed.encode('utf-8')).hexdigest()[:8], 16))
+
+    # Pick a random spectrum
+    index = random.randint(0, len(test_library_items) - 1)
+
     # Look up database ID of the test spectrum
     test_id = test_library_items[index]['specId']
 
@@ -188,12 +379,13 @@ for counter, index in enumerate(indices):
 
     # Look up the unique ID of this object
     object_name = test_spectrum.metadata[spectrum_matching_field]
-    logger.info("Working on test {:6d} (spectrum <{}>)".format(counter, object_name))
+    logger.info("Working on test {:6d} (spectrum <{}>)".format(test_number, object_name))
     # logger.info("Spectrum metadata: {}".format(str(test_spectrum.metadata)))
 
     # If we're cross-correlating with the test spectrum itself, create an RV code instance to do that now
-    if args.correlate_with_test_spectrum:
-        tmp_template_library = "tmp_{}".format(run_id)
+    test_rv_calculator = rv_calculator
+    if args.correlate_with_test_spectrum and not args.template_bank:
+        tmp_template_library = "tmp_{}_{}".format(run_id, worker['id'])
 
         os.system("rm -Rf {}".format(os_path.join(workspace, tmp_template_library)))
 
@@ -205,14 +397,14 @@ for counter, index in enumerate(indices):
                            )
 
         # Open template spectrum library
-        template_library = SpectrumLibrarySqlite(
+        tmp_library = SpectrumLibrarySqlite(
             path=os_path.join(workspace, tmp_template_library),
             create=False,
         )
 
         # Instantiate RV code
-        rv_calculator = RvInstanceCrossCorrelation(
-            spectrum_library=template_library,
+        test_rv_calculator = RvInstanceCrossCorrelation(
+            spectrum_library=tmp_library,
             upsampling=args.upsampling
         )
 
@@ -233,6 +425,16 @@ for counter, index in enumerate(indices):
     # Turn the SpectrumArray we got back into a single Spectrum
     test_spectrum_continuum_normalised = test_spectrum_continuum_normalised_arr.extract_item(0)
 
+    # If we're cross-correlating with the test spectrum itself using in-memory templates, resample this star into a
+    # template the first time we encounter it
+    if args.correlate_with_test_spectrum and args.template_bank:
+        if object_name not in worker['test_templates']:
+            worker['test_templates'][object_name] = test_spectrum_template_bank(
+                test_spectrum=test_spectrum,
+                test_spectrum_continuum_normalised=test_spectrum_continuum_normalised
+            )
+        test_rv_calculator = worker['test_templates'][object_name]
+
     # Pick a random radial velocity
     if not args.zero_rv:
         radial_velocity = random_radial_velocity()  # Unit km/s
@@ -252,7 +454,7 @@ for counter, index in enumerate(indices):
 
     # Now create a mock observation of this spectrum using 4FS
     logger.info("Passing spectrum through 4FS")
-    mock_observed_spectra = etc_wrapper.process_spectra(
+    mock_observed_spectra = worker['etc_wrapper'].process_spectra(
         spectra_list=((test_spectrum_with_rv, test_spectrum_continuum_normalised_with_rv),)
     )
 
@@ -273,26 +475,33 @@ for counter, index in enumerate(indices):
                 observed.value_errors[np.isnan(observed.values)] = 1000.
                 observed.values[np.isnan(observed.values)] = 1.
 
+            # On the first test, check that the template bank reproduces the RVs from <fourgp_rv>, warning if not
+            if args.template_bank and (test_rv_calculator is rv_calculator) and (test_number == args.first_test):
+                rv_calculator.check_agreement(input_spectrum=observed,
+                                              mode=mode,
+                                              interpolation_scheme=args.interpolation,
+                                              interpolation_pixels=args.interpolation_pixels)
+
             time_start = time.time()
-            time_start_cpu = get_cpu_time(run_id)
+            time_start_cpu = get_cpu_time(pid)
 
             rv_mean, rv_std_dev, stellar_parameters, rv_estimates = \
-                rv_calculator.estimate_rv(input_spectrum=observed,
-                                          mode=mode,
-                                          arm_names=rv_calculator.templates_by_arm[mode].keys(),
-                                          interpolation_scheme=args.interpolation,
-                                          interpolation_pixels=args.interpolation_pixels
-                                          )
+                test_rv_calculator.estimate_rv(input_spectrum=observed,
+                                               mode=mode,
+                                               arm_names=test_rv_calculator.templates_by_arm[mode].keys(),
+                                               interpolation_scheme=args.interpolation,
+                                               interpolation_pixels=args.interpolation_pixels
+                                               )
 
             # Calculate how much CPU time we used
             time_end = time.time()
-            time_end_cpu = get_cpu_time(run_id)
+            time_end_cpu = get_cpu_time(pid)
 
             # Debugging
             # output_files[arm_name].write("# {}\n".format(str(rv_estimates)))
 
-            # Write a line to the output data file
-            output_files[mode].write("  {}\n".format(format_str).format(
+            # Record a line of output, which is written to the output data file by the parent process
+            output_lines.append((mode, "  {}\n".format(format_str).format(
                 "{:.2f}/{:.2f}".format(time_end - time_start, time_end_cpu - time_start_cpu),
                 "{:.1f}".format(test_spectrum.metadata.get("Teff", np.nan)),
                 "{:.1f}".format(stellar_parameters[0]),
@@ -304,7 +513,41 @@ for counter, index in enumerate(indices):
                 "{:.4f}".format(rv_mean / 1000),
                 "{:.4f}".format(rv_std_dev / 1000),
                 "{}".format(object_name)
-            ))
+            )))
+
+    return test_number, output_lines
+
+
+# Run the tests, either in this process, or across a pool of worker processes
+if args.processes > 1:
+    pool = mp_context.Pool(processes=args.processes,
+                           initializer=init_worker,
+                           initargs=(worker_counter, True))
+    test_results = pool.imap(run_test, test_numbers)
+else:
+    init_worker(counter=worker_counter, reopen_library=False)
+    test_results = map(run_test, test_numbers)
+
+# Merge the output from all of the tests into the output data files, in order of test number, so that the output does
+# not depend on how the tests were distributed between processes
+try:
+    for test_number, output_lines in test_results:
+        for output_key, output_line in output_lines:
+            output_files[output_key].write(output_line)
 
             # Make sure that output data file is always kept up to date
-            output_files[mode].flush()
+            output_files[output_key].flush()
+
+    if args.processes > 1:
+        pool.close()
+except BaseException:
+    # Don't leave workers running if any test fails
+    if args.processes > 1:
+        pool.terminate()
+    raise
+finally:
+    if args.processes > 1:
+        pool.join()
+
+for output_file in output_files.values():
+    output_file.close()
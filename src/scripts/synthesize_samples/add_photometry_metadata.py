@@ -17,6 +17,7 @@ import time
 from os import path as os_path
 
 from fourgp_speclib import SpectrumLibrarySqlite
+from lib.photometry import PhotometryEngine
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
                     datefmt='%d/%m/%Y %H:%M:%S')
@@ -46,6 +47,8 @@ parser.add_argument('--log-file',
                     default="/tmp/photometry_apokasc_{}.log".format(pid),
                     dest="log_to",
                     help="Specify a log file where we log our progress.")
+parser.add_argument('--block-size', dest='block_size', type=int, default=1000,
+                    help="The number of spectra to load and compute photometry for at once.")
 args = parser.parse_args()
 
 logger.info("Adding photometry to spectra with arguments <{}> <{}>".format(args.input_library,
@@ -61,47 +64,56 @@ spectra = SpectrumLibrarySqlite.open_and_search(library_spec=args.input_library,
                                                 )
 input_library, input_spectra_ids, input_spectra_constraints = [spectra[i] for i in ("library", "items", "constraints")]
 
+# Search for the continuum-normalised versions of all the same objects (which will share the same uid / name)
+search_criteria = input_spectra_constraints.copy()
+search_criteria['continuum_normalised'] = 1
+continuum_normalised_spectra_ids = input_library.search(**search_criteria)
+continuum_normalised_metadata = input_library.get_metadata(ids=[item['specId']
+                                                                for item in continuum_normalised_spectra_ids])
+
+# Look up the name of each object
+input_metadata = input_library.get_metadata(ids=[item['specId'] for item in input_spectra_ids])
+spectrum_matching_field = 'uid' if (input_metadata and 'uid' in input_metadata[0]) else 'Starname'
+
+continuum_normalised_by_name = {}
+for item, metadata in zip(continuum_normalised_spectra_ids, continuum_normalised_metadata):
+    continuum_normalised_by_name.setdefault(metadata[spectrum_matching_field], []).append(item['specId'])
+
+# Compute the magnitudes of a block of spectra in all bands at once
+photometric_bands = [band.strip() for band in args.photometric_bands.split(",")]
+photometry = PhotometryEngine(bands=photometric_bands)
+
 # Loop over spectra to process
 with open(args.log_to, "w") as result_log:
-    for input_spectrum_id in input_spectra_ids:
-        logger.info("Working on <{}>".format(input_spectrum_id['filename']))
-
-        # Open Spectrum data from disk
-        input_spectrum_array = input_library.open(ids=input_spectrum_id['specId'])
-        input_spectrum = input_spectrum_array.extract_item(0)
-
-        # Look up the name of the star we've just loaded
-        spectrum_matching_field = 'uid' if 'uid' in input_spectrum.metadata else 'Starname'
-        object_name = input_spectrum.metadata[spectrum_matching_field]
-
-        # Write log message
-        result_log.write("\n[{}] {}... ".format(time.asctime(), object_name))
-        result_log.flush()
-
-        # Search for the continuum-normalised version of this same object
-        search_criteria = input_spectra_constraints.copy()
-        search_criteria[spectrum_matching_field] = object_name
-        search_criteria['continuum_normalised'] = 1
-        continuum_normalised_spectrum_id = input_library.search(**search_criteria)
-
-        # Check that continuum-normalised spectrum exists
-        assert len(continuum_normalised_spectrum_id) == 1, "Could not find continuum-normalised spectrum."
-
-        # Load the continuum-normalised version
-        input_spectrum_continuum_normalised_arr = input_library.open(ids=continuum_normalised_spectrum_id[0]['specId'])
-        input_spectrum_continuum_normalised = input_spectrum_continuum_normalised_arr.extract_item(0)
-
-        # Do photometry on the spectrum
-        new_metadata = {}
-        for band in args.photometric_bands.split(","):
-            band = band.strip()
-            magnitude = input_spectrum.photometry(band=band)
-            new_metadata["photometry_{:s}".format(band)] = magnitude
-
-        # Insert new metadata into spectrum library
-        input_library.set_metadata(metadata=new_metadata, ids=[
-            input_spectrum_id['specId'], continuum_normalised_spectrum_id[0]['specId']
-        ])
+    for block_start in range(0, len(input_spectra_ids), args.block_size):
+        block_ids = input_spectra_ids[block_start:block_start + args.block_size]
+        logger.info("Working on spectra {:d}-{:d} of {:d}".format(block_start + 1, block_start + len(block_ids),
+                                                                  len(input_spectra_ids)))
+
+        # Open Spectrum data from disk, and do photometry on all the spectra in this block
+        input_spectrum_array = input_library.open(ids=[item['specId'] for item in block_ids])
+        magnitudes = photometry.magnitudes(spectra=input_spectrum_array)
+
+        for index, input_spectrum_id in enumerate(block_ids):
+            object_name = input_metadata[block_start + index][spectrum_matching_field]
+
+            # Write log message
+            result_log.write("\n[{}] {}... ".format(time.asctime(), object_name))
+            result_log.flush()
+
+            # Check that continuum-normalised spectrum exists
+            continuum_normalised_spectrum_id = continuum_normalised_by_name.get(object_name, [])
+            assert len(continuum_normalised_spectrum_id) == 1, "Could not find continuum-normalised spectrum."
+
+            new_metadata = {}
+            for band_index, band in enumerate(photometric_bands):
+                new_metadata["photometry_{:s}".format(band)] = float(magnitudes[index, band_index])
+
+            # Insert new metadata into spectrum library. The flux- and continuum-normalised versions of each object
+            # share the same photometry, so they are updated together.
+            input_library.set_metadata(metadata=new_metadata, ids=[
+                input_spectrum_id['specId'], continuum_normalised_spectrum_id[0]
+            ])
 
 # Clean up spectrum library
 input_library.close()
@@ -14,8 +14,8 @@ TurboSpectrum.
 import logging
 
 import numpy as np
-from astropy.io import fits
 from lib.base_synthesizer import Synthesizer
+from lib.fits_ingest import fits_table_columns, open_fits
 
 # List of elements whose abundances we pass to TurboSpectrum
 element_list = (
@@ -35,7 +35,7 @@ synthesizer = Synthesizer(library_name="galah_sample_v2",
                           docstring=__doc__)
 
 # Table supplies list of abundances for GES stars
-f = fits.open("../../../../downloads/GALAH_trainingset_4MOST_errors.fits")
+f = open_fits("../../../../downloads/GALAH_trainingset_4MOST_errors.fits")
 galah_stars = f[1].data
 galah_fields = galah_stars.names
 # print galah_fields  # To print a list of available parameters
@@ -61,6 +61,9 @@ galah_fields = galah_stars.names
  'flag_Zn_abund_sme', 'Zr_abund_sme', 'e_Zr_abund_sme', 'flag_Zr_abund_sme']
 """
 
+# Convert the columns of the FITS table into Python values, a whole column at a time
+galah_columns = fits_table_columns(table=galah_stars)
+
 # Loop over stars extracting stellar parameters from FITS file
 star_list = []
 for star_index in range(len(galah_stars)):
@@ -94,14 +97,7 @@ for star_index in range(len(galah_stars)):
     # Propagate all input fields from the FITS file into <input_data>
     input_data = star_list_item["input_data"]
     for col_name in galah_fields:
-        value = galah_stars[col_name][star_index]
-
-        if galah_stars.dtype[col_name].type is np.string_:
-            typed_value = str(value)
-        else:
-            typed_value = float(value)
-
-        input_data[col_name] = typed_value
+        input_data[col_name] = galah_columns[col_name][star_index]
     star_list.append(star_list_item)
 
 # Pass list of stars to synthesizer
@@ -14,8 +14,8 @@ import json
 import logging
 
 import numpy as np
-from astropy.io import fits
 from lib.base_synthesizer import Synthesizer
+from lib.fits_ingest import fits_table_columns, open_fits
 
 # List of elements whose abundances we pass to TurboSpectrum
 # Elements with neutral abundances, e.g. LI1
@@ -38,7 +38,7 @@ synthesizer = Synthesizer(library_name="ges_dwarf_sample",
                           docstring=__doc__)
 
 # Table supplies list of abundances for GES stars
-f = fits.open("../../downloads/GES_iDR5_WG15_Recommended.fits")
+f = open_fits("../../downloads/GES_iDR5_WG15_Recommended.fits")
 ges = f[1].data
 ges_fields = ges.names
 
@@ -50,6 +50,9 @@ min_SNR = 50
 selection = np.where((ges.SNR > min_SNR) & (ges.REC_WG == 'WG11') & (ges.LOGG > 3.5))[0]
 stellar_data = ges[selection]
 
+# Convert the columns of the FITS table into Python values, a whole column at a time
+ges_columns = fits_table_columns(table=stellar_data, column_names=[i for i in ges_fields if i != "CNAME"])
+
 # Loop over stars extracting stellar parameters from FITS file
 star_list = []
 for star_index in range(len(stellar_data)):
@@ -96,14 +99,7 @@ for star_index in range(len(stellar_data)):
     for col_name in ges_fields:
         if col_name == "CNAME":
             continue
-        value = stellar_data[col_name][star_index]
-
-        if ges.dtype[col_name].type is np.string_:
-            typed_value = str(value)
-        else:
-            typed_value = float(value)
-
-        input_data[col_name] = typed_value
+        input_data[col_name] = ges_columns[col_name][star_index]
     star_list.append(star_list_item)
 
 # Pass list of stars to synthesizer
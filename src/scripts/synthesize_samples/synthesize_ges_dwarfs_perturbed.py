@@ -14,8 +14,8 @@ import logging
 import random
 
 import numpy as np
-from astropy.io import fits
 from lib.base_synthesizer import Synthesizer
+from lib.fits_ingest import open_fits
 
 # List of elements whose abundances we pass to TurboSpectrum
 # Elements with neutral abundances, e.g. LI1
@@ -38,7 +38,7 @@ synthesizer = Synthesizer(library_name="ges_dwarf_perturbed",
                           docstring=__doc__)
 
 # Table supplies list of abundances for GES stars
-f = fits.open("../../downloads/GES_iDR5_WG15_Recommended.fits")
+f = open_fits("../../downloads/GES_iDR5_WG15_Recommended.fits")
 ges = f[1].data
 ges_fields = ges.names
 
@@ -20,16 +20,25 @@ pass this code continuum normalised spectra if you want scientifically meaningfu
 
 import argparse
 import gzip
+import hashlib
 import json
 import logging
+import multiprocessing as mp
 import os
+import shutil
+import tempfile
 import time
 from os import path as os_path
 
 import numpy as np
 from fourgp_cannon import __version__ as fourgp_version
 from fourgp_degrade import SpectrumProperties
-from fourgp_speclib import SpectrumLibrarySqlite
+from fourgp_speclib import SpectrumLibrarySqlite, SpectrumArray
+
+from lib.cannon_model_bundle import model_reload_prefix, read_model_summary, remove_model_bundle, write_model_bundle
+from lib.cannon_model_registry import CannonModelRegistry
+from lib.censoring_line_list import CensoringLineList
+from lib.label_expression import evaluate_label_expressions
 
 
 def select_cannon(continuum_normalisation="none", cannon_version="casey_old"):
@@ -134,14 +143,70 @@ def resample_spectrum(spectrum, training_spectra):
     return spectrum_new
 
 
-def autocomplete_scaled_solar_abundances(training_library, training_library_ids_all, label_list):
+def label_completeness_mask(training_spectra, label_list):
+    """
+    Work out which spectra in a SpectrumArray have finite values for all of a list of labels.
+
+    :param training_spectra:
+        SpectrumArray containing the spectra we are to train the Cannon on.
+    :type training_spectra:
+        SpectrumArray
+    :param label_list:
+        The list of labels which must be set in order for a spectrum to be accepted.
+    :return:
+        A numpy array of Booleans, indicating which spectra have all the labels set.
+    """
+    mask = np.ones(len(training_spectra), dtype=bool)
+    for index in range(len(training_spectra)):
+        metadata = training_spectra.get_metadata(index)
+        for label in label_list:
+            if (label not in metadata) or (metadata[label] is None) or (not np.isfinite(metadata[label])):
+                mask[index] = False
+                break
+    return mask
+
+
+def select_training_spectra(training_spectra, selection):
+    """
+    Extract a subset of the spectra in a SpectrumArray which has already been loaded into memory, without reading
+    anything from disk. Each selected spectrum is given its own copy of its metadata, so that labels may be filled in
+    or computed for one batch of labels without affecting other batches.
+
+    :param training_spectra:
+        SpectrumArray containing all of the spectra in the training set.
+    :type training_spectra:
+        SpectrumArray
+    :param selection:
+        A numpy array of Booleans, indicating which spectra to select.
+    :return:
+        A SpectrumArray of the selected spectra. If all spectra are selected, this shares its flux arrays with the
+        input SpectrumArray. If the input flux arrays are memory mapped, so are those of the selection.
+    """
+    if np.all(selection):
+        values = training_spectra.values
+        value_errors = training_spectra.value_errors
+    elif isinstance(training_spectra.values, np.memmap):
+        values = memory_map_selection(array=training_spectra.values, selection=selection)
+        value_errors = memory_map_selection(array=training_spectra.value_errors, selection=selection)
+    else:
+        values = training_spectra.values[selection]
+        value_errors = training_spectra.value_errors[selection]
+
+    return SpectrumArray(wavelengths=training_spectra.wavelengths,
+                         values=values,
+                         value_errors=value_errors,
+                         metadata_list=[dict(training_spectra.get_metadata(index))
+                                        for index in np.flatnonzero(selection)])
+
+
+def autocomplete_scaled_solar_abundances(training_spectra, training_library_ids_all, label_list):
     """
     Where stars have elemental abundances missing, insert scaled-solar values.
 
-    :param training_library:
-        SpectrumLibrary containing the spectra we are to train the Cannon on.
-    :type training_library:
-        SpectrumLibrarySqlite
+    :param training_spectra:
+        SpectrumArray containing the spectra we are to train the Cannon on.
+    :type training_spectra:
+        SpectrumArray
     :param training_library_ids_all:
         List of the UIDs of the training spectra we are to use.
     :type training_library_ids_all:
@@ -154,27 +219,27 @@ def autocomplete_scaled_solar_abundances(training_library, training_library_ids_
         0. A list of the IDs of the selected spectra
         1. A SpectrumArray of the selected spectra
     """
-    input_spectra = training_library.open(ids=training_library_ids_all)
+    output_spectra = select_training_spectra(training_spectra=training_spectra,
+                                             selection=np.ones(len(training_spectra), dtype=bool))
 
-    for index in range(len(input_spectra)):
-        metadata = input_spectra.get_metadata(index)
+    for index in range(len(output_spectra)):
+        metadata = output_spectra.get_metadata(index)
         for label in label_list:
             if (label not in metadata) or (metadata[label] is None) or (not np.isfinite(metadata[label])):
                 # print "Label {} in spectrum {} assumed as scaled solar.".format(label, index)
                 metadata[label] = metadata["[Fe/H]"]
-    output_spectra = input_spectra
 
     return training_library_ids_all, output_spectra
 
 
-def filter_training_spectra(training_library, training_library_ids_all, label_list):
+def filter_training_spectra(training_spectra, training_library_ids_all, label_list):
     """
     Filter the spectra in a SpectrumArray on the basis that they must have a list of metadata values defined.
 
-    :param training_library:
-        SpectrumLibrary containing the spectra we are to train the Cannon on.
-    :type training_library:
-        SpectrumLibrarySqlite
+    :param training_spectra:
+        SpectrumArray containing the spectra we are to train the Cannon on.
+    :type training_spectra:
+        SpectrumArray
     :param training_library_ids_all:
         List of the UIDs of the training spectra we are to use.
     :type training_library_ids_all:
@@ -187,25 +252,80 @@ def filter_training_spectra(training_library, training_library_ids_all, label_li
         0. A list of the IDs of the selected spectra
         1. A SpectrumArray of the selected spectra
     """
-    input_spectra = training_library.get_metadata(ids=training_library_ids_all)
+    selection = label_completeness_mask(training_spectra=training_spectra, label_list=label_list)
 
-    ids_filtered = []
-    for index, metadata in enumerate(input_spectra):
-        accept = True
-        for label in label_list:
-            if (label not in metadata) or (metadata[label] is None) or (not np.isfinite(metadata[label])):
-                accept = False
-                break
-        if accept:
-            ids_filtered.append(training_library_ids_all[index])
+    output_spectrum_ids = [training_library_ids_all[index] for index in np.flatnonzero(selection)]
     logging.info("Accepted {:d} / {:d} training spectra; others had labels missing.".
-                 format(len(ids_filtered), len(training_library_ids_all)))
-    output_spectrum_ids = ids_filtered
-    output_spectra = training_library.open(ids=output_spectrum_ids)
+                 format(len(output_spectrum_ids), len(training_library_ids_all)))
+    output_spectra = select_training_spectra(training_spectra=training_spectra, selection=selection)
 
     return output_spectrum_ids, output_spectra
 
 
+def memory_map_spectra(spectra, directory):
+    """
+    Move the flux arrays of a SpectrumArray into memory-mapped files, so that worker processes can all read the same
+    copy of them. The files are mapped copy-on-write, so any process which modifies the arrays gets its own private
+    copy of the pages it changes, and never affects other processes.
+
+    :param spectra:
+        The SpectrumArray whose flux arrays we are to memory map.
+    :type spectra:
+        SpectrumArray
+    :param directory:
+        The directory in which to store the memory-mapped files.
+    :type directory:
+        str
+    :return:
+        A SpectrumArray whose flux arrays are memory mapped.
+    """
+    arrays = {}
+    for array_name in ("values", "value_errors"):
+        filename = os_path.join(directory, "{}.npy".format(array_name))
+        np.save(filename, getattr(spectra, array_name))
+        arrays[array_name] = np.load(filename, mmap_mode='c')
+
+    return SpectrumArray(wavelengths=spectra.wavelengths,
+                         values=arrays['values'],
+                         value_errors=arrays['value_errors'],
+                         metadata_list=[spectra.get_metadata(index) for index in range(len(spectra))])
+
+
+def memory_map_selection(array, selection, block_size=1024):
+    """
+    Select a subset of the rows of a memory-mapped array, returning them as another memory-mapped array. The rows are
+    copied into a new .npy file alongside the input array a block at a time, so the selection is never held in
+    memory. The file is named after the selection, so that worker processes which make the same selection share it.
+
+    :param array:
+        The memory-mapped array, as returned by <memory_map_spectra>.
+    :type array:
+        np.memmap
+    :param selection:
+        A numpy array of Booleans, indicating which rows to select.
+    :param block_size:
+        The number of rows to copy at a time.
+    :return:
+        A memory-mapped array of the selected rows.
+    """
+    indices = np.flatnonzero(selection)
+    filename = "{}_{}.npy".format(os_path.splitext(array.filename)[0],
+                                  hashlib.md5(np.packbits(selection).tobytes()).hexdigest())
+
+    if not os_path.exists(filename):
+        filename_tmp = "{}.{:d}.tmp".format(filename, os.getpid())
+        output = np.lib.format.open_memmap(filename_tmp, mode='w+', dtype=array.dtype,
+                                           shape=(len(indices),) + array.shape[1:])
+        for block_start in range(0, len(indices), block_size):
+            block = indices[block_start:block_start + block_size]
+            output[block_start:block_start + len(block)] = array[block]
+        output.flush()
+        del output
+        os.rename(filename_tmp, filename)
+
+    return np.load(filename, mmap_mode='c')
+
+
 def evaluate_computed_labels(label_expressions, spectra):
     """
     Evaluated computed labels for a spectrum. These are labels that are computed from multiple metadata items, such as
@@ -219,10 +339,13 @@ def evaluate_computed_labels(label_expressions, spectra):
     :return:
         None
     """
-    for index in range(len(spectra)):
-        metadata = spectra.get_metadata(index)
-        for label_expression in label_expressions:
-            value = eval(label_expression, metadata)
+    metadata_list = [spectra.get_metadata(index) for index in range(len(spectra))]
+
+    # Compile each expression once, and evaluate it over arrays of the metadata of all the spectra at once
+    values = evaluate_label_expressions(label_expressions=label_expressions, metadata_list=metadata_list)
+
+    for label_expression in label_expressions:
+        for metadata, value in zip(metadata_list, values[label_expression].tolist()):
             metadata[label_expression] = value
 
 
@@ -252,100 +375,14 @@ def create_censoring_masks(censoring_scheme, raster, censoring_line_list, label_
     """
     censoring_masks = None
     if censoring_line_list != "":
-        window = 1  # How many Angstroms either side of the line should be used?
-        censoring_masks = {}
-        line_list_txt = open(censoring_line_list).readlines()
-
-        for label_name in label_fields:
-            allowed_lines = 0
-            mask = np.zeros(raster.size, dtype=bool)
-
-            # Loop over the lines in the line list and see which ones to include
-            for line in line_list_txt:
-                line = line.strip()
-
-                # Ignore comment lines
-                if (len(line) == 0) or (line[0] == "#"):
-                    continue
-                words = line.split()
-                element_symbol = words[0]
-
-                # We deal with excluded regions below; in this pass we put lines INTO the mask
-                if element_symbol == "exclude":
-                    continue
-
-                wavelength = words[2]
-
-                # Only select lines from elements we're trying to fit. Always use H lines.
-                assert censoring_scheme in [1, 2, 3]
-                if element_symbol != "H":
-
-                    # Scheme 1: All elements can see all lines
-                    if censoring_scheme == 1:
-                        if "[{}/H]".format(element_symbol) not in label_fields:
-                            continue
-
-                    # Scheme 2: Elements can only see their own lines, but Teff, log(g) can see all
-                    elif censoring_scheme == 2:
-                        if label_name in ("Teff", "logg"):
-                            if "[{}/H]".format(element_symbol) not in label_fields:
-                                continue
-                        else:
-                            if "[{}/H]".format(element_symbol) != label_name:
-                                continue
-
-                    # Scheme 3: As scheme 2, but [Fe/H] can also see all
-                    elif censoring_scheme == 3:
-                        if label_name in ("Teff", "logg", "[Fe/H]"):
-                            if "[{}/H]".format(element_symbol) not in label_fields:
-                                continue
-                        else:
-                            if "[{}/H]".format(element_symbol) != label_name:
-                                continue
-
-                # Is line specified as a range (broad), or a single central wavelength (assume narrow)
-                if "-" in wavelength:
-                    pass_band = [float(i) for i in wavelength.split("-")]
-                else:
-                    pass_band = [float(wavelength) - window, float(wavelength) + window]
-
-                # Allow this line
-                allowed_lines += 1
-                window_mask = (raster >= pass_band[0]) * (pass_band[1] >= raster)
-                mask[window_mask] = True
-
-            # Loop over the excluded regions in the line list, and make sure they are not in the mask
-            for line in line_list_txt:
-                line = line.strip()
-
-                # Ignore comment lines
-                if (len(line) == 0) or (line[0] == "#"):
-                    continue
-                words = line.split()
-                if words[0] == "exclude":
-                    wavelength = words[1]
-                    if "-" in wavelength:
-                        pass_band = [float(i) for i in wavelength.split("-")]
-                    else:
-                        pass_band = [float(wavelength) - window, float(wavelength) + window]
-
-                    # Disallow this region
-                    window_mask = (raster >= pass_band[0]) * (pass_band[1] >= raster)
-                    mask[window_mask] = False
-
-            logging.info("Pixels used for label {}: {} of {} (in {} lines)".
-                         format(label_name, mask.sum(), len(raster), allowed_lines))
-
-            # Invert the mask because the Cannon expects pixels to be True when they are *excluded*
-            censoring_masks[label_name] = ~mask
-
-        # Make sure that label expressions also have masks set
-        for label_name in label_expressions:
-            mask = censoring_masks["Teff"].copy()
-            censoring_masks[label_name] = mask
-
-            logging.info("Pixels used for label {}: {} of {} (copied from Teff)".
-                         format(label_name, len(raster) - mask.sum(), len(raster)))
+        # Parse the line list (or reuse a copy we have already parsed), and build masks from the pixel index ranges
+        # of each line
+        line_list = CensoringLineList.load(filename=censoring_line_list)
+        censoring_masks = line_list.censoring_masks(censoring_scheme=censoring_scheme,
+                                                    raster=raster,
+                                                    label_fields=label_fields,
+                                                    label_expressions=label_expressions,
+                                                    logger=logging)
     return censoring_masks
 
 
@@ -431,6 +468,32 @@ def main():
                         dest="interpolate",
                         help="Do not interpolate the test spectra onto a different raster.")
     parser.set_defaults(interpolate=False)
+    parser.add_argument('--model-registry',
+                        action='store_true',
+                        dest="model_registry",
+                        help="Keep a registry of trained Cannon models in the workspace, and reuse any previously "
+                             "trained model with identical training spectra, labels, censoring and settings, as if "
+                             "--reload-cannon had been specified (default).")
+    parser.add_argument('--no-model-registry',
+                        action='store_false',
+                        dest="model_registry",
+                        help="Always train the Cannon from scratch, and do not add it to the model registry.")
+    parser.set_defaults(model_registry=True)
+    parser.add_argument('--model-bundle',
+                        action='store_true',
+                        dest="model_bundle",
+                        help="After training the Cannon, also save it as a bundle of memory-mappable arrays, which "
+                             "can be reloaded much faster than the pickled model and summary JSON file. The bundle "
+                             "holds a second copy of the model's arrays, roughly doubling its size on disk.")
+    parser.add_argument('--no-model-bundle',
+                        action='store_false',
+                        dest="model_bundle",
+                        help="Do not save a memory-mappable bundle of the trained Cannon (default).")
+    parser.set_defaults(model_bundle=False)
+    parser.add_argument('--batch-processes', default=1, dest='batch_processes', type=int,
+                        help="Train and test the independent Cannon models for each entry in --labels-individual "
+                             "concurrently, across a pool of this many processes. The training set is memory mapped "
+                             "and shared between the processes. Each Cannon then uses a single thread.")
     args = parser.parse_args()
 
     logging.info("Testing Cannon with arguments <{}> <{}> <{}> <{}>".format(args.test_library,
@@ -459,8 +522,13 @@ def main():
     # Find out whether we're reloading a previously saved Cannon
     reloading_cannon = args.reload_cannon is not None
 
+    # Open the registry of previously trained Cannon models
+    model_registry = None
+    if args.model_registry and not reloading_cannon:
+        model_registry = CannonModelRegistry(workspace=workspace)
+
     # Open training set
-    training_library = training_library_ids_all = None
+    training_spectra_all = training_library_ids_all = None
     if not reloading_cannon:
         spectra = SpectrumLibrarySqlite.open_and_search(
             library_spec=args.train_library,
@@ -472,6 +540,16 @@ def main():
         # Make list of IDs of all spectra in the training set
         training_library_ids_all = [i["specId"] for i in training_library_items]
 
+        # Load the whole training set once. Each batch of labels we fit individually selects the spectra it needs
+        # from this array in memory, rather than reading the training set from disk again.
+        training_spectra_all = training_library.open(ids=training_library_ids_all)
+
+    # Work out whether we are training the models for each batch of individual labels concurrently
+    parallel_batches = (args.batch_processes > 1) and (len(test_labels_individual) > 1)
+
+    # Multiple worker processes should not each spawn multiple threads as well
+    cannon_threads = None if (args.multithread and not parallel_batches) else 1
+
     # Open test set
     spectra = SpectrumLibrarySqlite.open_and_search(
         library_spec=args.test_library,
@@ -483,8 +561,28 @@ def main():
     # Make list of IDs of all spectra in the test set
     test_library_ids = [i["specId"] for i in test_library_items]
 
-    # Fit each set of labels we're fitting individually, one by one
-    for labels_individual_batch_count, test_labels_individual_batch in enumerate(test_labels_individual):
+    def run_batch(labels_individual_batch_count, worker_process=False):
+        """
+        Train and test the Cannon on one of the sets of labels we're fitting individually.
+
+        :param labels_individual_batch_count:
+            The index of the set of labels within the list of sets we're fitting individually.
+        :param worker_process:
+            Boolean flag indicating whether we are running in a worker process, which needs to open its own
+            connection to the test library.
+        :return:
+            None
+        """
+        test_labels_individual_batch = test_labels_individual[labels_individual_batch_count]
+
+        # Worker processes open their own connection to the test library, rather than sharing the parent's
+        batch_test_library = test_library
+        if worker_process:
+            batch_test_library = SpectrumLibrarySqlite.open_and_search(
+                library_spec=args.test_library,
+                workspace=workspace,
+                extra_constraints={"continuum_normalised": continuum_normalised_testing}
+            )["library"]
 
         # Create filename for the output from this Cannon run
         output_filename = args.output_file
@@ -496,14 +594,12 @@ def main():
         # Sequence of tasks if we're reloading a pre-saved Cannon from disk
         if reloading_cannon:
 
-            # Load the JSON data that summarises the Cannon training that we're about to reload
-            json_summary_filename = "{}.summary.json.gz".format(args.reload_cannon)
-            cannon_pickle_filename = "{}.cannon".format(args.reload_cannon)
+            # Load the data that summarises the Cannon training that we're about to reload. If the Cannon was saved
+            # as a bundle, its arrays are memory mapped, rather than being parsed from JSON and unpickled.
+            summary_json = read_model_summary(model_prefix=args.reload_cannon)
+            cannon_pickle_filename = "{}.cannon".format(model_reload_prefix(model_prefix=args.reload_cannon))
 
-            with gzip.open(json_summary_filename, "rt") as f:
-                summary_json = json.loads(f.read())
-
-            raster = np.array(summary_json['wavelength_raster'])
+            raster = np.asarray(summary_json['wavelength_raster'])
             test_labels = summary_json['labels']
             training_library_ids = summary_json['training_spectra_ids']
             training_library_string = summary_json['train_library']
@@ -523,7 +619,7 @@ def main():
                                  tolerance=args.tolerance,
                                  polynomial_order=args.polynomial_order,
                                  censors=None,
-                                 threads=None if args.multithread else 1
+                                 threads=cannon_threads
                                  )
             time_training_end = time.time()
 
@@ -538,7 +634,7 @@ def main():
             # If requested, fill in any missing labels on the training set by assuming scaled-solar abundances
             if args.assume_scaled_solar:
                 training_library_ids, training_spectra = autocomplete_scaled_solar_abundances(
-                    training_library=training_library,
+                    training_spectra=training_spectra_all,
                     training_library_ids_all=training_library_ids_all,
                     label_list=test_label_fields + test_labels_individual_batch
                 )
@@ -546,7 +642,7 @@ def main():
             # Otherwise we reject any training spectra which have incomplete labels
             else:
                 training_library_ids, training_spectra = filter_training_spectra(
-                    training_library=training_library,
+                    training_spectra=training_spectra_all,
                     training_library_ids_all=training_library_ids_all,
                     label_list=test_label_fields + test_labels_individual_batch
                 )
@@ -576,28 +672,83 @@ def main():
             # If we're doing our own continuum normalisation, we need to treat each wavelength arm separately
             wavelength_arm_breaks = SpectrumProperties(raster).wavelength_arms()['break_points']
 
-            # Construct and train a model
+            # See whether an identical model has already been trained, in which case we reload it
+            model_hash = registered_model = None
+            if model_registry is not None:
+                model_hash = CannonModelRegistry.model_hash(
+                    training_library="{}/{}".format(os_path.abspath(workspace), training_library_string),
+                    training_spectra=training_spectra,
+                    training_spectrum_ids=training_library_ids,
+                    labels=test_labels,
+                    censoring_masks=censoring_masks,
+                    options={
+                        "fourgp_version": fourgp_version,
+                        "cannon_version": args.cannon_version,
+                        "cannon_class": cannon_class.__name__,
+                        "continuum_normalisation": args.continuum_normalisation,
+                        "polynomial_order": args.polynomial_order,
+                        "tolerance": args.tolerance,
+                        "assume_scaled_solar": args.assume_scaled_solar
+                    }
+                )
+                registered_model = model_registry.lookup(model_hash=model_hash)
+
+            # We are about to save a new model under this output filename, so any bundle left by an earlier model
+            # which was saved under the same name is stale
+            remove_model_bundle(model_prefix=output_filename)
+
             time_training_start = time.time()
-            model = cannon_class(training_set=training_spectra,
-                                 wavelength_arms=wavelength_arm_breaks,
-                                 label_names=test_labels,
-                                 tolerance=args.tolerance,
-                                 polynomial_order=args.polynomial_order,
-                                 censors=censoring_masks,
-                                 threads=None if args.multithread else 1
-                                 )
-            time_training_end = time.time()
+            if registered_model is not None:
+                logging.info("Reusing previously trained Cannon <{}>".format(registered_model))
+
+                # Reload the model in the same way as --reload-cannon
+                model = cannon_class(training_set=None,
+                                     wavelength_arms=wavelength_arm_breaks,
+                                     load_from_file=registered_model,
+                                     label_names=test_labels,
+                                     tolerance=args.tolerance,
+                                     polynomial_order=args.polynomial_order,
+                                     censors=None,
+                                     threads=cannon_threads
+                                     )
+                time_training_end = time.time()
+
+                # Place a copy of the model alongside our other output, as if we had trained it
+                shutil.copyfile(registered_model, "{:s}.cannon".format(output_filename))
 
-            # Save the model
-            model.save_model(filename="{:s}.cannon".format(output_filename),
-                             overwrite=True)
+            else:
+                # Construct and train a model
+                model = cannon_class(training_set=training_spectra,
+                                     wavelength_arms=wavelength_arm_breaks,
+                                     label_names=test_labels,
+                                     tolerance=args.tolerance,
+                                     polynomial_order=args.polynomial_order,
+                                     censors=censoring_masks,
+                                     threads=cannon_threads
+                                     )
+                time_training_end = time.time()
+
+                # Save the model
+                model.save_model(filename="{:s}.cannon".format(output_filename),
+                                 overwrite=True)
+
+                # Add the model to the registry, so that future runs can reuse it
+                if model_registry is not None:
+                    model_registry.register(model_hash=model_hash,
+                                            filename="{:s}.cannon".format(output_filename),
+                                            description={
+                                                "train_library": training_library_string,
+                                                "labels": test_labels,
+                                                "line_list": line_list,
+                                                "output_file": output_filename
+                                            })
 
         # Test the model
         N = len(test_library_ids)
         time_taken = np.zeros(N)
         results = []
         for index in range(N):
-            test_spectrum_array = test_library.open(ids=test_library_ids[index])
+            test_spectrum_array = batch_test_library.open(ids=test_library_ids[index])
             spectrum = test_spectrum_array.extract_item(0)
             logging.info("Testing {}/{}: {}".format(index + 1, N, spectrum.metadata['Starname']))
 
@@ -654,11 +805,10 @@ def main():
         # Create output data structure
         censoring_output = None
         if reloading_cannon:
-            censoring_output = summary_json['censoring_mask']
-        else:
-            if censoring_masks is not None:
-                censoring_output = dict([(label, tuple([int(i) for i in mask]))
-                                         for label, mask in censoring_masks.items()])
+            censoring_masks = summary_json['censoring_mask']
+        if censoring_masks is not None:
+            censoring_output = dict([(label, tuple([int(i) for i in mask]))
+                                     for label, mask in censoring_masks.items()])
 
         output_data = {
             "hostname": os.uname()[1],
@@ -689,6 +839,67 @@ def main():
         with gzip.open("{:s}.full.json.gz".format(output_filename), "wt") as f:
             f.write(json.dumps(output_data, indent=2))
 
+        # Write a bundle of memory-mappable arrays, which allows this Cannon to be reloaded quickly
+        if args.model_bundle and not reloading_cannon:
+            write_model_bundle(model_prefix=output_filename)
+
+    # Fit each set of labels we're fitting individually, either concurrently or one by one
+    memory_map_directory = None
+    try:
+        if parallel_batches:
+            # Memory map the training set, so that all the worker processes share a single copy of it
+            if training_spectra_all is not None:
+                memory_map_directory = tempfile.mkdtemp(prefix="cannon_training_set_")
+                training_spectra_all = memory_map_spectra(spectra=training_spectra_all,
+                                                          directory=memory_map_directory)
+
+            # Worker processes are forked, so they inherit run_batch via the initializer without it being pickled
+            pool = mp.get_context("fork").Pool(processes=args.batch_processes,
+                                               initializer=init_batch_worker,
+                                               initargs=(run_batch,))
+            try:
+                pool.map(func=batch_worker,
+                         iterable=range(len(test_labels_individual)),
+                         chunksize=1)
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for labels_individual_batch_count in range(len(test_labels_individual)):
+                run_batch(labels_individual_batch_count=labels_individual_batch_count)
+
+    finally:
+        # Clean up memory-mapped copy of the training set
+        if memory_map_directory is not None:
+            shutil.rmtree(memory_map_directory, ignore_errors=True)
+
+
+# Function which trains and tests the Cannon on one set of individual labels, inherited by each worker process from
+# main() via <init_batch_worker>
+batch_runner = None
+
+
+def init_batch_worker(run_batch):
+    """
+    Initialise a worker process which trains and tests the Cannon on sets of individual labels.
+
+    :param run_batch:
+        The function which trains and tests the Cannon on one set of individual labels.
+    :return:
+        None
+    """
+    global batch_runner
+    batch_runner = run_batch
+
+
+# Helper to run one set of individual labels in a worker process. This has to be globally defined so all the worker
+# processes can see it...
+def batch_worker(labels_individual_batch_count):
+    batch_runner(labels_individual_batch_count=labels_individual_batch_count, worker_process=True)
+
 
 # Do it right away if we're run as a script
 if __name__ == "__main__":
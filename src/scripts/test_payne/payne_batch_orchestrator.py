@@ -0,0 +1,238 @@
+#!../../../../virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+
+# NB: The shebang line above assumes you've installed a python virtual environment alongside your working copy of the
+# <4most-4gp-scripts> git repository. It also only works if you invoke this python script from the directory where it
+# is located. If these two assumptions are incorrect (e.g. you're using Conda), you can still use this script by typing
+# <python payne_batch_orchestrator.py>, but <./payne_batch_orchestrator.py> will not work.
+
+"""
+Train the Payne in several batches of pixels, running the batches in parallel across a pool of processes on this
+machine, and then combine the batches and test the trained model.
+
+Any command-line arguments which this script does not recognise are passed straight through to <payne_test.py>, e.g.
+
+python3 payne_batch_orchestrator.py --train-batch-count 20 --processes 8 \\
+                                    --train "galah_training_sample_4fs_hrs[SNR=250]" \\
+                                    --test "galah_test_sample_4fs_hrs" \\
+                                    --labels "Teff,logg,[Fe/H]" \\
+                                    --output-file "../../../output_data/payne/payne_galah_hrs_3label"
+
+Each batch of pixels is trained by running <payne_test.py> with the arguments --train-batch-count and
+--train-batch-number. Progress is recorded in the directory <output-file>.batches, alongside the training data
+archive, so that if this script is interrupted and re-run with the same arguments, it only trains the batches which are
+not yet done. Batches which fail are retried. Once all the batches are done, <payne_test.py> is run with
+--train-batch-number -1, which combines the batches and tests the model.
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+import time
+from os import path as os_path
+
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                    datefmt='%d/%m/%Y %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+our_path = os_path.split(os_path.abspath(__file__))[0]
+
+
+def payne_test_command(payne_arguments, batch_number, batch_count):
+    """
+    Construct the command line to run <payne_test.py> on one batch of pixels.
+
+    :param payne_arguments:
+        List of the command-line arguments to pass to <payne_test.py>.
+    :param batch_number:
+        The number of the batch of pixels to train, or -1 to combine the batches and test the model.
+    :param batch_count:
+        The total number of batches of pixels.
+    :return:
+        List of command-line arguments.
+    """
+    return ([sys.executable, os_path.join(our_path, "payne_test.py")] +
+            payne_arguments +
+            ["--train-batch-count", str(batch_count), "--train-batch-number", str(batch_number)])
+
+
+def run_batch(job):
+    """
+    Run <payne_test.py> on one batch of pixels, writing its output to a log file.
+
+    :param job:
+        A tuple of (batch number, command line, log filename).
+    :return:
+        A tuple of (batch number, exit code, time taken).
+    """
+    batch_number, command, log_filename = job
+    time_start = time.time()
+    with open(log_filename, "a") as log:
+        log.write("# {}\n".format(" ".join(command)))
+        log.flush()
+        exit_code = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+    return batch_number, exit_code, time.time() - time_start
+
+
+class BatchStatus:
+    """
+    Record of which batches of pixels have been trained, stored as a JSON file in the directory <output-file>.batches.
+    """
+
+    def __init__(self, directory, payne_arguments, batch_count):
+        """
+        Open the record of batch progress, discarding it if it was made with different arguments to <payne_test.py>.
+
+        :param directory:
+            The directory where we store the record of progress, and the log files from each batch.
+        :param payne_arguments:
+            List of the command-line arguments to pass to <payne_test.py>.
+        :param batch_count:
+            The total number of batches of pixels.
+        """
+        self.directory = directory
+        self.filename = os_path.join(directory, "status.json")
+        os.system("mkdir -p {}".format(directory))
+
+        self.status = {
+            "payne_arguments": payne_arguments,
+            "batch_count": batch_count,
+            "batches": dict([(str(i), {"done": False, "attempts": 0, "time": None}) for i in range(batch_count)])
+        }
+
+        if os_path.exists(self.filename):
+            with open(self.filename) as f:
+                previous_status = json.loads(f.read())
+            if ((previous_status["payne_arguments"] == payne_arguments) and
+                    (previous_status["batch_count"] == batch_count)):
+                self.status = previous_status
+
+                # Each time we are run, give batches which previously failed a fresh set of attempts
+                for item in self.status["batches"].values():
+                    if not item["done"]:
+                        item["attempts"] = 0
+            else:
+                logger.info("Arguments have changed since batches were last trained; starting afresh.")
+
+        self.save()
+
+    def save(self):
+        """
+        Write the record of batch progress to disk. We write to a temporary file first, so that the record is never
+        left partially written.
+        """
+        with open("{}.tmp".format(self.filename), "w") as f:
+            f.write(json.dumps(self.status, indent=2))
+        os.rename("{}.tmp".format(self.filename), self.filename)
+
+    def log_filename(self, batch_number):
+        """
+        Return the filename of the log file for a batch of pixels.
+        """
+        return os_path.join(self.directory, "batch_{:03d}.log".format(batch_number))
+
+    def pending(self, max_attempts):
+        """
+        Return a list of the batches which are not yet done, and which have not yet used up all their attempts.
+        """
+        return [int(i) for i, item in sorted(self.status["batches"].items(), key=lambda x: int(x[0]))
+                if (not item["done"]) and (item["attempts"] < max_attempts)]
+
+    def all_done(self):
+        """
+        Return True if every batch of pixels has been trained.
+        """
+        return all(item["done"] for item in self.status["batches"].values())
+
+    def update(self, batch_number, exit_code, time_taken):
+        """
+        Record the result of an attempt to train a batch of pixels.
+        """
+        item = self.status["batches"][str(batch_number)]
+        item["attempts"] += 1
+        item["done"] = (exit_code == 0)
+        item["time"] = time_taken
+        self.save()
+
+
+def main():
+    """
+    Main entry point for training the Payne in batches.
+    """
+
+    # Read input parameters
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     allow_abbrev=False)
+    parser.add_argument('--train-batch-count', required=True, dest='batch_count', type=int,
+                        help="The number of batches of pixels to split the training of the Payne into.")
+    parser.add_argument('--processes', default=os.cpu_count(), dest='processes', type=int,
+                        help="The number of batches of pixels to train concurrently. Consider also passing --nothread "
+                             "if each batch would otherwise use every CPU core.")
+    parser.add_argument('--retries', default=2, dest='retries', type=int,
+                        help="The number of times to retry training a batch of pixels, if it fails.")
+    parser.add_argument('--output-file', default="./test_cannon.out", dest='output_file',
+                        help="Data file to write output to. This is passed through to <payne_test.py>.")
+    args, payne_arguments = parser.parse_known_args()
+
+    for reserved in ("--train-batch-number",):
+        assert reserved not in payne_arguments, \
+            "The argument {} is set by this script, and should not be specified.".format(reserved)
+
+    payne_arguments = payne_arguments + ["--output-file", args.output_file]
+
+    # Directory where we keep track of which batches are done
+    status = BatchStatus(directory="{}.batches".format(args.output_file),
+                         payne_arguments=payne_arguments,
+                         batch_count=args.batch_count)
+
+    # Train batches, retrying any which fail
+    max_attempts = args.retries + 1
+    pending = status.pending(max_attempts=max_attempts)
+    logger.info("{:d} of {:d} batches still to train.".format(len(pending), args.batch_count))
+
+    while pending:
+        jobs = [(batch_number,
+                 payne_test_command(payne_arguments=payne_arguments,
+                                    batch_number=batch_number,
+                                    batch_count=args.batch_count),
+                 status.log_filename(batch_number=batch_number))
+                for batch_number in pending]
+
+        with mp.get_context("fork").Pool(min(args.processes, len(jobs))) as pool:
+            for batch_number, exit_code, time_taken in pool.imap_unordered(run_batch, jobs):
+                status.update(batch_number=batch_number, exit_code=exit_code, time_taken=time_taken)
+                if exit_code == 0:
+                    logger.info("Batch {:d} done in {:.1f} sec.".format(batch_number, time_taken))
+                else:
+                    logger.warning("Batch {:d} failed with exit code {:d}. See <{}>.".
+                                   format(batch_number, exit_code, status.log_filename(batch_number=batch_number)))
+
+        pending = status.pending(max_attempts=max_attempts)
+
+    if not status.all_done():
+        logger.error("Some batches failed {:d} times; not combining batches.".format(max_attempts))
+        sys.exit(1)
+
+    # Combine the batches and test the model
+    logger.info("All batches done. Combining batches and testing the Payne.")
+    batch_number, exit_code, time_taken = run_batch((-1,
+                                                     payne_test_command(payne_arguments=payne_arguments,
+                                                                        batch_number=-1,
+                                                                        batch_count=args.batch_count),
+                                                     os_path.join(status.directory, "test.log")))
+    if exit_code != 0:
+        logger.error("Testing failed with exit code {:d}. See <{}>.".
+                     format(exit_code, os_path.join(status.directory, "test.log")))
+        sys.exit(1)
+
+    logger.info("Testing done in {:.1f} sec.".format(time_taken))
+
+
+# Do it right away if we're run as a script
+if __name__ == "__main__":
+    main()
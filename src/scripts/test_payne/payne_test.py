@@ -27,6 +27,9 @@ from fourgp_payne import __version__ as fourgp_version
 from fourgp_payne.payne_wrapper_ting import PayneInstanceTing
 from fourgp_speclib import SpectrumLibrarySqlite
 
+from lib.censoring_line_list import CensoringLineList
+from lib.label_expression import evaluate_label_expressions
+
 
 def resample_spectrum(spectrum, training_spectra):
     """
@@ -122,11 +125,13 @@ def evaluate_computed_labels(label_expressions, spectra):
     :return:
         None
     """
-    global logger
-    for index in range(len(spectra)):
-        metadata = spectra.get_metadata(index)
-        for label_expression in label_expressions:
-            value = eval(label_expression, metadata)
+    metadata_list = [spectra.get_metadata(index) for index in range(len(spectra))]
+
+    # Compile each expression once, and evaluate it over arrays of the metadata of all the spectra at once
+    values = evaluate_label_expressions(label_expressions=label_expressions, metadata_list=metadata_list)
+
+    for label_expression in label_expressions:
+        for metadata, value in zip(metadata_list, values[label_expression].tolist()):
             metadata[label_expression] = value
 
 
@@ -157,100 +162,14 @@ def create_censoring_masks(censoring_scheme, raster, censoring_line_list, label_
     global logger
     censoring_masks = None
     if censoring_line_list != "":
-        window = 1  # How many Angstroms either side of the line should be used?
-        censoring_masks = {}
-        line_list_txt = open(censoring_line_list).readlines()
-
-        for label_name in label_fields:
-            allowed_lines = 0
-            mask = np.zeros(raster.size, dtype=bool)
-
-            # Loop over the lines in the line list and see which ones to include
-            for line in line_list_txt:
-                line = line.strip()
-
-                # Ignore comment lines
-                if (len(line) == 0) or (line[0] == "#"):
-                    continue
-                words = line.split()
-                element_symbol = words[0]
-
-                # We deal with excluded regions below; in this pass we put lines INTO the mask
-                if element_symbol == "exclude":
-                    continue
-
-                wavelength = words[2]
-
-                # Only select lines from elements we're trying to fit. Always use H lines.
-                assert censoring_scheme in [1, 2, 3]
-                if element_symbol != "H":
-
-                    # Scheme 1: All elements can see all lines
-                    if censoring_scheme == 1:
-                        if "[{}/H]".format(element_symbol) not in label_fields:
-                            continue
-
-                    # Scheme 2: Elements can only see their own lines, but Teff, log(g) can see all
-                    elif censoring_scheme == 2:
-                        if label_name in ("Teff", "logg"):
-                            if "[{}/H]".format(element_symbol) not in label_fields:
-                                continue
-                        else:
-                            if "[{}/H]".format(element_symbol) != label_name:
-                                continue
-
-                    # Scheme 3: As scheme 2, but [Fe/H] can also see all
-                    elif censoring_scheme == 3:
-                        if label_name in ("Teff", "logg", "[Fe/H]"):
-                            if "[{}/H]".format(element_symbol) not in label_fields:
-                                continue
-                        else:
-                            if "[{}/H]".format(element_symbol) != label_name:
-                                continue
-
-                # Is line specified as a range (broad), or a single central wavelength (assume narrow)
-                if "-" in wavelength:
-                    pass_band = [float(i) for i in wavelength.split("-")]
-                else:
-                    pass_band = [float(wavelength) - window, float(wavelength) + window]
-
-                # Allow this line
-                allowed_lines += 1
-                window_mask = (raster >= pass_band[0]) * (pass_band[1] >= raster)
-                mask[window_mask] = True
-
-            # Loop over the excluded regions in the line list, and make sure they are not in the mask
-            for line in line_list_txt:
-                line = line.strip()
-
-                # Ignore comment lines
-                if (len(line) == 0) or (line[0] == "#"):
-                    continue
-                words = line.split()
-                if words[0] == "exclude":
-                    wavelength = words[1]
-                    if "-" in wavelength:
-                        pass_band = [float(i) for i in wavelength.split("-")]
-                    else:
-                        pass_band = [float(wavelength) - window, float(wavelength) + window]
-
-                    # Disallow this region
-                    window_mask = (raster >= pass_band[0]) * (pass_band[1] >= raster)
-                    mask[window_mask] = False
-
-            logger.info("Pixels used for label {}: {} of {} (in {} lines)".
-                        format(label_name, mask.sum(), len(raster), allowed_lines))
-
-            # Invert the mask because the Cannon expects pixels to be True when they are *excluded*
-            censoring_masks[label_name] = ~mask
-
-        # Make sure that label expressions also have masks set
-        for label_name in label_expressions:
-            mask = censoring_masks["Teff"].copy()
-            censoring_masks[label_name] = mask
-
-            logger.info("Pixels used for label {}: {} of {} (copied from Teff)".
-                        format(label_name, len(raster) - mask.sum(), len(raster)))
+        # Parse the line list (or reuse a copy we have already parsed), and build masks from the pixel index ranges
+        # of each line
+        line_list = CensoringLineList.load(filename=censoring_line_list)
+        censoring_masks = line_list.censoring_masks(censoring_scheme=censoring_scheme,
+                                                    raster=raster,
+                                                    label_fields=label_fields,
+                                                    label_expressions=label_expressions,
+                                                    logger=logger)
     return censoring_masks
 
 
@@ -281,7 +200,8 @@ def main():
     parser.add_argument('--train-batch-number', required=False, dest='batch_number', type=int, default=0,
                         help="If training pixels in multiple batches on different machines, then this is the number of "
                              "the batch of pixels we are to train. It should be in the range 0 .. batch_count-1 "
-                             "inclusive. If it is -1, then we skip training to move straight to testing.")
+                             "inclusive. If it is -1, then we skip training to move straight to testing. See "
+                             "<payne_batch_orchestrator.py> to run all the batches on one machine.")
     parser.add_argument('--train-batch-count', required=False, dest='batch_count', type=int, default=1,
                         help="If training pixels in multiple batches on different machines, then this is the number "
                              "of batches.")
@@ -432,6 +352,12 @@ def main():
 
         time_training_end = time.time()
 
+        # If we have only trained one of several batches of pixels, we can't test the model until all of the batches
+        # have been trained, and then combined by running again with a batch number of -1
+        if (args.batch_count > 1) and (args.batch_number >= 0):
+            logger.info("Trained batch {:d} of {:d}; skipping testing.".format(args.batch_number + 1, args.batch_count))
+            continue
+
         # Test the model
         N = len(test_library_ids)
         time_taken = np.zeros(N)
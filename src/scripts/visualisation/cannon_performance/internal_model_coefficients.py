@@ -11,14 +11,10 @@ Take an output file from the Cannon, and plot the Cannon's predictive model coef
 """
 
 import argparse
-import gzip
-import json
 import os
-from os import path as os_path
 
-import numpy as np
 from fourgp_cannon import CannonInstance
-from fourgp_speclib import SpectrumLibrarySqlite
+from lib.cannon_model_bundle import model_reload_prefix, read_model_summary
 
 # Read input parameters
 parser = argparse.ArgumentParser(description=__doc__)
@@ -33,39 +29,18 @@ parser.add_argument('--output', default="/tmp/cannon_model_", dest='output_stub'
                     help="Data file to write output to.")
 args = parser.parse_args()
 
-# Set path to workspace where we expect to find libraries of spectra
-our_path = os_path.split(os_path.abspath(__file__))[0]
-workspace = os_path.join(our_path, "../../../../workspace")
-
 # Create directory to store output files in
 os.system("mkdir -p {}".format(args.output_stub))
 
 # Fetch title for this Cannon run
-cannon_output = json.loads(gzip.open(args.cannon + ".summary.json.gz", "rt").read())
+cannon_output = read_model_summary(model_prefix=args.cannon)
 description = cannon_output['description']
 
-# Open spectrum library we originally trained the Cannon on
-training_spectra_info = SpectrumLibrarySqlite.open_and_search(
-    library_spec=cannon_output["train_library"],
-    workspace=workspace,
-    extra_constraints={"continuum_normalised": 1}
-)
-
-training_library, training_library_items = [training_spectra_info[i] for i in ("library", "items")]
-
-# Load training set
-training_library_ids = [i["specId"] for i in training_library_items]
-training_spectra = training_library.open(ids=training_library_ids)
-
-# Recreate a Cannon instance, using the saved state
-censoring_masks = cannon_output["censoring_mask"]
-if censoring_masks is not None:
-    for key, value in censoring_masks.items():
-        censoring_masks[key] = np.asarray(value)
-
-model = CannonInstance(training_set=training_spectra,
-                       load_from_file=args.cannon + ".cannon",
+# Recreate a Cannon instance, using the saved state. The coefficients of the Cannon's predictive model are all saved
+# on disk, so we don't need to load the training set (or even have a copy of it) to do this.
+model = CannonInstance(training_set=None,
+                       load_from_file="{}.cannon".format(model_reload_prefix(model_prefix=args.cannon)),
                        label_names=cannon_output["labels"],
-                       censors=censoring_masks,
+                       censors=None,
                        threads=None
                        )
@@ -21,7 +21,9 @@ from os import path as os_path
 
 import numpy as np
 from fourgp_cannon import CannonInstance_2018_01_09
-from fourgp_speclib import SpectrumLibrarySqlite, Spectrum
+from fourgp_speclib import SpectrumLibrarySqlite, SpectrumArray
+from lib.cannon_batch_prediction import label_matrix, predict_spectra
+from lib.cannon_model_bundle import model_reload_prefix
 
 
 def dict_merge(x, y):
@@ -30,66 +32,6 @@ def dict_merge(x, y):
     return z
 
 
-def autocomplete_scaled_solar_abundances(input_spectra, label_list):
-    """
-    Where stars have elemental abundances missing, insert scaled-solar values.
-
-    :param input_spectra:
-        SpectrumArray containing the spectra we are to operate on.
-    :param label_list:
-        The list of the labels which must be set on every spectrum.
-    :return:
-        SpectrumArray with values filled in.
-    """
-    global logger
-    for index in range(len(input_spectra)):
-        metadata = input_spectra.get_metadata(index)
-        for label in label_list:
-            if (label not in metadata) or (metadata[label] is None) or (not np.isfinite(metadata[label])):
-                # print "Label {} in spectrum {} assumed as scaled solar.".format(label, index)
-                metadata[label] = metadata["[Fe/H]"]
-    output_spectra = input_spectra
-
-    return output_spectra
-
-
-def filter_training_spectra(input_spectra, label_list, input_library, input_spectrum_ids):
-    """
-    Filter the spectra in a SpectrumArray on the basis that they must have a list of metadata values defined.
-
-    :param input_spectra:
-        A SpectrumArray from which we are to select spectra.
-    :param label_list:
-        The list of labels which must be set in order for a spectrum to be accepted.
-    :param input_library:
-        The input spectrum library from which these spectra were loaded (used to reload only the selected spectra).
-    :param input_spectrum_ids:
-        A list of the spectrum IDs of the spectra in the SpectrumArray <input_spectra>.
-    :return:
-        A list of two items:
-
-        0. A list of the IDs of the selected spectra
-        1. A SpectrumArray of the selected spectra
-    """
-    global logger
-    ids_filtered = []
-    for index in range(len(input_spectra)):
-        accept = True
-        metadata = input_spectra.get_metadata(index)
-        for label in label_list:
-            if (label not in metadata) or (metadata[label] is None) or (not np.isfinite(metadata[label])):
-                accept = False
-                break
-        if accept:
-            ids_filtered.append(input_spectrum_ids[index])
-    logger.info("Accepted {:d} / {:d} training spectra; others had labels missing.".
-                format(len(ids_filtered), len(input_spectrum_ids)))
-    output_spectrum_ids = ids_filtered
-    output_spectra = input_library.open(ids=output_spectrum_ids)
-
-    return output_spectra
-
-
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
                     datefmt='%d/%m/%Y %H:%M:%S')
@@ -130,33 +72,6 @@ os.system("mkdir -p {}".format(workspace))
 cannon_output = json.loads(gzip.open(args.cannon + ".full.json.gz", "rt").read())
 description = cannon_output['description']
 
-# Open spectrum library we originally trained the Cannon on
-training_spectra_info = SpectrumLibrarySqlite.open_and_search(
-    library_spec=cannon_output["train_library"],
-    workspace=workspace,
-    extra_constraints={"continuum_normalised": 1}
-)
-
-training_library, training_library_items = [training_spectra_info[i] for i in ("library", "items")]
-
-# Load training set
-training_library_ids_all = [i["specId"] for i in training_library_items]
-training_spectra_all = training_library.open(ids=training_library_ids_all)
-
-# If requested, fill in any missing labels on the training set by assuming scaled-solar abundances
-if cannon_output['assume_scaled_solar']:
-    training_spectra = autocomplete_scaled_solar_abundances(
-        input_spectra=training_spectra_all,
-        label_list=cannon_output["labels"]
-    )
-else:
-    training_spectra = filter_training_spectra(
-        input_spectra=training_spectra_all,
-        label_list=cannon_output["labels"],
-        input_library=training_library,
-        input_spectrum_ids=training_library_ids_all
-    )
-
 # Recreate the mask that was used when the Cannon was trained
 censoring_masks = cannon_output["censoring_mask"]
 if censoring_masks is not None:
@@ -181,11 +96,12 @@ logger.info("Mask includes {:d} of {:d} pixels.".format(sum(overall_mask),
                                                         len(cannon_output['wavelength_raster']))
             )
 
-# Recreate a Cannon instance, using the saved state
-model = CannonInstance_2018_01_09(training_set=training_spectra,
-                                  load_from_file=args.cannon + ".cannon",
+# Recreate a Cannon instance, using the saved state. The coefficients of the Cannon's predictive model are all saved
+# on disk, so we don't need to load the training set (or even have a copy of it) to do this.
+model = CannonInstance_2018_01_09(training_set=None,
+                                  load_from_file="{}.cannon".format(model_reload_prefix(model_prefix=args.cannon)),
                                   label_names=cannon_output["labels"],
-                                  censors=censoring_masks,
+                                  censors=None,
                                   threads=None
                                   )
 cannon = model._model
@@ -195,18 +111,20 @@ library_name = re.sub("/", "_", args.output_library)
 library_path = os_path.join(workspace, library_name)
 output_library = SpectrumLibrarySqlite(path=library_path, create=args.create)
 
-# Query Cannon's internal model of each test spectrum in turn
-for test_item in cannon_output['spectra']:
-    label_values = test_item['cannon_output'].copy()
-    label_vector = np.asarray([label_values[key] for key in cannon_output["labels"]])
-    cannon_predicted_spectrum = cannon.predict(label_vector)[0]
-
-    spectrum_object = Spectrum(wavelengths=cannon.dispersion[overall_mask],
-                               values=cannon_predicted_spectrum[overall_mask],
-                               value_errors=cannon.s2[overall_mask]
-                               )
-
-    output_library.insert(spectra=spectrum_object,
-                          filenames=test_item['Starname'],
-                          metadata_list=dict_merge(test_item['spectrum_metadata'], test_item['cannon_output'])
-                          )
+# Query Cannon's internal model of all the test spectra at once
+test_items = cannon_output['spectra']
+labels = label_matrix(label_values_list=[test_item['cannon_output'] for test_item in test_items],
+                      label_names=cannon_output["labels"])
+cannon_predicted_spectra = predict_spectra(cannon=cannon, labels=labels)
+
+# Write all of the predicted spectra into the output library in a single transaction
+spectra = SpectrumArray(wavelengths=cannon.dispersion[overall_mask],
+                        values=cannon_predicted_spectra[:, overall_mask],
+                        value_errors=np.tile(cannon.s2[overall_mask], (len(test_items), 1)),
+                        metadata_list=[dict_merge(test_item['spectrum_metadata'], test_item['cannon_output'])
+                                       for test_item in test_items]
+                        )
+
+output_library.insert(spectra=spectra,
+                      filenames=[test_item['Starname'] for test_item in test_items]
+                      )
@@ -15,8 +15,6 @@ multiple test stars with identical parameters, except for the one parameter we a
 """
 
 import argparse
-import gzip
-import json
 import os
 import re
 from operator import itemgetter
@@ -25,6 +23,8 @@ from os import path as os_path
 import numpy as np
 from fourgp_cannon import CannonInstance_2018_01_09
 from fourgp_speclib import SpectrumLibrarySqlite
+from lib.cannon_batch_prediction import label_matrix, predict_spectra
+from lib.cannon_model_bundle import model_reload_prefix, read_model_summary
 from lib.pyxplot_driver import PyxplotDriver
 
 
@@ -75,32 +75,29 @@ workspace = os_path.join(our_path, "../../../../workspace")
 os.system("mkdir -p {}".format(args.output_stub))
 
 # Fetch metadata about this Cannon run
-cannon_output = json.loads(gzip.open(args.cannon + ".summary.json.gz", "rt").read())
+cannon_output = read_model_summary(model_prefix=args.cannon)
 description = cannon_output['description']
 
-# Open spectrum library we originally trained the Cannon on
+# Open spectrum library we originally trained the Cannon on, and search for the training spectra which meet the label
+# constraints for this plot. We only need to load these spectra, not the whole training set.
 training_spectra_info = SpectrumLibrarySqlite.open_and_search(
     library_spec=cannon_output["train_library"],
     workspace=workspace,
-    extra_constraints={"continuum_normalised": 1}
+    extra_constraints=dict([("continuum_normalised", 1)] + list(label_constraints.items()))
 )
 
 training_library, training_library_items = [training_spectra_info[i] for i in ("library", "items")]
 
-# Load training set
+# Load training spectra
 training_library_ids = [i["specId"] for i in training_library_items]
 training_spectra = training_library.open(ids=training_library_ids)
 
-# Recreate a Cannon instance, using the saved state
-censoring_masks = cannon_output["censoring_mask"]
-if censoring_masks is not None:
-    for key, value in censoring_masks.items():
-        censoring_masks[key] = np.asarray(value)
-
-model = CannonInstance_2018_01_09(training_set=training_spectra,
-                                  load_from_file=args.cannon + ".cannon",
+# Recreate a Cannon instance, using the saved state. The coefficients of the Cannon's predictive model are all saved
+# on disk, so we don't need to train it on the training set to do this.
+model = CannonInstance_2018_01_09(training_set=None,
+                                  load_from_file="{}.cannon".format(model_reload_prefix(model_prefix=args.cannon)),
                                   label_names=cannon_output["labels"],
-                                  censors=censoring_masks,
+                                  censors=None,
                                   threads=None
                                   )
 
@@ -147,13 +144,19 @@ cannon = model._model
 raster_mask_2 = (cannon.dispersion > args.wavelength_min) * \
                 (cannon.dispersion < args.wavelength_max)
 raster_indices_2 = np.where(raster_mask_2)[0]
-cannon_predictions = []
-for i in range(n_steps):
+step_values = np.linspace(value_min, value_max, n_steps)
+label_values_list = []
+for value in step_values:
     label_values = label_fixed_values.copy()
-    value = value_min + i * (value_max - value_min) / (n_steps - 1.)
     label_values[args.label] = value
-    label_vector = np.asarray([label_values[key] for key in cannon_output["labels"]])
-    cannon_predicted_spectrum = cannon.predict(label_vector)[0]
+    label_values_list.append(label_values)
+
+# Predict the spectra for all the steps at once
+cannon_predicted_spectra = predict_spectra(cannon=cannon,
+                                           labels=label_matrix(label_values_list=label_values_list,
+                                                               label_names=cannon_output["labels"]))
+cannon_predictions = []
+for value, cannon_predicted_spectrum in zip(step_values, cannon_predicted_spectra):
     cannon_predictions.append({
         "value": value,
         "flux": cannon_predicted_spectrum[raster_mask_2],
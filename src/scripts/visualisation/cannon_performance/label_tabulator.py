@@ -33,20 +33,23 @@ from os import path as os_path
 import numpy as np
 
 
+def last_occurrences(keys):
+    """
+    Find the index of the last occurrence of each distinct value in an array of integer keys.
+
+    :param keys:
+        A numpy array of integer keys.
+    :return:
+        A list of two numpy arrays: the distinct keys, in ascending order, and the index of the last occurrence of each.
+    """
+    unique_keys, reversed_index = np.unique(keys[::-1], return_index=True)
+    return unique_keys, len(keys) - 1 - reversed_index
+
+
 def tabulate_labels(output_stub, labels, cannon, assume_scaled_solar=False):
     # Make sure output directory exists
     os.system("mkdir -p {}".format(os_path.split(output_stub)[0]))
 
-    # library_values[Starname] = [list of label values]
-    # cannon_values[Starname][SNR] = [list of label values]
-    # cannon_errors[Starname][SNR] = [list of label uncertainties, as estimated by the Cannon]
-    library_values = {}
-    cannon_values = {}
-    cannon_uncertainties = {}
-
-    # Start compiling a list of all the SNR values in the Cannon output
-    snr_list = []
-
     # Load Cannon JSON output
     if not cannon.endswith(".full.json.gz"):
         cannon += ".full.json.gz"
@@ -57,99 +60,82 @@ def tabulate_labels(output_stub, labels, cannon, assume_scaled_solar=False):
     if not labels:
         labels = sorted(cannon_json['labels'])
 
-    # Open Cannon output data file
-    for item in cannon_json["spectra"]:
-        # Look up name of object and SNR of spectrum used
-        object_name = item["Starname"]
-        snr = item["spectrum_metadata"]["SNR"] if "SNR" in item["spectrum_metadata"] else 0
-
-        # Look up Cannon's estimated values of the labels we're interested in
-        label_values = []
-        for label in labels:
-            label_values.append(item["cannon_output"][label])
-
-        # Feed Cannon's estimated values in the cannon_values data structure
-        if object_name not in cannon_values:
-            cannon_values[object_name] = {}
-        cannon_values[object_name][snr] = label_values
-
-        # Keep a list of all the SNRs we've seen
-        if snr not in snr_list:
-            snr_list.append(snr)
-
-        # Look up the target values for each label
-        label_values = []
-        for label in labels:
-            if label in item["spectrum_metadata"]:
-                label_values.append(item["spectrum_metadata"][label])
-            elif assume_scaled_solar and ("[Fe/H]" in item["spectrum_metadata"]):
-                # If no target value available, scale with [Fe/H]
-                label_values.append(item["spectrum_metadata"]["[Fe/H]"])
-            else:
-                # If even [Fe/H] isn't available, leave blank
-                label_values.append(np.nan)
-
-        library_values[object_name] = label_values
-
-        # Look up the Cannon's error estimates for each label
-        label_values = []
-        for label in labels:
-            key = "E_{}".format(label)
-            if key in item["cannon_output"]:
-                label_values.append(item["cannon_output"][key])
-            else:
-                label_values.append(np.nan)
-        if object_name not in cannon_uncertainties:
-            cannon_uncertainties[object_name] = {}
-        cannon_uncertainties[object_name][snr] = label_values
+    # Gather the name of each object, the SNR of each spectrum, and the label values into arrays, with one row per
+    # spectrum in the Cannon output
+    spectra = cannon_json["spectra"]
+    object_names = np.array([item["Starname"] for item in spectra], dtype=object)
+    snr_values = [item["spectrum_metadata"]["SNR"] if "SNR" in item["spectrum_metadata"] else 0 for item in spectra]
+
+    def label_array(function):
+        return np.array([[function(item, label) for label in labels] for item in spectra],
+                        dtype=float).reshape((len(spectra), len(labels)))
+
+    def library_value(item, label):
+        if label in item["spectrum_metadata"]:
+            return item["spectrum_metadata"][label]
+        elif assume_scaled_solar and ("[Fe/H]" in item["spectrum_metadata"]):
+            # If no target value available, scale with [Fe/H]
+            return item["spectrum_metadata"]["[Fe/H]"]
+        # If even [Fe/H] isn't available, leave blank
+        return np.nan
+
+    # library_values = the target values for each label
+    # cannon_values = the Cannon's estimated values of each label
+    # cannon_uncertainties = the Cannon's error estimates for each label
+    library_values = label_array(library_value)
+    cannon_values = label_array(lambda item, label: item["cannon_output"][label])
+    cannon_uncertainties = label_array(lambda item, label: item["cannon_output"].get("E_{}".format(label), np.nan))
+
+    # Group spectra by object and by SNR. Where an object appears more than once at the same SNR, the last entry wins.
+    unique_objects, object_index = np.unique(object_names, return_inverse=True)
+    unique_snrs, snr_first_index, snr_index = np.unique(np.array(snr_values, dtype=float),
+                                                         return_index=True, return_inverse=True)
+    object_count = len(unique_objects)
+
+    _, library_rows = last_occurrences(object_index)
+    grid_keys, grid_rows = last_occurrences(snr_index * object_count + object_index)
+
+    # Format all the numbers in each table in one go. <library_text> is indexed by [object, label], and <cannon_text>
+    # by [snr, object, label, value / uncertainty]. Objects which have no spectrum at a particular SNR are given
+    # placeholders.
+    library_text = np.char.mod("%10.4f", library_values[library_rows])
+    cannon_text = np.full((len(unique_snrs) * object_count, len(labels), 2), "{:10s}", dtype=object)
+    cannon_text[grid_keys, :, 0] = np.char.mod("%10.4f", cannon_values[grid_rows])
+    cannon_text[grid_keys, :, 1] = np.char.mod("%10.4f", cannon_uncertainties[grid_rows])
+    cannon_text = cannon_text.reshape((len(unique_snrs), object_count, len(labels), 2))
+
+    # Headings at the top of each file
+    words = []
+    for item in labels:
+        words.append("in_{}".format(item))
+        words.append("out_{}".format(item))
+        words.append("err_{}".format(item))
+    words.append("Starname")
+    heading = "# {}\n".format(" ".join(["{:10s}".format(i) for i in words]))
 
     # Start creating output data files
     snr_list_with_filenames = []
-    snr_list.sort()
-    object_names = list(library_values.keys())
-    object_names.sort()
-    for snr in snr_list:
+    for snr_number, first_index in enumerate(snr_first_index):
+        snr = snr_values[first_index]
         filename = "{}_{:03.0f}.dat".format(output_stub, snr)
         snr_list_with_filenames.append({
             "snr": snr,
             "filename": filename
         })
 
+        # Each line contains the library value, the Cannon's estimate and its uncertainty for each label, followed by
+        # the name of the object
+        lines = []
+        for object_number, object_name in enumerate(unique_objects):
+            words = np.concatenate([library_text[object_number, :, np.newaxis],
+                                    cannon_text[snr_number, object_number]], axis=1).flatten().tolist()
+            words.append(object_name)
+            lines.append(" ".join(words))
+
         with open(filename, "w") as output:
-            # Write headings at the top of the file
-            words = []
-            for item in labels:
-                words.append("in_{}".format(item))
-                words.append("out_{}".format(item))
-                words.append("err_{}".format(item))
-            words.append("Starname")
-            output.write("# {}\n".format(" ".join(["{:10s}".format(i) for i in words])))
-
-            # Loop over stars writing them into data file
-            for object_name in object_names:
-                words = []
-                for index, item in enumerate(labels):
-                    # Start line with the library parameter values
-                    words.append("{:10.4f}".format(library_values[object_name][index]))
-
-                    # Add values which the Cannon estimated at this SNR
-                    if (object_name in cannon_values) and (snr in cannon_values[object_name]):
-                        words.append("{:10.4f}".format(cannon_values[object_name][snr][index]))
-                    else:
-                        words.append("{:10s}")
-
-                    # Add uncertainties which the Cannon reported at this SNR
-                    if (object_name in cannon_values) and (snr in cannon_values[object_name]):
-                        words.append("{:10.4f}".format(cannon_uncertainties[object_name][snr][index]))
-                    else:
-                        words.append("{:10s}")
-
-                # Add name of object
-                words.append(object_name)
-
-                # Write output line
-                line = " ".join(words)
-                output.write("{}\n".format(line))
+            output.write(heading)
+            output.write("".join(["{}\n".format(line) for line in lines]))
+
     return snr_list_with_filenames
 
 
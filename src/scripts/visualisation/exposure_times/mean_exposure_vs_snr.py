@@ -36,35 +36,31 @@ workspace = os_path.join(our_path, "../../../../workspace")
 
 # Construct list of exposure times at each SNR/pixel
 exposures_by_snr = {}
-snr_converter = None
-
-# Open output data file
-with open(args.output_file, "w") as output:
-    # Open spectrum library
-    spectra = SpectrumLibrarySqlite.open_and_search(
-        library_spec=args.library,
-        workspace=workspace,
-        extra_constraints={"continuum_normalised": 1}
-    )
-    library_object, library_items = [spectra[i] for i in ("library", "items")]
-
-    # Loop over objects in SpectrumLibrary
-    for item in library_items:
-        metadata = library_object.get_metadata(ids=item['specId'])[0]
-
-        # Extract exposure time and SNR/pixel from spectrum metadata
-        exposure = metadata['exposure']  # minutes
-        snr = metadata['SNR']  # per pixel
-
-        # Add this exposure time to our table of results
-        if snr not in exposures_by_snr:
-            exposures_by_snr[snr] = []
-        exposures_by_snr[snr].append(exposure)
-
-        # If we don't already have a converter between SNR/pixel and SNR/A, instantiate one
-        if snr_converter is None:
-            spectrum = library_object.open(ids=item['specId']).extract_item(0)
-            snr_converter = SNRConverter(raster=spectrum.wavelengths, snr_at_wavelength=args.wavelength)
+
+# Open spectrum library
+spectra = SpectrumLibrarySqlite.open_and_search(
+    library_spec=args.library,
+    workspace=workspace,
+    extra_constraints={"continuum_normalised": 1}
+)
+library_object, library_items = [spectra[i] for i in ("library", "items")]
+
+# Fetch the metadata of all the spectra in one query. The exposure times were recorded by 4FS when the library was
+# made, so we never need to run 4FS again here.
+library_metadata = library_object.get_metadata(ids=[item['specId'] for item in library_items])
+
+# Loop over objects in SpectrumLibrary
+for metadata in library_metadata:
+    # Extract exposure time and SNR/pixel from spectrum metadata
+    exposure = metadata['exposure']  # minutes
+    snr = metadata['SNR']  # per pixel
+
+    # Add this exposure time to our table of results
+    exposures_by_snr.setdefault(snr, []).append(exposure)
+
+# Instantiate a converter between SNR/pixel and SNR/A
+spectrum = library_object.open(ids=library_items[0]['specId']).extract_item(0)
+snr_converter = SNRConverter(raster=spectrum.wavelengths, snr_at_wavelength=args.wavelength)
 
 # Make list of unique SNR values
 unique_snrs = set(exposures_by_snr.keys())
@@ -79,8 +75,8 @@ with open(args.output_file, "w") as f:
         f.write("{snr_per_pixel:.3f}  {snr_per_a:.3f}  {mean_exposure:.3f}  {std_exposure:.3f}\n".
                 format(snr_per_pixel=snr.per_pixel(),
                        snr_per_a=snr.per_a(),
-                       mean_exposure=np.mean(exposures_by_snr[snr]),
-                       std_exposure=np.std(exposures_by_snr[snr])))
+                       mean_exposure=np.mean(exposures_by_snr[snr_per_pixel]),
+                       std_exposure=np.std(exposures_by_snr[snr_per_pixel])))
 
 # Produce plot of exposure time versus SNR
 stem = args.output_file
@@ -108,6 +108,13 @@ input_library_info = SpectrumLibrarySqlite.open_and_search(
 
 input_library, library_items = [input_library_info[i] for i in ("library", "items")]
 
+# Look up the exposure time of every spectrum in the library in a single query, rather than searching the library
+# for each star in turn
+exposure_time_by_uid = {}
+for metadata in input_library.get_metadata(ids=[item['specId'] for item in library_items]):
+    assert metadata['uid'] not in exposure_time_by_uid, "Multiple spectra with the same UID"
+    exposure_time_by_uid[metadata['uid']] = metadata['exposure']
+
 # Loop over stars, reorganising data by star name and E(B-V)
 data = {}
 for star_index, star in enumerate(cannon_output['stars']):
@@ -126,12 +133,8 @@ for star_index, star in enumerate(cannon_output['stars']):
     if snr_value not in data[object_name][e_bv]:
         data[object_name][e_bv][snr_value] = []
 
-    # Fetch metadata about this star
-    spectra_list = input_library.search(uid=uid, continuum_normalised=1)
-    assert len(spectra_list) == 1, "Multiple spectra with the same UID"
-    spectra_ids = [i["specId"] for i in spectra_list]
-    metadata = input_library.get_metadata(ids=spectra_ids)[0]
-    exposure_time = metadata['exposure']
+    # Look up the exposure time of this star
+    exposure_time = exposure_time_by_uid[uid]
     if not np.isfinite(exposure_time):
         exposure_time = 1e9
     data[object_name][e_bv][snr_value].append([float(exposure_time), star])
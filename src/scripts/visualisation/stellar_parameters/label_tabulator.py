@@ -11,12 +11,91 @@ Take a SpectrumLibrary and tabulate a list of the stellar parameters of the star
 """
 
 import argparse
+import hashlib
+import json
+import os
 import re
 from os import path as os_path
 
 from fourgp_speclib import SpectrumLibrarySqlite
 
 
+def tabulation_cache_filename(workspace, library, library_path, label_list):
+    """
+    Return the filename where we cache the tabulated labels for a spectrum library. The filename is a hash of the
+    library name and constraints, the list of labels, and the modification time and size of the library's database,
+    so that the cache is ignored as soon as the library changes.
+
+    :param workspace:
+        Path to the workspace where we expect to find SpectrumLibraries stored
+    :param library:
+        The name of the SpectrumLibrary, with any constraints in [] brackets
+    :param library_path:
+        The path of the SpectrumLibrary
+    :param label_list:
+        A list of the labels whose values we are to tabulate, or None to tabulate all labels
+    :return:
+        str
+    """
+    index_status = os.stat(os_path.join(library_path, "index.db"))
+    cache_key = hashlib.sha256(json.dumps({
+        "library": library,
+        "labels": label_list,
+        "mtime": index_status.st_mtime,
+        "size": index_status.st_size
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+
+    return os_path.join(workspace, "label_tabulator_cache", "{}.dat".format(cache_key))
+
+
+def tabulate_library(library, label_list, workspace, page_size=10000):
+    """
+    Tabulate the stellar parameters of the stars within a single SpectrumLibrary.
+
+    :param library:
+        The name of the SpectrumLibrary, with any constraints in [] brackets
+    :param label_list:
+        A list of the labels whose values we are to tabulate, or None to tabulate all labels
+    :param workspace:
+        Path to the workspace where we expect to find SpectrumLibraries stored
+    :param page_size:
+        The number of spectra to fetch metadata for in each database query
+    :return:
+        The text of the table
+    """
+
+    # Open spectrum library, and search it for spectra matching any input constraints
+    library_spectra = SpectrumLibrarySqlite.open_and_search(
+        library_spec=library,
+        workspace=workspace,
+        extra_constraints={}
+    )
+    library_object, library_items = [library_spectra[i] for i in ("library", "items")]
+    metadata_fields = library_object.list_metadata_fields()
+
+    # Add an additional constraint on only returning continuum normalised spectra, if that field is defined for this
+    # library
+    if "continuum_normalised" in metadata_fields:
+        constraints = dict(library_spectra["constraints"])
+        constraints["continuum_normalised"] = 1
+        library_items = library_object.search(**constraints)
+
+    library_ids = [item['specId'] for item in library_items]
+
+    # Write column headers at the top of the output
+    columns = label_list if label_list is not None else metadata_fields
+    lines = ["# {}".format("".join(["{} ".format(label) for label in columns]))]
+
+    # Fetch the metadata for the spectra in large pages, rather than querying the database once for each spectrum
+    for page_start in range(0, len(library_ids), page_size):
+        page_metadata = library_object.get_metadata(ids=library_ids[page_start:page_start + page_size])
+
+        lines.extend(["".join(["{} ".format(metadata.get(label, "-")) for label in columns])
+                      for metadata in page_metadata])
+
+    return "\n".join(lines) + "\n"
+
+
 def tabulate_labels(library_list, label_list, output_file, workspace=None):
     """
     Take a SpectrumLibrary and tabulate a list of the stellar parameters of the stars within it.
@@ -49,38 +128,24 @@ def tabulate_labels(library_list, label_list, output_file, workspace=None):
                 library_name = library
             else:
                 library_name = test.group(1)
-
-            # Open spectrum library and extract list of metadata fields which are defined on this library
             library_path = os_path.join(workspace, library_name)
-            library_object = SpectrumLibrarySqlite(path=library_path, create=False)
-            metadata_fields = library_object.list_metadata_fields()
-
-            # Now search library for spectra matching any input constraints, with additional constraint on only
-            # returning continuum normalised spectra, if that field is defined for this library
-            constraints = {}
-            if "continuum_normalised" in metadata_fields:
-                constraints["continuum_normalised"] = 1
-
-            library_spectra = SpectrumLibrarySqlite.open_and_search(
-                library_spec=library,
-                workspace=workspace,
-                extra_constraints=constraints
-            )
-
-            # Write column headers at the top of the output
-            columns = label_list if label_list is not None else library_object.list_metadata_fields()
-            output.write("# ")
-            for label in columns:
-                output.write("{} ".format(label))
-            output.write("\n")
-
-            # Loop over objects in each spectrum library
-            for item in library_spectra["items"]:
-                metadata = library_object.get_metadata(ids=item['specId'])[0]
-
-                for label in columns:
-                    output.write("{} ".format(metadata.get(label, "-")))
-                output.write("\n")
+
+            # If we have already tabulated these labels for this library, and it hasn't changed since, reuse the table
+            cache_filename = tabulation_cache_filename(workspace=workspace, library=library,
+                                                       library_path=library_path, label_list=label_list)
+
+            if os_path.exists(cache_filename):
+                with open(cache_filename) as f:
+                    table = f.read()
+            else:
+                table = tabulate_library(library=library, label_list=label_list, workspace=workspace)
+
+                os.system("mkdir -p {}".format(os_path.split(cache_filename)[0]))
+                with open("{}.{:d}.tmp".format(cache_filename, os.getpid()), "w") as f:
+                    f.write(table)
+                os.rename("{}.{:d}.tmp".format(cache_filename, os.getpid()), cache_filename)
+
+            output.write(table)
 
 
 # If we're invoked as a script, read input parameters from the command line
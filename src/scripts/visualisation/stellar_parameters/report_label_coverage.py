@@ -26,6 +26,8 @@ parser.add_argument('--library', required=True, dest='library',
                          "range.")
 parser.add_argument('--label', dest='labels', action="append",
                     help="Label to check coverage of.")
+parser.add_argument('--page-size', dest='page_size', type=int, default=10000,
+                    help="The number of spectra to fetch metadata for in each database query.")
 args = parser.parse_args()
 
 # Set path to workspace where we expect to find libraries of spectra
@@ -51,16 +53,26 @@ else:
 # Create blank structure into which to count how many spectra have each label set
 count = [0] * len(label_list)
 
-# Test if metadata label is set on each spectrum in turn
-spectrum_count = 0
-for spectrum_index, spectrum_id in enumerate(library_ids):
-    spectrum_array = library.open(ids=spectrum_id)
-    spectrum_count += 1
-    metadata = spectrum_array.get_metadata(0)
+
+def label_is_set(value):
+    """
+    Test whether a metadata value is set, i.e. it is not None, and is finite if it is a number.
+    """
+    if value is None:
+        return False
+    if isinstance(value, (int, float)):
+        return bool(np.isfinite(value))
+    return True
+
+
+# Fetch the metadata of the spectra in large pages, without opening the spectra themselves, and count how many spectra
+# have each label set
+spectrum_count = len(library_ids)
+for page_start in range(0, spectrum_count, args.page_size):
+    page_metadata = library.get_metadata(ids=library_ids[page_start:page_start + args.page_size])
 
     for label_index, label in enumerate(label_list):
-        if (label in metadata) and (metadata[label] is not None) and np.isfinite(metadata[label]):
-            count[label_index] += 1
+        count[label_index] += sum(label_is_set(metadata.get(label, None)) for metadata in page_metadata)
 
 for label_index, label in enumerate(label_list):
     print("Label {:16s} is set on {:5d} / {:5d} spectra.".format(label, count[label_index], spectrum_count))